@@ -0,0 +1,103 @@
+# docker-compose exec app python3 benchmark.py -e sushigo gonutsfordonuts -st 5000
+
+import os
+import time
+import argparse
+import numpy as np
+
+from contextlib import redirect_stdout
+from functools import partial
+
+from stable_baselines import logger
+from stable_baselines.common import set_global_seeds
+
+from utils.register import get_environment
+from utils.selfplay import selfplay_wrapper
+
+import config
+
+ENV_NAMES = ['tictactoe', 'connect4', 'sushigo', 'gonutsfordonuts', 'butterfly', 'geschenkt', 'frouge']
+
+
+def steps_per_second(env, steps, render):
+    # random legal moves, rendering every ply (as SelfPlayEnv used to) or not at all (headless)
+    env.reset()
+    start = time.perf_counter()
+    for _ in range(steps):
+        if render:
+            env.render()
+        action = np.random.choice(np.flatnonzero(env.legal_actions))
+        _, _, done, _ = env.step(action)
+        if done:
+            env.reset()
+    return steps / (time.perf_counter() - start)
+
+
+def selfplay_steps_per_second(env, steps, render):
+    # random legal moves by the agent through SelfPlayEnv.step, with the base model playing the opponents.
+    # Rendering is the only difference between the modes: SelfPlayEnv used to call the environment's render
+    # on every ply whatever the log level, so that call is put back for the render mode
+    if render:
+        env.render = partial(type(env).__bases__[0].render, env)
+    try:
+        return steps_per_second(env, steps, render = False)
+    finally:
+        if render:
+            del env.render
+
+
+def main(args):
+
+    logger.set_level(config.INFO)
+
+    timed = selfplay_steps_per_second if args.selfplay else steps_per_second
+
+    print(f"{'env':<20}{'render':>12}{'headless':>12}{'speedup':>10}")
+    for env_name in args.env_names:
+        env = get_environment(env_name)
+        if args.selfplay:
+            env = selfplay_wrapper(env)(opponent_type = 'base', verbose = args.verbose)
+        else:
+            env = env(verbose = args.verbose)
+
+        timings = []
+        with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+            for render in (True, False):
+                # the same games in each mode
+                set_global_seeds(args.seed)
+                timings.append(timed(env, args.steps, render))
+
+        before, after = timings
+        print(f"{env_name:<20}{before:>12.0f}{after:>12.0f}{after / before:>9.1f}x")
+
+
+def cli() -> None:
+  """Handles argument extraction from CLI and passing to main().
+  Note that a separate function is used rather than in __name__ == '__main__'
+  to allow unit testing of cli().
+  """
+  # Setup argparse to show defaults on help
+  formatter_class = argparse.ArgumentDefaultsHelpFormatter
+  parser = argparse.ArgumentParser(formatter_class=formatter_class)
+
+  parser.add_argument("--env_names", "-e", nargs = '+', type = str, default = ENV_NAMES
+            , help="Which environments to benchmark")
+  parser.add_argument("--steps", "-st", type = int, default = 2000
+            , help="How many steps to time in each mode")
+  parser.add_argument("--verbose", "-v", action = 'store_true', default = False
+            , help="Include the observation in the rendered output")
+  parser.add_argument("--selfplay", "-sp", action = 'store_true', default = False
+            , help="Time SelfPlayEnv.step against the base model, rendering every ply (the old behaviour) or not, rather than the bare env")
+  parser.add_argument("--seed", "-s", type = int, default = 17
+            , help="Random seed")
+
+  # Extract args
+  args = parser.parse_args()
+
+  # Enter main
+  main(args)
+  return
+
+
+if __name__ == '__main__':
+  cli()
@@ -9,3 +9,8 @@ LOGDIR = "logs"
 RESULTSPATH = 'viz'
 TMPMODELDIR = "zoo/tmp"
 MODELDIR = "zoo"
+
+
+MODEL_POOL_MEMORY = 2048 # MB of model parameters held in each process before the least recently used models are evicted
+ZOO_MANIFEST = 'manifest.jsonl' # index of the generations in each zoo directory
+ZOO_MANIFEST_REFRESH = 5 # seconds between checks of a zoo manifest for new generations
@@ -1,33 +1,185 @@
-import pandas as pd
+import os
+import re
+import csv
+import json
+import time
 import matplotlib.pyplot as plt
 import seaborn as sb
 import numpy as np
 
 import argparse
 
-# read file
+MODEL_NAME = re.compile(r'^_(model_\d{5})_.+$')
 
-def main(args) -> None:
 
-    df = pd.read_csv(args.filename)
+def label(name):
     # Sort so base appears lexographically before _model_00001
-    df = df.replace('base', 'model_00000_base')
+    if name == 'base':
+        return 'model_00000_base'
     # Replace unnecessary suffixes
-    df = df.replace(to_replace=r'^_(model_\d{5})_.+$', value=r'\1', regex=True)
+    return MODEL_NAME.sub(r'\1', name)
+
 
-    # Create score difference between models, in the 3 player game (with 1 base) both models will likely score on average > 0
+class ResultsMatrix():
+    # running count, sum and sum of squares of the score difference between model0 and model1 for every pair,
+    # grown as new models turn up. In the 3 player game (with 1 base) both models will likely score on average > 0
     # (taking score from base), so this tests if model0 is doing better than model1
-    df['score0-score1'] = df['score0'] - df['score1']
+    def __init__(self):
+        self.index = {}
+        self.labels = []
+        self.n = np.zeros((0, 0))
+        self.total = np.zeros((0, 0))
+        self.total_sq = np.zeros((0, 0))
+        self.rows = 0
+
+    def position(self, name):
+        if name not in self.index:
+            name_label = label(name)
+            self.index[name] = len(self.labels)
+            self.labels.append(name_label)
+            if len(self.labels) > len(self.n):
+                self.grow(max(16, 2 * len(self.n)))
+        return self.index[name]
+
+    def grow(self, size):
+        old = len(self.n)
+        for field in ['n', 'total', 'total_sq']:
+            grown = np.zeros((size, size))
+            grown[:old, :old] = getattr(self, field)
+            setattr(self, field, grown)
+
+    def add_rows(self, rows):
+        # game rows (p0 / p1 points, from the all results file or the cache) or cell rows (score0 / score1,
+        # from the tournament results file, where each cell counts as a single result)
+        if len(rows) == 0:
+            return
+        if 'p0_points' in rows[0]:
+            players, points = ('p0', 'p1'), ('p0_points', 'p1_points')
+        else:
+            players, points = ('model0', 'model1'), ('score0', 'score1')
+        i = np.array([self.position(row[players[0]]) for row in rows])
+        j = np.array([self.position(row[players[1]]) for row in rows])
+        difference = np.array([float(row[points[0]]) - float(row[points[1]]) for row in rows])
+        np.add.at(self.n, (i, j), 1)
+        np.add.at(self.total, (i, j), difference)
+        np.add.at(self.total_sq, (i, j), difference ** 2)
+        self.rows += len(rows)
+
+    def means(self, z = 0):
+        # the mean difference of every pair, in label order, with the pairs that haven't played - or, for z > 0,
+        # whose mean is within z standard errors of 0 - left empty
+        order = np.argsort(self.labels)
+        m = len(order)
+        n, total, total_sq = (x[:m, :m][order][:, order] for x in (self.n, self.total, self.total_sq))
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            mean = total / n
+            half_width = z * np.sqrt(np.maximum(total_sq / n - mean ** 2, 0) / n)
+        mean[n == 0] = np.nan
+        if z > 0:
+            mean[np.abs(mean) <= half_width] = np.nan
+        return [self.labels[k] for k in order], mean, n
+
+
+class ResultsReader():
+    # reads the rows added to a results file since the last read. CSV files and the tournament cache (.jsonl) can be
+    # followed while a tournament writes them, as only complete lines are read. A Parquet file is only readable
+    # once it has been closed, so it is read once, a row group at a time
+    def __init__(self, filename):
+        self.filename = filename
+        self.offset = 0
+        self.fieldnames = None
+        # the os.stat of the file when it was last read
+        self.stat = None
+
+    def rewritten(self):
+        # the tournament starts its results files from scratch on every run, as new files renamed over the old ones,
+        # so a different inode means a new file. One that has been truncated and written again in place is caught
+        # if it is now smaller, or has been changed without growing
+        if self.stat is None or not os.path.exists(self.filename):
+            return False
+        stat = os.stat(self.filename)
+        if stat.st_ino != self.stat.st_ino or stat.st_size < self.stat.st_size:
+            return True
+        return stat.st_size == self.stat.st_size and stat.st_mtime_ns != self.stat.st_mtime_ns
+
+    def read(self):
+        if not os.path.exists(self.filename):
+            return
+        if self.filename.endswith('.parquet'):
+            yield from self.read_parquet()
+        else:
+            yield from self.read_lines()
+
+    def read_lines(self):
+        with open(self.filename, 'rb') as f:
+            self.stat = os.fstat(f.fileno())
+            f.seek(self.offset)
+            data = f.read()
+        end = data.rfind(b'\n') + 1
+        self.offset += end
+        lines = data[:end].decode().splitlines()
+
+        if self.filename.endswith('.jsonl'):
+            for line in lines:
+                yield json.loads(line)['game_rows']
+            return
+
+        if self.fieldnames is None and len(lines) > 0:
+            self.fieldnames = next(csv.reader(lines[:1]))
+            lines = lines[1:]
+        yield list(csv.DictReader(lines, fieldnames = self.fieldnames))
+
+    def read_parquet(self):
+        import pyarrow.parquet as pq
+
+        if self.offset > 0:
+            return
+        self.stat = os.stat(self.filename)
+        parquet_file = pq.ParquetFile(self.filename)
+        for k in range(parquet_file.num_row_groups):
+            columns = parquet_file.read_row_group(k).to_pydict()
+            yield [dict(zip(columns, values)) for values in zip(*columns.values())]
+        self.offset = self.stat.st_size
+
+
+def draw(fig, matrix, args):
+    labels, mean, n = matrix.means(args.z)
+    print(f"{matrix.rows} results for {len(labels)} models, {int(np.sum(n > 0))} of {len(labels) ** 2} pairs played")
+
+    fig.clf()
+    ax = fig.add_subplot(1, 1, 1)
+    sb.heatmap(mean, xticklabels = labels, yticklabels = labels, annot = len(labels) <= args.max_annotated
+        , vmin=-1.0, vmax=1.0, ax = ax)
+    ax.set_xlabel('model1')
+    ax.set_ylabel('model0')
+
+    # replaced in one go, so that anything watching the image never sees half of it
+    tmp_file = f"{args.savefile}.tmp"
+    fig.savefig(tmp_file, format = os.path.splitext(args.savefile)[1][1:] or 'png')
+    os.replace(tmp_file, args.savefile)
+
+
+def main(args) -> None:
+
+    matrix = ResultsMatrix()
+    reader = ResultsReader(args.filename)
+    fig = plt.figure(figsize = (18, 15))
 
-    print(df.head())
+    while True:
+        if reader.rewritten():
+            matrix = ResultsMatrix()
+            reader = ResultsReader(args.filename)
 
-    results_sq = df.pivot(index='model0', columns='model1', values='score0-score1')
+        rows = matrix.rows
+        for chunk in reader.read():
+            matrix.add_rows(chunk)
 
-    print(results_sq.head())
+        if matrix.rows > rows:
+            draw(fig, matrix, args)
 
-    fig, ax = plt.subplots(1, 1, figsize = (18, 15))
-    sb.heatmap(results_sq, annot = True, vmin=-1.0, vmax=1.0)
-    plt.savefig(args.savefile)
+        if not args.follow:
+            break
+        time.sleep(args.interval)
 
 
 def cli() -> None:
@@ -35,8 +187,16 @@ def cli() -> None:
   formatter_class = argparse.ArgumentDefaultsHelpFormatter
   parser = argparse.ArgumentParser(formatter_class=formatter_class)
 
-  parser.add_argument("filename", help="Data file to plot")
+  parser.add_argument("filename", help="Data file to plot (tournament or all results .csv / .parquet, or the tournament's -cache.jsonl)")
   parser.add_argument("savefile", help="Filename for png to save")
+  parser.add_argument("--follow", "-f", action = 'store_true', default = False
+            , help="Keep reading the file as a tournament adds to it, redrawing the heatmap when there are new results")
+  parser.add_argument("--interval", "-i", type = float, default = 10
+            , help="Seconds between reads of the file when following it")
+  parser.add_argument("--z", "-z", type = float, default = 0
+            , help="Leave out the pairs whose mean difference is within this many standard errors of 0 (0 shows every pair played)")
+  parser.add_argument("--max_annotated", "-ma", type = int, default = 40
+            , help="Only write the values in the cells when there are at most this many models")
 
 
   #parser.add_argument("player_to_exclude", action = 'store_true', default = False
@@ -51,4 +211,4 @@ def cli() -> None:
 
 
 if __name__ == '__main__':
-  cli()
\ No newline at end of file
+  cli()
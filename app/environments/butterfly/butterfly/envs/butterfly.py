@@ -4,12 +4,13 @@ import numpy as np
 import random
 
 import config
+from utils.cache import GameStateCache
 
 from stable_baselines import logger
 
 from .classes import *
 
-class ButterflyEnv(gym.Env):
+class ButterflyEnv(GameStateCache, gym.Env):
     metadata = {'render.modes': ['human']}
 
     def __init__(self, verbose = False, manual = False):
@@ -65,8 +66,7 @@ class ButterflyEnv(gym.Env):
             self.contents.append({'tile': Wasp, 'info': {'name': 'wasp', 'value': value}, 'count':  1})
 
         
-    @property
-    def observation(self):
+    def compute_observation(self):
         obs = np.zeros(([self.total_positions, self.total_tiles]))
         player_num = self.current_player_num
 
@@ -131,8 +131,7 @@ class ButterflyEnv(gym.Env):
 
         return ret
 
-    @property
-    def legal_actions(self):
+    def compute_legal_actions(self):
         legal_actions = np.zeros(self.action_space.n)
 
         # UP / DOWN
@@ -223,7 +222,8 @@ class ButterflyEnv(gym.Env):
 
 
     def choose_net_tile(self):
-        logger.debug(f'Player {self.current_player.id} choosing extra tile using net')
+        if logger.get_level() <= config.DEBUG:
+            logger.debug(f'Player {self.current_player.id} choosing extra tile using net')
         self.current_player.position.add(self.drawbag.draw(1))
 
     def choose_tile(self, square):
@@ -232,7 +232,8 @@ class ButterflyEnv(gym.Env):
             logger.debug(f"Player {self.current_player.id} trying to pick tile from square {square} but doesn't exist!")
             raise Exception('tile not found')
 
-        logger.debug(f"Player {self.current_player.id} picking {tile.symbol}")
+        if logger.get_level() <= config.DEBUG:
+            logger.debug(f"Player {self.current_player.id} picking {tile.symbol}")
         self.current_player.position.add([tile])
 
 
@@ -274,6 +275,8 @@ class ButterflyEnv(gym.Env):
                 self.board.hudson_facing = 'U'
             
             self.board.hudson = square
+            # the legal actions don't depend on whose turn it is, so they can be cached for the end of game check
+            self.clear_cache()
 
             if sum(self.legal_actions) == 0:
                 reward = self.score_game()
@@ -312,6 +315,7 @@ class ButterflyEnv(gym.Env):
 
         self.turns_taken = 0
 
+        self.clear_cache()
         return self.observation
 
 
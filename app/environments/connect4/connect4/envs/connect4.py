@@ -3,6 +3,7 @@ import gym
 import numpy as np
 
 import config
+from utils.cache import GameStateCache
 
 from stable_baselines import logger
 
@@ -21,7 +22,7 @@ class Token():
         self.symbol = symbol
         
         
-class Connect4Env(gym.Env):
+class Connect4Env(GameStateCache, gym.Env):
     metadata = {'render.modes': ['human']}
 
     def __init__(self, verbose = False, manual = False):
@@ -39,8 +40,7 @@ class Connect4Env(gym.Env):
         self.verbose = verbose
         
 
-    @property
-    def observation(self):
+    def compute_observation(self):
         if self.current_player.token.number == 1:
             position_1 = np.array([1 if x.number == 1 else 0  for x in self.board]).reshape(self.grid_shape)
             position_2 = np.array([1 if x.number == -1 else 0 for x in self.board]).reshape(self.grid_shape)
@@ -53,8 +53,7 @@ class Connect4Env(gym.Env):
         out = np.stack([position_1, position_2, position_3], axis = -1) 
         return out
 
-    @property
-    def legal_actions(self):
+    def compute_legal_actions(self):
         legal_actions = []
         for action_num in range(self.action_space.n):
             legal = self.is_legal(action_num)
@@ -138,6 +137,7 @@ class Connect4Env(gym.Env):
         if not done:
             self.current_player_num = (self.current_player_num + 1) % 2
 
+        self.clear_cache()
         return self.observation, reward, done, {}
 
     def reset(self):
@@ -147,6 +147,7 @@ class Connect4Env(gym.Env):
         self.turns_taken = 0
         self.done = False
         logger.debug(f'\n\n---- NEW GAME ----')
+        self.clear_cache()
         return self.observation
 
 
@@ -6,6 +6,7 @@ import random
 from functools import cmp_to_key
 
 import config
+from utils.cache import GameStateCache
 
 from stable_baselines import logger
 from stable_baselines.common import set_global_seeds
@@ -22,7 +23,7 @@ PLAYER_COLOR_MAP = {
                 "5" : "95",
             }
 
-class FlammeRougeEnv(gym.Env):
+class FlammeRougeEnv(GameStateCache, gym.Env):
     metadata = {'render.modes': ['human']}
 
     def __init__(self, verbose = False, manual = False):
@@ -42,8 +43,7 @@ class FlammeRougeEnv(gym.Env):
         self.verbose = verbose
 
         
-    @property
-    def observation(self):
+    def compute_observation(self):
         cell_dim_size = (MAX_CODE + 2*self.n_players)
         #add race board
         board_array = np.array(self.board.array)
@@ -95,8 +95,7 @@ class FlammeRougeEnv(gym.Env):
 
         return obs
 
-    @property
-    def legal_actions(self):
+    def compute_legal_actions(self):
         legal_actions = np.zeros(self.action_space.n)
         if self.phase == 2:
             cyclist = self.current_player.hand_order[self.hand_number]
@@ -301,6 +300,7 @@ class FlammeRougeEnv(gym.Env):
 
         self.done = done
 
+        self.clear_cache()
         return self.observation, reward, done, {}
 
     def finish_turn(self):
@@ -386,6 +386,7 @@ class FlammeRougeEnv(gym.Env):
         logger.debug(f'\n\n---- NEW GAME ----')
         self.render_map(first_turn=True)
 
+        self.clear_cache()
         return self.observation
 
     def render_map(self,first_turn=False):
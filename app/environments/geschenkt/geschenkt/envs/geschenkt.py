@@ -3,12 +3,13 @@ import gym
 import numpy as np
 
 import config
+from utils.cache import GameStateCache
 
 from stable_baselines import logger
 
 from .classes import *
 
-class GeschenktEnv(gym.Env):
+class GeschenktEnv(GameStateCache, gym.Env):
     metadata = {'render.modes': ['human']}
 
     def __init__(self, verbose = False, manual = False, n_players = 3):
@@ -50,8 +51,7 @@ class GeschenktEnv(gym.Env):
         self.verbose = verbose
 
         
-    @property
-    def observation(self):
+    def compute_observation(self):
         # Cards
         obs = np.zeros(([self.total_positions, self.total_cards]))
         player_num = self.current_player_num
@@ -98,8 +98,7 @@ class GeschenktEnv(gym.Env):
 
         return ret
 
-    @property
-    def legal_actions(self):
+    def compute_legal_actions(self):
         legal_actions = np.zeros(self.action_space.n)
         if self.current_player.counters.size() > 0:
             legal_actions[0] = 1
@@ -151,7 +150,8 @@ class GeschenktEnv(gym.Env):
                 self.current_player_num = (self.current_player_num + 1) % self.n_players
 
             else:
-                logger.debug(f'Player chooses to take card {self.centre_card.cards[0].symbol} and {self.centre_counters.size()} counters')
+                if logger.get_level() <= config.DEBUG:
+                    logger.debug(f'Player chooses to take card {self.centre_card.cards[0].symbol} and {self.centre_counters.size()} counters')
                 self.current_player.position.add(self.centre_card.cards)
                 self.current_player.counters.add(self.centre_counters.size())
                 self.centre_card.reset()
@@ -171,6 +171,7 @@ class GeschenktEnv(gym.Env):
 
         self.done = done
 
+        self.clear_cache()
         return self.observation, reward, done, {}
 
 
@@ -205,6 +206,7 @@ class GeschenktEnv(gym.Env):
         self.done = False
 
         logger.debug(f'\n\n---- NEW GAME ----')
+        self.clear_cache()
         return self.observation
 
 
@@ -0,0 +1,376 @@
+import gym
+import numpy as np
+
+import gonutsfordonuts.envs.cards as cards
+import gonutsfordonuts.envs.actions as actions
+
+from stable_baselines import logger
+
+from utils.cache import GameStateCache
+
+from .gonutsfordonuts import GoNutsGame, GoNutsGameState, GoNutsScorer, GoNutsGameGymTranslator
+
+
+class GoNutsBatchGame:
+    # n_games GoNutsGames held as arrays, one row per game, so that a move in any number of games is a handful of
+    # NumPy operations rather than a walk through the Card objects of each game.
+    # The deck and the discard of each game are stacks of card ids, drawn from the end like the Deck and Discard
+    # lists, and the positions are counts of each card type, which is all that scoring and the observations use
+    def __init__(self, n_games, n_players, deck_filter):
+        self.n_games = n_games
+        self.n_players = n_players
+        self.no_donut_decks = n_players + 1
+
+        # the type of each card id, from the cards the standard deck is built from
+        self.card_types = np.array([ card.type for card in GoNutsGame.card_catalogue().cards ])
+        self.deck_filter = np.array(deck_filter)
+        n_cards = len(self.deck_filter)
+
+        self.deck = np.zeros((n_games, n_cards), dtype=np.int64)
+        self.deck_size = np.zeros(n_games, dtype=np.int64)
+        self.discard = np.zeros((n_games, n_cards), dtype=np.int64)
+        self.discard_size = np.zeros(n_games, dtype=np.int64)
+        self.discard_counts = np.zeros((n_games, cards.TOTAL_TYPES), dtype=np.int32)
+        self.counts = np.zeros((n_games, n_players, cards.TOTAL_TYPES), dtype=np.int32)
+        self.scores = np.zeros((n_games, n_players))
+
+        self.donut_decks = np.zeros((n_games, self.no_donut_decks), dtype=np.int64)
+        self.taken = np.zeros((n_games, self.no_donut_decks), dtype=bool)
+        self.to_discard = np.zeros((n_games, self.no_donut_decks), dtype=bool)
+
+        self.game_state = np.zeros(n_games, dtype=np.int64)
+        self.donut_player = np.zeros(n_games, dtype=np.int64)
+        self.action_player = np.zeros(n_games, dtype=np.int64)
+        self.current_player = np.zeros(n_games, dtype=np.int64)
+        # the donut deck each player picked this turn, and the type of card they got from it (-1 if discarded)
+        self.picks = np.zeros((n_games, n_players), dtype=np.int64)
+        self.cards_picked = np.full((n_games, n_players), -1, dtype=np.int64)
+        self.turns_taken = np.zeros(n_games, dtype=np.int64)
+        self.game_ends = np.zeros(n_games, dtype=bool)
+
+    def reset_games(self, games, decks = None):
+        """Deals new games, from a shuffle of the filtered deck or from decks given as card ids in draw order"""
+        if decks is None:
+            order = np.argsort(np.random.random((len(games), len(self.deck_filter))), axis=1)
+            decks = self.deck_filter[order]
+        self.deck[games] = decks
+        self.deck_size[games] = self.deck.shape[1]
+
+        self.discard_size[games] = 0
+        self.discard_counts[games] = 0
+        self.counts[games] = 0
+        self.scores[games] = 0
+        self.game_state[games] = GoNutsGameState.PICK_DONUT
+        self.donut_player[games] = 0
+        self.action_player[games] = 0
+        self.current_player[games] = 0
+        self.cards_picked[games] = -1
+        self.turns_taken[games] = 0
+        self.game_ends[games] = False
+
+        self.taken[games] = False
+        self.to_discard[games] = False
+        for i in range(self.no_donut_decks):
+            self.donut_decks[games, i] = self.draw_one(games)
+
+    def draw_one(self, games):
+        self.deck_size[games] -= 1
+        return self.deck[games, self.deck_size[games]]
+
+    def push_discard(self, games, card_ids):
+        self.discard[games, self.discard_size[games]] = card_ids
+        self.discard_size[games] += 1
+        np.add.at(self.discard_counts, (games, self.card_types[card_ids]), 1)
+
+    def pop_discard(self, games):
+        self.discard_size[games] -= 1
+        card_ids = self.discard[games, self.discard_size[games]]
+        np.add.at(self.discard_counts, (games, self.card_types[card_ids]), -1)
+        return card_ids
+
+    @staticmethod
+    def remove_at(stacks, games, sizes, index):
+        # closes the gap left by the card at index in each game's stack, keeping the order of the others
+        columns = np.arange(stacks.shape[1])
+        shifted = np.minimum(columns + (columns >= index[:, None]), stacks.shape[1] - 1)
+        stacks[games] = np.take_along_axis(stacks[games], shifted, axis=1)
+        sizes[games] -= 1
+
+    @staticmethod
+    def choose(matches):
+        # a random one of the matching columns in each row, like the random.choice in translate_step_action
+        r = np.random.random(matches.shape)
+        r[~matches] = -1
+        return np.argmax(r, axis=1)
+
+    def add_to_positions(self, games, players, card_types):
+        np.add.at(self.counts, (games, players, card_types), 1)
+
+    def step(self, games, step_actions):
+        """Plays the action of the player to move in each of games, which must all be unfinished"""
+        # grouped by the state before the move, as a move can take a game into one of the later states
+        game_states = self.game_state[games]
+        for state, do_action in ((GoNutsGameState.PICK_DONUT, self.do_pick_donut_action)
+            , (GoNutsGameState.PICK_DISCARD, self.do_pick_discard_action)
+            , (GoNutsGameState.PICK_ONE_FROM_TWO_DECK_CARDS, self.do_pick_one_from_two_deck_action)
+            , (GoNutsGameState.GIVE_CARD, self.do_give_card_action)):
+            in_state = game_states == state
+            if in_state.any():
+                do_action(games[in_state], step_actions[in_state])
+
+    def do_pick_donut_action(self, games, step_actions):
+        card_types = step_actions - actions.ACTION_DONUT
+        matches = self.card_types[self.donut_decks[games]] == card_types[:, None]
+        if not matches.any(axis=1).all():
+            raise RuntimeError(f"Can't find donut of types {card_types[~matches.any(axis=1)]} in positions")
+        self.picks[games, self.donut_player[games]] = self.choose(matches)
+        self.donut_player[games] += 1
+
+        # All players have picked a card, process actions
+        all_picked = self.donut_player[games] == self.n_players
+        self.current_player[games[~all_picked]] = self.donut_player[games[~all_picked]]
+        if all_picked.any():
+            games = games[all_picked]
+            self.pick_cards(games)
+            self.action_player[games] = 0
+            self.check_actions(games)
+
+    def pick_cards(self, games):
+        picks = self.picks[games]
+        for p in range(self.n_players):
+            deck_picked = picks[:, p]
+            card_types = self.card_types[self.donut_decks[games, deck_picked]]
+            shared = (picks == deck_picked[:, None]).sum(axis=1) > 1
+
+            self.to_discard[games[shared], deck_picked[shared]] = True
+            self.cards_picked[games[shared], p] = -1
+
+            won = ~shared
+            self.taken[games[won], deck_picked[won]] = True
+            self.cards_picked[games[won], p] = card_types[won]
+            self.add_to_positions(games[won], p, card_types[won])
+
+    def do_pick_discard_action(self, games, step_actions):
+        card_types = step_actions - actions.ACTION_DISCARD
+        in_discard = np.arange(self.discard.shape[1]) < self.discard_size[games][:, None]
+        matches = (self.card_types[self.discard[games]] == card_types[:, None]) & in_discard
+        if not matches.any(axis=1).all():
+            raise RuntimeError(f"Can't find donut of types {card_types[~matches.any(axis=1)]} in discards")
+        self.remove_at(self.discard, games, self.discard_size, self.choose(matches))
+        np.add.at(self.discard_counts, (games, card_types), -1)
+        self.add_to_positions(games, self.action_player[games], card_types)
+        self.next_action_player(games)
+
+    def do_pick_one_from_two_deck_action(self, games, step_actions):
+        card_types = step_actions - actions.ACTION_DECK
+        top = self.deck_size[games] - 1
+        # the top card if it's the type asked for, otherwise the one under it
+        index = np.where(self.card_types[self.deck[games, top]] == card_types, top, top - 1)
+        if (index < 0).any():
+            raise RuntimeError(f"Can't find donut of types {card_types[index < 0]} in 2-from-deck-pick")
+        card_ids = self.deck[games, index]
+        self.remove_at(self.deck, games, self.deck_size, index)
+        self.add_to_positions(games, self.action_player[games], self.card_types[card_ids])
+        self.next_action_player(games)
+
+    def do_give_card_action(self, games, step_actions):
+        card_types = step_actions - actions.ACTION_GIVE_CARD
+        players = self.action_player[games]
+        if (self.counts[games, players, card_types] == 0).any():
+            raise RuntimeError(f"Can't find donut of types {card_types} in positions of players {players}")
+
+        # always give to the player with the lowest score, excluding the current player (the first, on a tie)
+        scores = self.scores[games].copy()
+        scores[np.arange(len(games)), players] = np.inf
+        target_players = np.argmin(scores, axis=1)
+
+        np.add.at(self.counts, (games, players, card_types), -1)
+        self.add_to_positions(games, target_players, card_types)
+        self.next_action_player(games)
+
+    def next_action_player(self, games):
+        self.action_player[games] += 1
+        self.check_actions(games)
+
+    def check_actions(self, games):
+        # plays the instant actions of each game's action players in turn, until a player needs to make a choice
+        # or every player has had their action, which ends the turn
+        while len(games):
+            end_turn = self.action_player[games] == self.n_players
+            if end_turn.any():
+                self.end_turn(games[end_turn])
+                games = games[~end_turn]
+
+            players = self.action_player[games]
+            card_types = self.cards_picked[games, players]
+
+            # skip the state if there are no discard or deck cards for it
+            pick_discard = (card_types == cards.TYPE_RV) & (self.discard_size[games] > 0)
+            pick_from_deck = (card_types == cards.TYPE_DC) & (self.deck_size[games] > 0)
+            give_card = card_types == cards.TYPE_SPR
+
+            self.game_state[games[pick_discard]] = GoNutsGameState.PICK_DISCARD
+            self.game_state[games[pick_from_deck]] = GoNutsGameState.PICK_ONE_FROM_TWO_DECK_CARDS
+            self.game_state[games[give_card]] = GoNutsGameState.GIVE_CARD
+            choice = pick_discard | pick_from_deck | give_card
+            self.current_player[games[choice]] = players[choice]
+
+            games, players, card_types = games[~choice], players[~choice], card_types[~choice]
+            self.game_state[games] = GoNutsGameState.INSTANT_ACTION
+
+            # Chocolate Frosted draws the top card from the draw deck
+            draw = (card_types == cards.TYPE_CF) & (self.deck_size[games] > 0)
+            self.add_to_positions(games[draw], players[draw], self.card_types[self.draw_one(games[draw])])
+
+            # Eclair draws the top card from the discard
+            draw = (card_types == cards.TYPE_ECL) & (self.discard_size[games] > 0)
+            self.add_to_positions(games[draw], players[draw], self.card_types[self.pop_discard(games[draw])])
+
+            self.action_player[games] += 1
+
+    def end_turn(self, games):
+        self.game_state[games] = GoNutsGameState.PICK_DONUT
+        self.donut_player[games] = 0
+        self.action_player[games] = 0
+        self.current_player[games] = 0
+        self.turns_taken[games] += 1
+
+        # Check end of game
+        refill = self.taken[games] | self.to_discard[games]
+        ends = refill.sum(axis=1) > self.deck_size[games]
+        self.game_ends[games[ends]] = True
+
+        # Redraw and discard any used decks, in deck order
+        refilled_games, refill = games[~ends], refill[~ends]
+        for i in range(self.no_donut_decks):
+            discarded = refilled_games[self.to_discard[refilled_games, i]]
+            if len(discarded):
+                self.push_discard(discarded, self.donut_decks[discarded, i])
+            refilled = refilled_games[refill[:, i]]
+            self.donut_decks[refilled, i] = self.draw_one(refilled)
+        self.taken[refilled_games] = False
+        self.to_discard[refilled_games] = False
+
+        # Per-turn scores are an observation for the agents
+        self.scores[games] = GoNutsScorer.score_counts(self.counts[games])
+
+
+class GoNutsForDonutsBatchEnv(GameStateCache):
+    """n_games GoNutsForDonutsEnv games played at once by a GoNutsBatchGame, with the same observation and action
+       spaces. step plays a move in any subset of the games - by whichever player is to move in each of them"""
+
+    def __init__(self, n_games, verbose = False, manual = False):
+        self.name = 'gonutsfordonuts'
+        self.n_games = n_games
+        self.n_players = 3
+        self.verbose = verbose
+
+        # the same cards as GoNutsForDonutsEnv.reset
+        self.game = GoNutsBatchGame(n_games, self.n_players, GoNutsGame.teal_deck_filter_no_fc())
+        self.translator = GoNutsGameGymTranslator(self.game)
+
+        if (self.game.card_types[self.game.deck_filter] >= self.translator.total_possible_card_types).any():
+            raise Exception(f'The observation only has room for {self.translator.total_possible_card_types} card types')
+
+        self.action_space = gym.spaces.Discrete(self.translator.action_space_size())
+        self.observation_space = gym.spaces.Box(0, 1, (self.translator.observation_space_size(),))
+        self.done = np.zeros(n_games, dtype=bool)
+
+    @property
+    def current_player_num(self):
+        return self.game.current_player
+
+    def compute_legal_actions(self):
+        game = self.game
+        legal_actions = np.zeros((self.n_games, self.action_space.n))
+        types = self.translator.total_possible_card_types
+
+        pick_donut = np.flatnonzero(game.game_state == GoNutsGameState.PICK_DONUT)
+        legal_actions[pick_donut[:, None], actions.ACTION_DONUT + game.card_types[game.donut_decks[pick_donut]]] = 1
+
+        pick_discard = game.game_state == GoNutsGameState.PICK_DISCARD
+        legal_actions[pick_discard, actions.ACTION_DISCARD:actions.ACTION_DISCARD + types] = game.discard_counts[pick_discard, :types] > 0
+
+        pick_from_deck = np.flatnonzero(game.game_state == GoNutsGameState.PICK_ONE_FROM_TWO_DECK_CARDS)
+        top = game.deck_size[pick_from_deck] - 1
+        legal_actions[pick_from_deck, actions.ACTION_DECK + game.card_types[game.deck[pick_from_deck, top]]] = 1
+        second = pick_from_deck[top > 0]
+        legal_actions[second, actions.ACTION_DECK + game.card_types[game.deck[second, top[top > 0] - 1]]] = 1
+
+        give_card = np.flatnonzero(game.game_state == GoNutsGameState.GIVE_CARD)
+        counts = game.counts[give_card, game.current_player[give_card], :types]
+        # Sprinkled can only be given with both Sprinkled cards, or when it's the only card in the position
+        sprinkled = counts[:, cards.TYPE_SPR]
+        give_sprinkled = (sprinkled == 2) | ((sprinkled > 0) & (counts.sum(axis=1) == 1))
+        counts[:, cards.TYPE_SPR] = 0
+        legal_actions[give_card, actions.ACTION_GIVE_CARD:actions.ACTION_GIVE_CARD + types] = counts > 0
+        legal_actions[give_card, actions.ACTION_GIVE_CARD + cards.TYPE_SPR] = give_sprinkled
+
+        return legal_actions
+
+    def compute_observation(self):
+        game = self.game
+        translator = self.translator
+        players, types = translator.total_possible_players, translator.total_possible_card_types
+
+        # each player's position and score, starting from the current player and cycling to higher-numbered players
+        seats = (np.arange(players)[None, :] + game.current_player[:, None]) % players
+        positions = np.zeros((self.n_games, players, types))
+        positions[:, :self.n_players] = game.counts[:, :, :types] > 0
+        positions = np.take_along_axis(positions, seats[:, :, None], axis=1)
+
+        scores = np.zeros((self.n_games, players))
+        scores[:, :self.n_players] = game.scores / 200
+        scores = np.take_along_axis(scores, seats, axis=1)
+
+        discard = game.discard_counts[:, :types] > 0
+
+        top_discard = np.zeros((self.n_games, types))
+        has_discard = np.flatnonzero(game.discard_size > 0)
+        top_discard[has_discard, game.card_types[game.discard[has_discard, game.discard_size[has_discard] - 1]]] = 1
+
+        return np.concatenate([positions.reshape(self.n_games, -1), discard, top_discard, scores, self.legal_actions], axis=1)
+
+    def score_game(self, games):
+        # GoNutsForDonutsEnvUtility.score_game_from_players for each game
+        scores = self.game.scores[games]
+        winners = scores == scores.max(axis=1, keepdims=True)
+        losers = scores == scores.min(axis=1, keepdims=True)
+        return 0.0 + winners / winners.sum(axis=1, keepdims=True) - losers / losers.sum(axis=1, keepdims=True)
+
+    def reset_games(self, games, decks = None):
+        games = np.asarray(games)
+        self.game.reset_games(games, decks)
+        self.done[games] = False
+        self.clear_cache()
+
+    def reset(self):
+        self.reset_games(np.arange(self.n_games))
+        return self.observation
+
+    def step(self, actions, games = None):
+        """Plays actions[k] in games[k] (every game by default), returning the reward of each player and whether
+           the game is over, for each of them"""
+        games = np.arange(self.n_games) if games is None else np.asarray(games)
+        actions = np.asarray(actions)
+
+        reward = np.zeros((len(games), self.n_players))
+        legal = self.legal_actions[games, actions] == 1
+
+        # illegal actions end the game
+        illegal = np.flatnonzero(~legal)
+        if len(illegal):
+            logger.info(f'Illegal actions played in games {games[illegal]}')
+            reward[illegal] = 1.0 / (self.n_players - 1)
+            reward[illegal, self.game.current_player[games[illegal]]] = -1
+
+        self.clear_cache()
+        self.game.step(games[legal], actions[legal])
+
+        # Check end-of-game condition (no donuts less than no of spaces)
+        over = legal & self.game.game_ends[games]
+        reward[over] = self.score_game(games[over])
+
+        done = ~legal | over
+        self.done[games] = done
+        return reward, done
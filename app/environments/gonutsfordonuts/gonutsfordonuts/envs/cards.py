@@ -93,6 +93,8 @@ TYPE_RF = 20
 TYPE_SG = 21
 TYPE_FC = 22
 
+TOTAL_TYPES = 23
+
 card_id_to_type_map = {
     CF_FIRST: TYPE_CF,
     CF_2: TYPE_CF,
@@ -1,4 +1,5 @@
 import random
+import numpy as np
 from stable_baselines import logger
 import gonutsfordonuts.envs.cards as cards
 
@@ -9,6 +10,11 @@ class Player():
         self.hand = Hand()
         self.position = Position()
 
+    def reset(self):
+        self.score = 0
+        self.hand.cards.clear()
+        self.position.reset()
+
 class Card():
     def __init__(self, id, type, name):
         self.id = id
@@ -158,14 +164,50 @@ class StrawberryGlazed(Card):
         self.colour = 'blue'
         self.symbol = 'SG'
        
+class CardCatalogue():
+    """Every card of the deck contents, created once with its id (in the same order as Deck.create)
+       Cards never change in play, so the decks dealt from a catalogue share its cards rather than creating their own
+    """
+    def __init__(self, contents):
+        catalogue = []
+        for x in contents:
+            for i in range(x['count']):
+                catalogue.append(x['card'](id=len(catalogue), **x['info']))
+        self.cards = tuple(catalogue)
+
+    def size(self):
+        return len(self.cards)
+
 class Deck():
-    def __init__(self, players, contents):
+    def __init__(self, players, contents, catalogue=None):
         # The cards to use for this case
         self.contents = contents
         # The full set of standard cards, used to define the spaces
         self.cards = [] # Stack to pull cards from
         self.base_deck = [] # Snapshot of the full standard deck
-        self.create()
+        self.ids = {} # The cards in the stack by id
+        if catalogue is None:
+            self.create()
+        else:
+            self.base_deck = catalogue.cards
+            self.cards = list(catalogue.cards)
+            self.index()
+
+    def index(self):
+        self.ids.clear()
+        for card in self.cards:
+            self.ids[card.id] = card
+
+    def reset(self, card_ids=None):
+        """Puts the cards of the base deck back in the stack, without making a new one: all of them in their
+           conventional order, or just card_ids in the order given (the last is drawn first)
+        """
+        self.cards.clear()
+        if card_ids is None:
+            self.cards.extend(self.base_deck)
+        else:
+            self.cards.extend(map(self.base_deck.__getitem__, card_ids))
+        self.index()
     
     def shuffle(self):
         random.shuffle(self.cards)
@@ -182,14 +224,16 @@ class Deck():
             new_card_order.append(self.cards[i])
 
         # Add any unrequested cards in their conventional order afterwards
+        requested = set(new_order)
         for card in self.cards:
-            if not card.id in new_order:
+            if not card.id in requested:
                 new_card_order.append(card)
 
         # Reverse the deck so that the chosen cards are drawn first
         new_card_order.reverse()
 
         self.cards = new_card_order
+        self.index()
 
     def filter(self, filter):
         """Filters the deck to keep only the card ids in filter, in the order specified.
@@ -203,15 +247,18 @@ class Deck():
         new_deck.reverse()
 
         self.cards = new_deck
+        self.index()
 
     def draw(self, n):
         drawn = []
         for x in range(n):
-            drawn.append(self.cards.pop())
+            drawn.append(self.draw_one())
         return drawn
     
     def draw_one(self):
-        return self.cards.pop()
+        card = self.cards.pop()
+        del self.ids[card.id]
+        return card
 
     def peek_one(self):
         if not len(self.cards):
@@ -224,11 +271,20 @@ class Deck():
         return self.cards[-n]
     
     def remove_one(self, card):
-        self.cards.remove(card)
+        # cards are only taken from the top of the stack, so look from there
+        for i in range(len(self.cards) - 1, -1, -1):
+            if self.cards[i] == card:
+                del self.ids[self.cards.pop(i).id]
+                return
+        raise ValueError(f'Card {card.id} is not in the deck')
+
+    def card_for_id(self, card_id):
+        return self.ids.get(card_id)
 
     def add(self, cards):
         for card in cards:
             self.cards.append(card)
+            self.ids[card.id] = card
 
     def add_to_base_deck(self, cards):
         for card in cards:
@@ -288,25 +344,80 @@ class Hand():
                 return c
         
                 
+def swap_remove(items, slots, card):
+    """Removes card from items in O(1), by moving the last item into its place (so items keep no order)
+       slots holds the index in items of every card id, and is kept up to date
+    """
+    i = slots.pop(card.id)
+    last = items.pop()
+    if i < len(items):
+        items[i] = last
+        slots[last.id] = i
+
 class Discard():
     def __init__(self):
+        # the discard pile, top last. A card taken from the middle leaves a gap (None) rather than
+        # moving every card above it down, and the gaps are dropped once they reach the top
         self.cards = []  
+        # how many cards of each type are in the discard, kept up to date as cards come and go
+        self.counts = np.zeros(cards.TOTAL_TYPES, dtype=np.int32)
+        # the cards by id, and the cards of each type
+        self.ids = {}
+        self.types = [ [] for _ in range(cards.TOTAL_TYPES) ]
+        # where each card is in cards and in the list for its type, by id
+        self.slots = {}
+        self.type_slots = {}
+
+    def reset(self):
+        self.cards.clear()
+        self.counts[:] = 0
+        self.ids.clear()
+        for same_type in self.types:
+            same_type.clear()
+        self.slots.clear()
+        self.type_slots.clear()
     
     def add(self, cards):
         for card in cards:
+            self.slots[card.id] = len(self.cards)
             self.cards.append(card)
+            self.index(card)
+
+    def index(self, card):
+        self.counts[card.type] += 1
+        self.ids[card.id] = card
+        self.type_slots[card.id] = len(self.types[card.type])
+        self.types[card.type].append(card)
+
+    def unindex(self, card):
+        self.counts[card.type] -= 1
+        del self.ids[card.id]
+        swap_remove(self.types[card.type], self.type_slots, card)
+
+    def drop_gaps(self):
+        while len(self.cards) and self.cards[-1] is None:
+            self.cards.pop()
     
     def draw(self, n):
         drawn = []
         for x in range(n):
-            drawn.append(self.cards.pop())
+            drawn.append(self.draw_one())
         return drawn
 
     def draw_one(self):
-        return self.cards.pop()
+        card = self.cards.pop()
+        del self.slots[card.id]
+        self.unindex(card)
+        self.drop_gaps()
+        return card
 
     def remove_one(self, card):
-        self.cards.remove(card)
+        self.cards[self.slots.pop(card.id)] = None
+        self.unindex(card)
+        self.drop_gaps()
+
+    def card_for_id(self, card_id):
+        return self.ids.get(card_id)
 
     def peek_one(self):
         if not len(self.cards):
@@ -314,30 +425,61 @@ class Discard():
         return self.cards[-1]
     
     def size(self):
-        return len(self.cards)
+        return len(self.ids)
     
 class Position():
     def __init__(self):
+        # the cards in no particular order, since only their counts are scored
         self.cards = []  
+        # how many cards of each type are in the position, so scoring doesn't have to count them
+        self.counts = np.zeros(cards.TOTAL_TYPES, dtype=np.int32)
+        # the cards by id, and the cards of each type
+        self.ids = {}
+        self.types = [ [] for _ in range(cards.TOTAL_TYPES) ]
+        # where each card is in cards and in the list for its type, by id
+        self.slots = {}
+        self.type_slots = {}
+
+    def reset(self):
+        self.cards.clear()
+        self.counts[:] = 0
+        self.ids.clear()
+        for same_type in self.types:
+            same_type.clear()
+        self.slots.clear()
+        self.type_slots.clear()
     
     def add(self, cards):
         for card in cards:
-            self.cards.append(card)
+            self.add_one(card)
 
     def add_one(self, card):
+        self.slots[card.id] = len(self.cards)
         self.cards.append(card)
+        self.counts[card.type] += 1
+        self.ids[card.id] = card
+        self.type_slots[card.id] = len(self.types[card.type])
+        self.types[card.type].append(card)
     
     def size(self):
         return len(self.cards)
 
     def pick(self, name):
-        for i, c in enumerate(self.cards):
-            if c.name == name:
-                self.cards.pop(i)
-                return c
+        # every card of a type has the same name, so look through the types rather than the cards
+        for same_type in self.types:
+            if len(same_type) and same_type[0].name == name:
+                card = same_type[0]
+                self.remove_one(card)
+                return card
 
     def remove_one(self, card):
-        self.cards.remove(card)
+        swap_remove(self.cards, self.slots, card)
+        self.counts[card.type] -= 1
+        del self.ids[card.id]
+        swap_remove(self.types[card.type], self.type_slots, card)
+
+    def card_for_id(self, card_id):
+        return self.ids.get(card_id)
 
     def contains_id(self, card_id):
-        return card_id in [c.id for c in self.cards]
+        return card_id in self.ids
\ No newline at end of file
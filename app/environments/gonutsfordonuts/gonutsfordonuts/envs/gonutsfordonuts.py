@@ -7,6 +7,7 @@ import gonutsfordonuts.envs.cards as cards
 import gonutsfordonuts.envs.actions as actions
 
 import config
+from utils.cache import GameStateCache
 
 from stable_baselines import logger
 from collections import Counter, defaultdict
@@ -14,9 +15,31 @@ from collections import Counter, defaultdict
 from .classes import *
 
 class GoNutsScorer:
+    # Points for the number of cards of a type, by count (the scoring functions below, as lookup tables)
+    DONUT_HOLES_POINTS = np.array([0, 1, 3, 6, 10, 15, 0])
+    JELLY_FILLED_POINTS = np.array([0, 0, 5, 5, 10, 10, 0])
+    BOSTON_CREAM_POINTS = np.array([0, 0, 3, 0, 15, 0, 25])
+
+    # Points per card for the types that score the same for every card (plain before the majority bonus)
+    CARD_POINTS = np.zeros(cards.TOTAL_TYPES, dtype=np.int64)
+    CARD_POINTS[[cards.TYPE_GZ, cards.TYPE_FC, cards.TYPE_POW, cards.TYPE_RV, cards.TYPE_SPR, cards.TYPE_P]] = [2, 2, 3, -2, 2, 1]
+
     # Score turn as if it was the end of the game (so carry out EOG effects)
     @staticmethod
     def score_turn(positions):
+
+        # all the players are scored at once from their card counts, the breakdown is only worked out to be logged
+        player_scores = GoNutsScorer.score_counts(np.array([ position.counts for position in positions ]))
+        if logger.get_level() <= config.DEBUG:
+            GoNutsScorer.score_itemised(positions)
+        if logger.get_level() <= config.DEBUG:
+            logger.debug(f'Final score (all players): {player_scores}')
+
+        return player_scores
+
+    @staticmethod
+    def score_itemised(positions):
+        # the same scores as score_counts, added up one scoring rule at a time with each one logged
         
         player_scores = np.zeros(len(positions))
         
@@ -63,10 +86,33 @@ class GoNutsScorer:
         score_plain = GoNutsScorer.score_plain(positions)
         logger.debug(f'Plain (all players): {score_plain}')
         player_scores = np.add(player_scores, score_plain)
-        logger.info(f'Final score (all players): {player_scores}')
 
         return player_scores
 
+    @staticmethod
+    def score_counts(counts):
+        """Scores every player of every game from a (games, players, card types) array of card counts
+           (or (players, card types) for a single game), the same as score_turn"""
+
+        counts = np.asarray(counts)
+        clip = lambda table, card_type: np.take(table, counts[..., card_type], mode='clip')
+
+        player_scores = counts @ GoNutsScorer.CARD_POINTS
+        player_scores += clip(GoNutsScorer.DONUT_HOLES_POINTS, cards.TYPE_DH)
+        player_scores += clip(GoNutsScorer.JELLY_FILLED_POINTS, cards.TYPE_JF)
+        player_scores += clip(GoNutsScorer.BOSTON_CREAM_POINTS, cards.TYPE_BC)
+
+        # maple bars only score with more than 6 types of card in the position
+        player_scores += np.where(np.count_nonzero(counts, axis=-1) > 6, counts[..., cards.TYPE_MB] * 3, 0)
+
+        # plain majority: 3 for the only player with the most, or 1 each for a tie
+        plain = counts[..., cards.TYPE_P]
+        max_plain = plain.max(axis=-1, keepdims=True)
+        is_max = (plain == max_plain) & (max_plain > 0)
+        player_scores += np.where(is_max.sum(axis=-1, keepdims=True) == 1, 3, 1) * is_max
+
+        return player_scores.astype(np.float64)
+
     @staticmethod
     def score_plain(positions):
         
@@ -74,8 +120,7 @@ class GoNutsScorer:
         total_plain = []
         
         for p, position in enumerate(positions):
-            card_counter = Counter([ c.name for c in position.cards ])
-            dn_count = card_counter["plain"]
+            dn_count = position.counts[cards.TYPE_P]
             player_scores[p] = 1 * dn_count
             total_plain.append((p, dn_count))
         
@@ -93,8 +138,7 @@ class GoNutsScorer:
 
     @staticmethod
     def score_donut_holes(position):
-        card_counter = Counter([ c.type for c in position.cards ])
-        dh_count = card_counter[cards.TYPE_DH]
+        dh_count = position.counts[cards.TYPE_DH]
         if dh_count == 1:
             return 1
         if dh_count == 2:
@@ -110,8 +154,7 @@ class GoNutsScorer:
 
     @staticmethod
     def score_jelly_filled(position):
-        card_counter = Counter([ c.type for c in position.cards ])
-        dn_count = card_counter[cards.TYPE_JF]
+        dn_count = position.counts[cards.TYPE_JF]
         if dn_count == 2 or dn_count == 3:
             return 5
         if dn_count == 4 or dn_count == 5:
@@ -121,38 +164,32 @@ class GoNutsScorer:
 
     @staticmethod
     def score_glazed(position):
-        card_counter = Counter([ c.type for c in position.cards ])
-        dn_count = card_counter[cards.TYPE_GZ]
+        dn_count = position.counts[cards.TYPE_GZ]
         return dn_count * 2
 
     @staticmethod
     def score_french_cruller(position):
-        card_counter = Counter([ c.type for c in position.cards ])
-        dn_count = card_counter[cards.TYPE_FC]
+        dn_count = position.counts[cards.TYPE_FC]
         return dn_count * 2
 
     @staticmethod
     def score_powdered(position):
-        card_counter = Counter([ c.type for c in position.cards ])
-        dn_count = card_counter[cards.TYPE_POW]
+        dn_count = position.counts[cards.TYPE_POW]
         return dn_count * 3
 
     @staticmethod
     def score_red_velvet(position):
-        card_counter = Counter([ c.type for c in position.cards ])
-        dn_count = card_counter[cards.TYPE_RV]
+        dn_count = position.counts[cards.TYPE_RV]
         return dn_count * -2
 
     @staticmethod
     def score_sprinkled(position):
-        card_counter = Counter([ c.type for c in position.cards ])
-        dn_count = card_counter[cards.TYPE_SPR]
+        dn_count = position.counts[cards.TYPE_SPR]
         return dn_count * 2
 
     @staticmethod
     def score_boston_cream(position):
-        card_counter = Counter([ c.type for c in position.cards ])
-        dn_count = card_counter[cards.TYPE_BC]
+        dn_count = position.counts[cards.TYPE_BC]
         if not dn_count:
             return 0
         bc_scores = [0, 3, 0, 15, 0, 25]
@@ -160,10 +197,9 @@ class GoNutsScorer:
 
     @staticmethod
     def score_maple_bar(position):
-        card_counter = Counter([ c.type for c in position.cards ])
-        types_of_cards = len(card_counter)
+        types_of_cards = np.count_nonzero(position.counts)
         if types_of_cards > 6:
-            return card_counter[cards.TYPE_MB] * 3
+            return position.counts[cards.TYPE_MB] * 3
         return 0
 
 
@@ -205,8 +241,7 @@ class GoNutsGameGymTranslator:
             for i in range(self.game.no_donut_decks):
                 legal_actions[self.game.donut_decks[i].card.type] = 1
         elif self.game.game_state == GoNutsGameState.PICK_DISCARD:
-            for card in self.game.discard.cards:
-                legal_actions[card.type] = 1
+            legal_actions[np.flatnonzero(self.game.discard.counts)] = 1
         elif self.game.game_state == GoNutsGameState.PICK_ONE_FROM_TWO_DECK_CARDS:
             if self.game.deck.size():
                 legal_actions[self.game.deck.peek_one().type] = 1
@@ -214,20 +249,21 @@ class GoNutsGameGymTranslator:
                 legal_actions[self.game.deck.peek_in_nth_position(2).type] = 1
         elif self.game.game_state == GoNutsGameState.GIVE_CARD:
             
+            position = self.game.players[current_player_num].position
+
             # Sprinkled requires giving a Sprinkled card to only be an option if the player has a sprinkled card already
-            if self.game.players[current_player_num].position.contains_id(cards.SPR_FIRST) and self.game.players[current_player_num].position.contains_id(cards.SPR_2):
+            if position.contains_id(cards.SPR_FIRST) and position.contains_id(cards.SPR_2):
                 legal_actions[actions.ACTION_GIVE_CARD + cards.TYPE_SPR] = 1
 
             # OR it's the only card in the position
-            if self.game.players[current_player_num].position.contains_id(cards.SPR_FIRST) and self.game.players[current_player_num].position.size() == 1:
+            if position.contains_id(cards.SPR_FIRST) and position.size() == 1:
                 legal_actions[actions.ACTION_GIVE_CARD + cards.TYPE_SPR] = 1
-            if self.game.players[current_player_num].position.contains_id(cards.SPR_2) and self.game.players[current_player_num].position.size() == 1:
+            if position.contains_id(cards.SPR_2) and position.size() == 1:
                 legal_actions[actions.ACTION_GIVE_CARD + cards.TYPE_SPR] = 1
 
             # Otherwise it's all cards in the position, excluding Sprinkles cards
-            for card in self.game.players[current_player_num].position.cards:
-                if not card.id == cards.SPR_FIRST and not card.id == cards.SPR_2:
-                    legal_actions[actions.ACTION_GIVE_CARD + card.type] = 1
+            card_types = np.flatnonzero(position.counts)
+            legal_actions[actions.ACTION_GIVE_CARD + card_types[card_types != cards.TYPE_SPR]] = 1
 
         else:
             logger.info(f'get_legal_actions called in inappropriate game state {self.game.game_state}')
@@ -235,7 +271,7 @@ class GoNutsGameGymTranslator:
         
         return legal_actions
 
-    def get_observations(self, current_player_num):
+    def get_observations(self, current_player_num, legal_actions = None):
 
         # To make this a generalisable model
         # Always assume we are playing with 5 players and just 0 out their observations
@@ -257,8 +293,7 @@ class GoNutsGameGymTranslator:
         for i in range(n_players):
             player = self.game.players[i]
 
-            for card in player.position.cards:
-               positions[i][card.type] = 1
+            positions[i][np.flatnonzero(player.position.counts)] = 1
 
         positions_flat = positions.flatten()
         # roll forward (+wrap) to put this player's numbers at the start
@@ -271,8 +306,7 @@ class GoNutsGameGymTranslator:
         # Again by type
         discard = np.zeros(self.total_possible_card_types)
 
-        for card in self.game.discard.cards:
-            discard[card.type] = 1
+        discard[np.flatnonzero(self.game.discard.counts)] = 1
         
         ret = np.append(ret, discard)
 
@@ -302,7 +336,9 @@ class GoNutsGameGymTranslator:
         # 26 obvs (94 so far)
 
         # Legal actions, representing the donut choices or other actions
-        ret = np.append(ret, self.get_legal_actions(current_player_num))
+        if legal_actions is None:
+            legal_actions = self.get_legal_actions(current_player_num)
+        ret = np.append(ret, legal_actions)
 
         return ret
 
@@ -315,8 +351,12 @@ class GoNutsGameState:
 
 class GoNutsGame:
 
+    # the cards of the standard deck, created the first time a game is set up and shared by every game after that
+    catalogue = None
+
     def __init__(self, n_players):
         self.n_players = n_players
+        self.deck = None
 
     def setup_game(self, shuffle=True, deck_order=None, deck_filter=None):
         self.no_donut_decks = self.n_players + 1
@@ -331,17 +371,37 @@ class GoNutsGame:
         self.reset_game(shuffle=shuffle, deck_order=deck_order, deck_filter=deck_filter)
 
     def reset_game(self, shuffle=True, deck_order=None, deck_filter=None):
-        self.deck = Deck(self.n_players, GoNutsGame.standard_deck_contents())
-        
+        # the deck, discard and players are made for the first game and emptied in place for every game after that,
+        # so resetting only permutes the ids of the cards to deal and refills the deck with the catalogue's cards
+        if self.deck is None:
+            self.deck = Deck(self.n_players, self.contents, GoNutsGame.card_catalogue())
+            self.discard = Discard()
+            self.players = [ Player(p) for p in range(self.n_players) ]
+            self.deck_ids = []
+        else:
+            self.discard.reset()
+            for p in self.players:
+                p.reset()
+
         if deck_order:
+            # a chosen order (used in testing) is put together from the full deck
+            self.deck.reset()
             self.deck.reorder(deck_order)
-        if deck_filter:
-            self.deck.filter(deck_filter)
-        if shuffle:
-            self.deck.shuffle()
-         
-        self.discard = Discard()
-        self.players = []
+            if deck_filter:
+                self.deck.filter(deck_filter)
+            if shuffle:
+                self.deck.shuffle()
+        else:
+            if deck_filter:
+                # reversed so that the first card of the filter is drawn first (as Deck.filter does)
+                self.deck_ids[:] = deck_filter
+                self.deck_ids.reverse()
+            else:
+                self.deck_ids[:] = range(len(self.deck.base_deck))
+            if shuffle:
+                random.shuffle(self.deck_ids)
+            self.deck.reset(self.deck_ids)
+
         self.turns_taken = 0
         self.game_ends = False
         self.donut_picks_action_bank = []
@@ -349,16 +409,21 @@ class GoNutsGame:
 
         self.game_state = GoNutsGameState.PICK_DONUT
 
-        player_id = 0
-        for p in range(self.n_players):
-            self.players.append(Player(player_id))
-            player_id += 1
-
     def start_game(self):
         # Setup donut decks for the first time
         self.donut_decks = []
         for i in range (0, self.no_donut_decks):
             self.donut_decks.append(DonutDeckPosition(self.deck.draw_one()))
+        self.index_donut_decks()
+
+    def index_donut_decks(self):
+        # the donut decks by the id of their card, and the ids of the cards of each type in deck order,
+        # built whenever the decks are refilled so the picks in the turn don't search them
+        self.donut_deck_for_id = {}
+        self.donut_ids_for_type = defaultdict(list)
+        for deck in self.donut_decks:
+            self.donut_deck_for_id[deck.card.id] = deck
+            self.donut_ids_for_type[deck.card.type].append(deck.card.id)
 
     @classmethod
     def teal_deck_filter(self):
@@ -405,6 +470,12 @@ class GoNutsGame:
         cards.RV_FIRST, cards.RV_2, cards.DC_FIRST, cards.DC_2, cards.SPR_FIRST, cards.SPR_2 ]
 
 
+    @classmethod
+    def card_catalogue(self):
+        if GoNutsGame.catalogue is None:
+            GoNutsGame.catalogue = CardCatalogue(GoNutsGame.standard_deck_contents())
+        return GoNutsGame.catalogue
+
     @classmethod
     def standard_deck_contents(self):
 
@@ -452,33 +523,33 @@ class GoNutsGame:
         return standard_deck_contents
     
     def position_card_for_card_id(self, player_no, card_id):
-        for card in self.players[player_no].position.cards:
-            if card.id == card_id:
-                return card
+        card = self.players[player_no].position.card_for_id(card_id)
+        if card:
+            return card
 
         logger.info(f'Cannot find card_id {card_id} in position of player {player_no}')
         raise Exception(f'Cannot find card_id {card_id} in position of player {player_no}')
 
     def deck_for_card_id(self, card_id):
-        for deck in self.donut_decks:
-            if deck.card.id == card_id:
-                return deck
+        deck = self.donut_deck_for_id.get(card_id)
+        if deck:
+            return deck
 
         logger.info(f'Cannot find deck for card_id {card_id}')
         raise Exception(f'Cannot find deck for card_id {card_id}')
 
     def discard_card_for_card_id(self, card_id):
-        for card in self.discard.cards:
-            if card.id == card_id:
-                return card
+        card = self.discard.card_for_id(card_id)
+        if card:
+            return card
 
         logger.info(f'Cannot find card_id {card_id} in discard')
         raise Exception(f'Cannot find card_id {card_id} in discard')
 
     def deck_card_for_card_id(self, card_id):
-        for card in self.deck.cards:
-            if card.id == card_id:
-                return card
+        card = self.deck.card_for_id(card_id)
+        if card:
+            return card
 
         logger.info(f'Cannot find card_id {card_id} in deck')
         raise Exception(f'Cannot find card_id {card_id} in deck')
@@ -494,20 +565,22 @@ class GoNutsGame:
             logger.info('pick_cards() called with wrong number of card_ids')
             raise Exception('pick_cards() called with wrong number of card_ids')
 
+        card_ids_counter = Counter(cards_ids_picked)
+
         for i, card_id in enumerate(cards_ids_picked):
-        
-            card_ids_counter = Counter(cards_ids_picked)
 
             player = self.players[i]
             deck = self.deck_for_card_id(card_id)
 
             if card_ids_counter[card_id] > 1:
                 deck.set_to_discard()
-                logger.info(f'Discarding {deck.card.symbol}')
+                if logger.get_level() <= config.DEBUG:
+                    logger.debug(f'Discarding {deck.card.symbol}')
                 cards_picked.append(None)
             else:
                 player.position.add_one(deck.card)
-                logger.info(f'Player {player.id} picks {deck.card.symbol} ({deck.card.type}:{deck.card.id})')
+                if logger.get_level() <= config.DEBUG:
+                    logger.debug(f'Player {player.id} picks {deck.card.symbol} ({deck.card.type}:{deck.card.id})')
 
                 cards_picked.append(deck.card)
                 deck.set_taken()
@@ -524,21 +597,26 @@ class GoNutsGame:
             elif card.type == cards.TYPE_ECL:
                 self.card_action_eclair(player_no)
             else:
-                logger.info(f"No instant effect for card {card.symbol} for player {player_no}")
+                if logger.get_level() <= config.DEBUG:
+                    logger.debug(f"No instant effect for card {card.symbol} for player {player_no}")
 
 
     def card_action_chocolate_frosted(self, player_no):
         # Draw the top card from the draw deck
-        logger.info(f"Card action Chocolate Frosted (draw one from deck) for player {player_no}")
+        if logger.get_level() <= config.DEBUG:
+            logger.debug(f"Card action Chocolate Frosted (draw one from deck) for player {player_no}")
         if self.deck.size() > 0:
-            logger.debug(f"Adding {self.deck.peek_one().symbol} to position of {player_no}")
+            if logger.get_level() <= config.DEBUG:
+                logger.debug(f"Adding {self.deck.peek_one().symbol} to position of {player_no}")
             self.players[player_no].position.add_one(self.deck.draw_one())
 
     def card_action_eclair(self, player_no):
-        logger.info(f"Card action Eclair (draw top from discard) for player {player_no}")
+        if logger.get_level() <= config.DEBUG:
+            logger.debug(f"Card action Eclair (draw top from discard) for player {player_no}")
 
         if self.discard.size() > 0:
-            logger.debug(f"Adding {self.discard.peek_one().symbol} to position of {player_no}")
+            if logger.get_level() <= config.DEBUG:
+                logger.debug(f"Adding {self.discard.peek_one().symbol} to position of {player_no}")
             self.players[player_no].position.add_one(self.discard.draw_one())
 
     def reset_turn(self):
@@ -547,7 +625,8 @@ class GoNutsGame:
 
         self.turns_taken += 1
 
-        logger.info(f'\nSetting up turn {self.turns_taken}...')
+        if logger.get_level() <= config.DEBUG:
+            logger.debug(f'\nSetting up turn {self.turns_taken}...')
         
         # Check end of game
         decks_to_discard = sum(1 for d in self.donut_decks if d.to_discard)
@@ -562,17 +641,22 @@ class GoNutsGame:
                 if self.donut_decks[i].taken:
                     # Already added to player's position
                     self.donut_decks[i] = DonutDeckPosition(self.deck.draw_one())
-                    logger.info(f'Filling deck position {i} with card {self.donut_decks[i].card.symbol}')
+                    if logger.get_level() <= config.DEBUG:
+                        logger.debug(f'Filling deck position {i} with card {self.donut_decks[i].card.symbol}')
 
                 elif self.donut_decks[i].to_discard:
                     discarded_card = self.donut_decks[i].card
                     self.discard.add([discarded_card])
                     self.donut_decks[i] = DonutDeckPosition(self.deck.draw_one())
-                    logger.info(f'Discarding {discarded_card.symbol} from deck position {i} and filling with card {self.donut_decks[i].card.symbol}')
+                    if logger.get_level() <= config.DEBUG:
+                        logger.debug(f'Discarding {discarded_card.symbol} from deck position {i} and filling with card {self.donut_decks[i].card.symbol}')
 
                 # Otherwise the card stays in position
                 else:
-                    logger.info(f'Deck position {i} stays unchanged with card {self.donut_decks[i].card.symbol}')
+                    if logger.get_level() <= config.DEBUG:
+                        logger.debug(f'Deck position {i} stays unchanged with card {self.donut_decks[i].card.symbol}')
+
+            self.index_donut_decks()
                     
     def is_game_over(self):
         return self.game_ends
@@ -589,30 +673,35 @@ class GoNutsGame:
 
     def do_pick_cards_action(self, player_card_picks):
 
-        logger.info(f'\nThe chosen cards are now competitively picked')
+        logger.debug('\nThe chosen cards are now competitively picked')
         self.record_player_actions(player_card_picks)
         self.cards_picked = self.pick_cards(player_card_picks)
 
     def do_pick_discard_action(self, player_no, player_discard_pick):
-        logger.info(f"Card action pick discard [Red Velvet] (draw card from discard) for player {player_no}")
+        if logger.get_level() <= config.DEBUG:
+            logger.debug(f"Card action pick discard [Red Velvet] (draw card from discard) for player {player_no}")
 
         discard_card_to_pick = self.discard_card_for_card_id(player_discard_pick)
 
-        logger.debug(f"Adding {discard_card_to_pick.symbol} to position of {player_no}")
+        if logger.get_level() <= config.DEBUG:
+            logger.debug(f"Adding {discard_card_to_pick.symbol} to position of {player_no}")
         self.players[player_no].position.add_one(discard_card_to_pick)
         self.discard.remove_one(discard_card_to_pick)
 
     def do_pick_one_from_two_deck_action(self, player_no, player_deck_pick):
-        logger.info(f"Card action pick from deck [Double Chocolate] (draw one of two cards from deck) for player {player_no}")
+        if logger.get_level() <= config.DEBUG:
+            logger.debug(f"Card action pick from deck [Double Chocolate] (draw one of two cards from deck) for player {player_no}")
 
         deck_card_to_pick = self.deck_card_for_card_id(player_deck_pick)
 
-        logger.debug(f"Adding {deck_card_to_pick.symbol} to position of {player_no}")
+        if logger.get_level() <= config.DEBUG:
+            logger.debug(f"Adding {deck_card_to_pick.symbol} to position of {player_no}")
         self.players[player_no].position.add_one(deck_card_to_pick)
         self.deck.remove_one(deck_card_to_pick)
 
     def do_give_card_action(self, player_no, player_card_to_give):
-        logger.info(f"Card action give card [Sprinkled] (give one card from position) for player {player_no}")
+        if logger.get_level() <= config.DEBUG:
+            logger.debug(f"Card action give card [Sprinkled] (give one card from position) for player {player_no}")
 
         give_card = self.position_card_for_card_id(player_no, player_card_to_give)
 
@@ -624,7 +713,8 @@ class GoNutsGame:
                 target_player_no = p.id
                 break
         
-        logger.debug(f"Giving card {give_card.symbol} to position of player {target_player_no}")
+        if logger.get_level() <= config.DEBUG:
+            logger.debug(f"Giving card {give_card.symbol} to position of player {target_player_no}")
         self.players[target_player_no].position.add_one(give_card)
         self.players[player_no].position.remove_one(give_card)
 
@@ -670,30 +760,35 @@ class GoNutsGame:
             self.game_state = GoNutsGameState.PICK_DONUT
             self.donut_player = 0
             self.action_player = 0
-            logger.info("Resetting turn after all player actions")
+            logger.debug("Resetting turn after all player actions")
             self.do_end_turn_after_all_player_actions()
             return self.donut_player
         
         # Examine donut pick for this player and set state
         card = self.cards_picked[self.action_player]
         if card:
-            logger.debug(f"Checking special cards for player {self.action_player}, card is {card.name}")
+            if logger.get_level() <= config.DEBUG:
+                logger.debug(f"Checking special cards for player {self.action_player}, card is {card.name}")
             if card.type == cards.TYPE_RV:
                 # skip the state if there are no discard cards
                 if self.discard.size() > 0:
-                    logger.debug(f"Red velvet change state, sufficient discard ({self.discard.size()}) cards left for action")
+                    if logger.get_level() <= config.DEBUG:
+                        logger.debug(f"Red velvet change state, sufficient discard ({self.discard.size()}) cards left for action")
                     new_state = GoNutsGameState.PICK_DISCARD
                 else:
-                    logger.debug(f"Red velvet change state, insufficient discard ({self.discard.size()}) cards left for action")
+                    if logger.get_level() <= config.DEBUG:
+                        logger.debug(f"Red velvet change state, insufficient discard ({self.discard.size()}) cards left for action")
             if card.type == cards.TYPE_DC:
                 # skip the state if there are no deck cards left
                 if self.deck.size() > 0:
-                    logger.debug(f"Double chocolate change state, sufficient ({self.deck.size()}) cards left for action")
+                    if logger.get_level() <= config.DEBUG:
+                        logger.debug(f"Double chocolate change state, sufficient ({self.deck.size()}) cards left for action")
                     new_state = GoNutsGameState.PICK_ONE_FROM_TWO_DECK_CARDS
                 else:
-                    logger.debug(f"Double chocolate change state, insufficient ({self.deck.size()}) cards left for action")
+                    if logger.get_level() <= config.DEBUG:
+                        logger.debug(f"Double chocolate change state, insufficient ({self.deck.size()}) cards left for action")
             if card.type == cards.TYPE_SPR:
-                logger.debug(f"Sprinkled, always change state")
+                logger.debug("Sprinkled, always change state")
                 new_state = GoNutsGameState.GIVE_CARD
   
         self.game_state = new_state
@@ -709,7 +804,8 @@ class GoNutsGame:
         # CHECK ACTION STATES
 
         # Do instant actions - does not require step, action state
-        logger.debug(f'Game state: {repr(self.game_state)}')
+        if logger.get_level() <= config.DEBUG:
+            logger.debug(f'Game state: {repr(self.game_state)}')
         if self.game_state == GoNutsGameState.INSTANT_ACTION:
             self.do_immediate_card_special_effects(self.action_player, self.cards_picked[self.action_player])
             self.move_to_next_action_player()
@@ -769,22 +865,23 @@ class GoNutsGame:
         if game_state == GoNutsGameState.PICK_DONUT:
             step_action_norm = step_action - actions.ACTION_DONUT
             # action is a card type, so pick a random donut of that type from the available positions
-            matching_donut_positions = [ p.card.id for p in self.donut_decks if p.card.type == step_action_norm ]
+            matching_donut_positions = self.donut_ids_for_type.get(step_action_norm)
             if not matching_donut_positions:
                 logger.error(f"Can't find donut of type {step_action_norm} in positions")
                 raise RuntimeError(f"Can't find donut of type {step_action_norm} in positions")
             card_id_to_choose = random.choice(matching_donut_positions)
             if len(matching_donut_positions) > 1:
-                logger.info(f"More than 1 card of type {step_action_norm}, random choice of card id {card_id_to_choose}")
+                if logger.get_level() <= config.DEBUG:
+                    logger.debug(f"More than 1 card of type {step_action_norm}, random choice of card id {card_id_to_choose}")
             return card_id_to_choose
         elif game_state == GoNutsGameState.PICK_DISCARD:
             step_action_norm = step_action - actions.ACTION_DISCARD
             # action is a card type, so pick a random donut of that type from the available discard
-            matching_discards = [ c.id for c in self.discard.cards if c.type == step_action_norm ]
+            matching_discards = self.discard.types[step_action_norm]
             if not matching_discards:
                 logger.error(f"Can't find donut of type {step_action_norm} in discards")
                 raise RuntimeError(f"Can't find donut of type {step_action_norm} in discards")
-            return random.choice(matching_discards)
+            return random.choice(matching_discards).id
         elif game_state == GoNutsGameState.PICK_ONE_FROM_TWO_DECK_CARDS:
             step_action_norm = step_action - actions.ACTION_DECK
             if self.deck.peek_one().type == step_action_norm:
@@ -796,11 +893,11 @@ class GoNutsGame:
                 raise RuntimeError(f"Can't find donut of type {step_action_norm} in 2-from-deck-pick")
         elif game_state == GoNutsGameState.GIVE_CARD:
             step_action_norm =  step_action - actions.ACTION_GIVE_CARD
-            matching_hand_cards = [ c.id for c in self.players[current_player_no].position.cards if c.type == step_action_norm ]
+            matching_hand_cards = self.players[current_player_no].position.types[step_action_norm]
             if not matching_hand_cards:
                 logger.error(f"Can't find donut of type {step_action_norm} in position of player {current_player_no}")
                 raise RuntimeError(f"Can't find donut of type {step_action_norm} in position of player {current_player_no}")
-            return random.choice(matching_hand_cards)
+            return random.choice(matching_hand_cards).id
         else:
             logger.error(f"Can't translate action {step_action} from game state {game_state}")
             raise RuntimeError(f"Unknown game state {game_state}")
@@ -832,7 +929,7 @@ class GoNutsForDonutsEnvUtility:
 
         return reward
 
-class GoNutsForDonutsEnv(gym.Env):
+class GoNutsForDonutsEnv(GameStateCache, gym.Env):
     metadata = {'render.modes': ['human']}
 
     def __init__(self, verbose = False, manual = False):
@@ -854,12 +951,10 @@ class GoNutsForDonutsEnv(gym.Env):
         self.observation_space = gym.spaces.Box(0, 1, (self.translator.observation_space_size(),))
         self.verbose = verbose
   
-    @property
-    def observation(self):
-        return self.translator.get_observations(self.current_player_num)
+    def compute_observation(self):
+        return self.translator.get_observations(self.current_player_num, self.legal_actions)
 
-    @property
-    def legal_actions(self):
+    def compute_legal_actions(self):
         return self.translator.get_legal_actions(self.current_player_num)
 
     def score_game(self):
@@ -885,7 +980,8 @@ class GoNutsForDonutsEnv(gym.Env):
         # do actions; vote for a card; pick cards if all players have voted
         else:
             next_player = self.game.execute_game_loop(action)
-            logger.debug(f"Moving to player id: {next_player}")
+            if logger.get_level() <= config.DEBUG:
+                logger.debug(f"Moving to player id: {next_player}")
             self.current_player_num = next_player
             
             # Check end-of-game condition (no donuts less than no of spaces)
@@ -897,6 +993,7 @@ class GoNutsForDonutsEnv(gym.Env):
 
         self.done = done
 
+        self.clear_cache()
         return self.observation, reward, done, {}
 
     def reset(self):
@@ -908,7 +1005,8 @@ class GoNutsForDonutsEnv(gym.Env):
 
         self.current_player_num = 0
         self.done = False
-        logger.info(f'\n\n---- NEW GAME ----')
+        logger.debug('\n\n---- NEW GAME ----')
+        self.clear_cache()
         return self.observation
 
     def render(self, mode='human', close=False):
@@ -916,31 +1014,31 @@ class GoNutsForDonutsEnv(gym.Env):
         if close:
             return
 
-        print(f'\n\n-------TURN {self.game.turns_taken + 1}-----------')
-        print(f"It is Player {self.current_player.id}'s turn to choose in state {self.game.game_state}")            
+        logger.debug(f'\n\n-------TURN {self.game.turns_taken + 1}-----------')
+        logger.debug(f"It is Player {self.current_player.id}'s turn to choose in state {self.game.game_state}")            
 
         # Render player positions
 
         for p in self.game.players:
-            print(f'Player {p.id}\'s position')
+            logger.debug(f'Player {p.id}\'s position')
             if p.position.size() > 0:
-                print('  '.join([card.symbol + ': ' + str(card.id) for card in sorted(p.position.cards, key=lambda x: x.id)]))
+                logger.debug('  '.join([card.symbol + ': ' + str(card.id) for card in sorted(p.position.cards, key=lambda x: x.id)]))
             else:
-                print('Empty')
+                logger.debug('Empty')
 
         # Render donuts to choose
         for i, d in enumerate(self.game.donut_decks):
             this_card = d.get_card()
-            print(f'Deck {i}: {this_card.symbol} ({this_card.type}:{this_card.id})')
+            logger.debug(f'Deck {i}: {this_card.symbol} ({this_card.type}:{this_card.id})')
 
         # Top of discard
         if self.game.discard.size():
-            print(f'Discard: {self.game.discard.size()} cards, top {self.game.discard.peek_one().symbol}')
+            logger.debug(f'Discard: {self.game.discard.size()} cards, top {self.game.discard.peek_one().symbol}')
 
-        print(f'\n{self.game.deck.size()} cards left in deck')
+        logger.debug(f'\n{self.game.deck.size()} cards left in deck')
 
         if self.verbose:
-            print(f'\nObservation: \n{[i if o == 1 else (i,o) for i,o in enumerate(self.observation) if o != 0]}')
+            logger.debug(f'\nObservation: \n{[i if o == 1 else (i,o) for i,o in enumerate(self.observation) if o != 0]}')
         
         if not self.done:
             legal_action_str = "Legal actions: "
@@ -956,14 +1054,14 @@ class GoNutsForDonutsEnv(gym.Env):
                     if card_for_action:
                         legal_action_str += f"{i}:{card_for_action.symbol} "
                     else:
-                        print(f"Can't find card for action {i}")
-            print(legal_action_str)
+                        logger.warn(f"Can't find card for action {i}")
+            logger.debug(legal_action_str)
 
         if self.done:
-            print(f'\n\nGAME OVER')
+            logger.debug(f'\n\nGAME OVER')
             
         for p in self.game.players:
-            print(f'Player {p.id} points: {p.score}')
+            logger.debug(f'Player {p.id} points: {p.score}')
 
 
     def rules_move(self):
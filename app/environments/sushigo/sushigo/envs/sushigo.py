@@ -3,12 +3,13 @@ import gym
 import numpy as np
 
 import config
+from utils.cache import GameStateCache
 
 from stable_baselines import logger
 
 from .classes import *
 
-class SushiGoEnv(gym.Env):
+class SushiGoEnv(GameStateCache, gym.Env):
     metadata = {'render.modes': ['human']}
 
     def __init__(self, verbose = False, manual = False):
@@ -47,8 +48,7 @@ class SushiGoEnv(gym.Env):
         self.verbose = verbose
 
         
-    @property
-    def observation(self):
+    def compute_observation(self):
         obs = np.zeros(([self.total_positions, self.total_cards]))
         player_num = self.current_player_num
         hands_seen = 0
@@ -81,8 +81,7 @@ class SushiGoEnv(gym.Env):
 
         return ret
 
-    @property
-    def legal_actions(self):
+    def compute_legal_actions(self):
         legal_actions = np.zeros(self.action_space.n)
         hand = self.current_player.hand.cards
 
@@ -220,7 +219,8 @@ class SushiGoEnv(gym.Env):
 
 
     def pickup_chopsticks(self, player):
-        logger.debug(f'Player {player.id} picking up chopsticks')
+        if logger.get_level() <= config.DEBUG:
+            logger.debug(f'Player {player.id} picking up chopsticks')
         chopsticks = player.position.pick('chopsticks')
         player.hand.add([chopsticks])
 
@@ -232,7 +232,8 @@ class SushiGoEnv(gym.Env):
             logger.debug(f"Player {player.id} trying to play {card_num} but doesn't exist!")
             raise Exception('Card not found')
 
-        logger.debug(f"Player {player.id} playing {str(card.order) + ': ' + card.symbol + ': ' + str(card.id)}")
+        if logger.get_level() <= config.DEBUG:
+            logger.debug(f"Player {player.id} playing {str(card.order) + ': ' + card.symbol + ': ' + str(card.id)}")
         if card.type == 'nigiri':
             for c in player.position.cards:
                 if c.type == 'wasabi' and c.played_upon == False:
@@ -298,11 +299,14 @@ class SushiGoEnv(gym.Env):
                     reward = self.score_game()
                     done = True
                 else:
+                    # the end of the round is rendered before the next one is dealt
+                    self.clear_cache()
                     self.render()
                     self.reset_round()
 
         self.done = done
 
+        self.clear_cache()
         return self.observation, reward, done, {}
 
     def reset_round(self):
@@ -334,6 +338,7 @@ class SushiGoEnv(gym.Env):
         self.done = False
         self.reset_round()
         logger.debug(f'\n\n---- NEW GAME ----')
+        self.clear_cache()
         return self.observation
 
 
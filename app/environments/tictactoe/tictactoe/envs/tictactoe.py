@@ -4,6 +4,7 @@ import gym
 import numpy as np
 
 import config
+from utils.cache import GameStateCache
 
 from stable_baselines import logger
 
@@ -22,7 +23,7 @@ class Token():
 
     
 
-class TicTacToeEnv(gym.Env):
+class TicTacToeEnv(GameStateCache, gym.Env):
     metadata = {'render.modes': ['human']}
 
     def __init__(self, verbose = False, manual = False):
@@ -39,8 +40,7 @@ class TicTacToeEnv(gym.Env):
         self.verbose = verbose
         
 
-    @property
-    def observation(self):
+    def compute_observation(self):
         if self.players[self.current_player_num].token.number == 1:
             position = np.array([x.number for x in self.board]).reshape(self.grid_shape)
         else:
@@ -50,8 +50,7 @@ class TicTacToeEnv(gym.Env):
         out = np.stack([position,la_grid], axis = -1)
         return out
 
-    @property
-    def legal_actions(self):
+    def compute_legal_actions(self):
         legal_actions = []
         for action_num in range(len(self.board)):
             if self.board[action_num].number==0: #empty square
@@ -119,6 +118,7 @@ class TicTacToeEnv(gym.Env):
         if not done:
             self.current_player_num = (self.current_player_num + 1) % 2
 
+        self.clear_cache()
         return self.observation, reward, done, {}
 
     def reset(self):
@@ -128,6 +128,7 @@ class TicTacToeEnv(gym.Env):
         self.turns_taken = 0
         self.done = False
         logger.debug(f'\n\n---- NEW GAME ----')
+        self.clear_cache()
         return self.observation
 
 
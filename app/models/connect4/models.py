@@ -8,6 +8,8 @@ from tensorflow.keras.layers import BatchNormalization, Activation, Flatten, Con
 from stable_baselines.common.policies import ActorCriticPolicy
 from stable_baselines.common.distributions import CategoricalProbabilityDistributionType, CategoricalProbabilityDistribution
 
+from utils import numpy_layers as nl
+
 
 class CustomPolicy(ActorCriticPolicy):
     def __init__(self, sess, ob_space, ac_space, n_env, n_steps, n_batch, reuse=False, **kwargs):
@@ -39,6 +41,11 @@ class CustomPolicy(ActorCriticPolicy):
     def value(self, obs, state=None, mask=None):
         return self.sess.run(self.value_flat, {self.obs_ph: obs})
 
+    def proba_value(self, obs, value=True):
+        if not value:
+            return self.proba_step(obs), None
+        return tuple(self.sess.run([self.policy_proba, self.value_flat], {self.obs_ph: obs}))
+
 
 
 def value_head(y):
@@ -108,3 +115,27 @@ def dense(y, filters, batch_norm = True, activation = 'relu', name = None):
     return y
 
 
+def numpy_forward(weights, obs, value = True):
+    # NumPy mirror of CustomPolicy, for utils.inference.NumpyPolicy
+    # weights must be consumed in the order that the layers are created above
+    y = nl.convolutional(weights, obs)
+    for _ in range(3):
+        y = numpy_residual(weights, y)
+
+    policy = nl.flatten(nl.convolutional(weights, y))
+    policy = nl.dense(weights, policy, activation = None)
+
+    if not value:
+        return policy, None
+
+    vf = nl.flatten(nl.convolutional(weights, y))
+    vf = nl.dense(weights, vf)
+    vf = nl.dense(weights, vf, activation = 'tanh')
+    return policy, vf[:, 0]
+
+
+def numpy_residual(weights, y):
+    shortcut = y
+    y = nl.convolutional(weights, y)
+    y = nl.convolutional(weights, y, activation = None)
+    return nl.activate(shortcut + y, 'relu')
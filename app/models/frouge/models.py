@@ -8,6 +8,8 @@ import tensorflow.keras.backend as K
 from stable_baselines.common.policies import ActorCriticPolicy
 from stable_baselines.common.distributions import CategoricalProbabilityDistribution
 
+from utils import numpy_layers as nl
+
 ACTIONS = 29
 FEATURE_SIZE = 64
 
@@ -43,6 +45,11 @@ class CustomPolicy(ActorCriticPolicy):
     def value(self, obs, state=None, mask=None):
         return self.sess.run(self.value_flat, {self.obs_ph: obs})
 
+    def proba_value(self, obs, value=True):
+        if not value:
+            return self.proba_step(obs), None
+        return tuple(self.sess.run([self.policy_proba, self.value_flat], {self.obs_ph: obs}))
+
 
 def split_input(processed_obs, split):
     obs = processed_obs[...,:-split]
@@ -122,3 +129,31 @@ def dense(y, filters, batch_norm = False, activation = 'relu', name = None):
     return y
 
 
+def numpy_forward(weights, obs, value = True):
+    # NumPy mirror of CustomPolicy, for utils.inference.NumpyPolicy
+    # weights must be consumed in the order that the layers are created above
+    obs, legal_actions = obs[...,:-ACTIONS], np.mean(obs[...,-ACTIONS:], axis = (1,2))
+    y = nl.convolutional(weights, obs, batch_norm = False, strides = (2,1))
+    y = numpy_residual(weights, y, strides = (2,1))
+
+    policy = nl.flatten(nl.convolutional(weights, y, batch_norm = False))
+    policy = nl.dense(weights, policy)
+    policy = nl.dense(weights, policy, activation = None)
+    policy = nl.mask_illegal(policy, legal_actions)
+
+    if not value:
+        return policy, None
+
+    vf = nl.flatten(nl.convolutional(weights, y, batch_norm = False))
+    vf = nl.dense(weights, vf)
+    vf = nl.dense(weights, vf, activation = 'tanh')
+    return policy, vf[:, 0]
+
+
+def numpy_residual(weights, y, strides):
+    shortcut = nl.convolutional(weights, y, batch_norm = False, strides = strides)
+    shortcut = nl.convolutional(weights, shortcut, batch_norm = False, strides = strides)
+
+    y = nl.convolutional(weights, y, batch_norm = False, strides = strides)
+    y = nl.convolutional(weights, y, batch_norm = False, activation = None, strides = strides)
+    return nl.activate(shortcut + y, 'relu')
@@ -8,6 +8,8 @@ import tensorflow.keras.backend as K
 from stable_baselines.common.policies import ActorCriticPolicy
 from stable_baselines.common.distributions import CategoricalProbabilityDistribution
 
+from utils import numpy_layers as nl
+
 
 ACTIONS = 36
 FEATURE_SIZE = 128
@@ -46,6 +48,11 @@ class CustomPolicy(ActorCriticPolicy):
     def value(self, obs, state=None, mask=None):
         return self.sess.run(self.value_flat, {self.obs_ph: obs})
 
+    def proba_value(self, obs, value=True):
+        if not value:
+            return self.proba_step(obs), None
+        return tuple(self.sess.run([self.policy_proba, self.value_flat], {self.obs_ph: obs}))
+
 
 def split_input(obs, split):
     return   obs[:,:-split], obs[:,-split:]
@@ -112,3 +119,32 @@ def dense(y, filters, batch_norm = False, activation = 'relu', name = None):
     return y
 
 
+def numpy_forward(weights, obs, value = True):
+    # NumPy mirror of CustomPolicy, for utils.inference.NumpyPolicy
+    # weights must be consumed in the order that the layers are created above
+    obs, legal_actions = obs[:,:-ACTIONS], obs[:,-ACTIONS:]
+    y = nl.dense(weights, obs)
+    for _ in range(DEPTH):
+        y = numpy_residual(weights, y)
+
+    policy = y
+    for _ in range(POLICY_DEPTH):
+        policy = nl.dense(weights, policy)
+    policy = nl.dense(weights, policy, activation = None)
+    policy = nl.mask_illegal(policy, legal_actions)
+
+    if not value:
+        return policy, None
+
+    vf = y
+    for _ in range(VALUE_DEPTH):
+        vf = nl.dense(weights, vf)
+    vf = nl.dense(weights, vf, activation = 'tanh')
+    return policy, vf[:, 0]
+
+
+def numpy_residual(weights, y):
+    shortcut = y
+    y = nl.dense(weights, y)
+    y = nl.dense(weights, y, activation = None)
+    return nl.activate(shortcut + y, 'relu')
@@ -13,7 +13,7 @@ import argparse
 from stable_baselines import logger
 from stable_baselines.common import set_global_seeds
 
-from utils.files import load_model, write_results
+from utils.files import load_model, ResultsWriter, results_row
 from utils.register import get_environment
 from utils.agents import Agent
 
@@ -36,9 +36,12 @@ def main(args):
 
   total_rewards = {}
 
+  if args.write_results:
+    results = ResultsWriter(f"{config.RESULTSPATH}/results.csv")
+
   if args.recommend:
     ppo_model = load_model(env, 'best_model.zip')
-    ppo_agent = Agent('best_model', ppo_model)
+    ppo_agent = Agent('best_model', ppo_model, args.backend)
   else:
     ppo_agent = None
 
@@ -56,10 +59,10 @@ def main(args):
       agent_obj = Agent('rules')
     elif agent == 'base':
       base_model = load_model(env, 'base.zip')
-      agent_obj = Agent('base', base_model)   
+      agent_obj = Agent('base', base_model, args.backend)   
     else:
       ppo_model = load_model(env, f'{agent}.zip')
-      agent_obj = Agent(agent, ppo_model)
+      agent_obj = Agent(agent, ppo_model, args.backend)
     agents.append(agent_obj)
     total_rewards[agent_obj.id] = 0
   
@@ -117,11 +120,13 @@ def main(args):
     logger.info(f"Played {game + 1} games: {total_rewards}")
 
     if args.write_results:
-      write_results('results.csv', players, game, args.games, env.turns_taken)
+      results.write(results_row(players, game, args.games, env.turns_taken))
 
     for p in players:
       p.points = 0
 
+  if args.write_results:
+    results.close()
   env.close()
     
 
@@ -161,6 +166,8 @@ def cli() -> None:
             , help="Write results to a file?")
   parser.add_argument("--seed", "-s",  type = int, default = 17
             , help="Random seed")
+  parser.add_argument("--backend", "-bk", type = str, default = 'tf'
+            , help="tf / numpy - how the agent policies are evaluated")
 
   # Extract args
   args = parser.parse_args()
@@ -1,8 +1,10 @@
 import numpy as np
 
-from gonutsfordonuts.envs.gonutsfordonuts import GoNutsGame, GoNutsScorer, GoNutsGameGymTranslator, GoNutsForDonutsEnvUtility, GoNutsGameState
+import gonutsfordonuts.envs.gonutsfordonuts as gonutsfordonuts
+from gonutsfordonuts.envs.gonutsfordonuts import GoNutsGame, GoNutsScorer, GoNutsGameGymTranslator, GoNutsForDonutsEnvUtility, GoNutsGameState, GoNutsForDonutsEnv
+from gonutsfordonuts.envs.batch import GoNutsBatchGame, GoNutsForDonutsBatchEnv
 from gonutsfordonuts.envs.classes import ChocolateFrosted, DonutHoles, Eclair, FrenchCruller, Glazed, JellyFilled, MapleBar, Plain, Powdered, BostonCream, DoubleChocolate, RedVelvet, Sprinkled, BearClaw, CinnamonTwist, Coffee, DayOldDonuts, Milk, OldFashioned, MapleFrosted, MuchoMatcha, RaspberryFrosted, StrawberryGlazed
-from gonutsfordonuts.envs.classes import Position, Player, Deck, Discard
+from gonutsfordonuts.envs.classes import Position, Player, Deck, Discard, CardCatalogue
 import gonutsfordonuts.envs.cards as cards
 import gonutsfordonuts.envs.obvs as obvs
 import gonutsfordonuts.envs.actions as actions
@@ -32,6 +34,69 @@ class TestDiscard:
         d.remove_one(Glazed(cards.GZ_FIRST))
         assert d.size() == 8
 
+    def test_type_counts_follow_discard(self):
+        d = Discard()
+        d.add([ChocolateFrosted(cards.CF_FIRST), ChocolateFrosted(cards.CF_2), Glazed(cards.GZ_FIRST), MapleBar(cards.MB_FIRST)])
+
+        assert d.counts[cards.TYPE_CF] == 2
+        assert d.draw_one().id == cards.MB_FIRST
+        assert d.counts[cards.TYPE_MB] == 0
+        d.remove_one(ChocolateFrosted(cards.CF_2))
+        assert d.counts[cards.TYPE_CF] == 1
+        assert d.counts.sum() == d.size() == 2
+
+    def test_id_and_type_indexes_follow_discard(self):
+        d = Discard()
+        d.add([ChocolateFrosted(cards.CF_FIRST), Glazed(cards.GZ_FIRST), ChocolateFrosted(cards.CF_2), MapleBar(cards.MB_FIRST)])
+
+        assert d.card_for_id(cards.GZ_FIRST).symbol == 'GZ'
+        assert [ c.id for c in d.types[cards.TYPE_CF] ] == [cards.CF_FIRST, cards.CF_2]
+        d.draw_one()
+        d.remove_one(ChocolateFrosted(cards.CF_FIRST))
+        assert d.card_for_id(cards.MB_FIRST) is None
+        assert d.card_for_id(cards.CF_FIRST) is None
+        assert [ c.id for c in d.types[cards.TYPE_CF] ] == [cards.CF_2]
+        assert d.types[cards.TYPE_MB] == []
+
+    def test_discard_order_survives_removal_from_the_middle(self):
+        d = Discard()
+        d.add([Glazed(cards.GZ_FIRST), ChocolateFrosted(cards.CF_FIRST), MapleBar(cards.MB_FIRST), Eclair(cards.ECL_FIRST)])
+
+        d.remove_one(MapleBar(cards.MB_FIRST))
+        d.remove_one(ChocolateFrosted(cards.CF_FIRST))
+        assert d.size() == 2
+        assert d.draw_one().id == cards.ECL_FIRST
+        assert d.peek_one().id == cards.GZ_FIRST
+        d.remove_one(Glazed(cards.GZ_FIRST))
+        assert d.peek_one() is None
+        assert d.size() == d.counts.sum() == 0
+
+
+class TestPosition:
+    def test_type_counts_follow_position(self):
+        position = Position()
+        position.add([Sprinkled(cards.SPR_FIRST), Plain(cards.P_FIRST)])
+        position.add_one(Plain(cards.P_2))
+
+        assert position.counts[cards.TYPE_P] == 2
+        assert position.pick('plain').id == cards.P_FIRST
+        position.remove_one(Sprinkled(cards.SPR_FIRST))
+        assert position.counts[cards.TYPE_SPR] == 0
+        assert position.counts.sum() == position.size() == 1
+
+    def test_id_and_type_indexes_follow_position(self):
+        position = Position()
+        position.add([Sprinkled(cards.SPR_FIRST), Plain(cards.P_FIRST), Sprinkled(cards.SPR_2)])
+
+        assert position.contains_id(cards.SPR_2)
+        assert position.card_for_id(cards.P_FIRST).name == 'plain'
+        assert [ c.id for c in position.types[cards.TYPE_SPR] ] == [cards.SPR_FIRST, cards.SPR_2]
+        position.pick('plain')
+        position.remove_one(Sprinkled(cards.SPR_FIRST))
+        assert not position.contains_id(cards.SPR_FIRST)
+        assert not position.contains_id(cards.P_FIRST)
+        assert [ c.id for c in position.types[cards.TYPE_SPR] ] == [cards.SPR_2]
+
 
 class TestDeck:
 
@@ -95,6 +160,68 @@ class TestDeck:
         assert d.draw_one().symbol == "GZ"
         assert d.draw_one().symbol == "POW"
 
+    def test_id_index_follows_deck(self):
+
+        d = Deck(2, GoNutsGame.standard_deck_contents())
+        d.filter([cards.CF_FIRST, cards.DH_FIRST, cards.GZ_FIRST])
+
+        assert d.card_for_id(cards.MB_FIRST) is None
+        assert d.card_for_id(cards.DH_FIRST).symbol == 'DH'
+        d.remove_one(d.card_for_id(cards.DH_FIRST))
+        assert d.draw_one().id == cards.CF_FIRST
+        assert d.card_for_id(cards.DH_FIRST) is None
+        assert d.card_for_id(cards.CF_FIRST) is None
+        assert [ c.id for c in d.cards ] == [cards.GZ_FIRST]
+        assert list(d.ids) == [cards.GZ_FIRST]
+
+    def test_catalogue_matches_created_deck(self):
+
+        catalogue = CardCatalogue(GoNutsGame.standard_deck_contents())
+        d = Deck(2, GoNutsGame.standard_deck_contents())
+
+        assert catalogue.size() == 70
+        assert list(catalogue.cards) == d.base_deck
+        assert [ type(c) for c in catalogue.cards ] == [ type(c) for c in d.base_deck ]
+
+    def test_deck_from_catalogue_shares_its_cards(self):
+
+        catalogue = CardCatalogue(GoNutsGame.standard_deck_contents())
+        d = Deck(2, GoNutsGame.standard_deck_contents(), catalogue)
+
+        d.filter([cards.GZ_FIRST, cards.CF_2])
+
+        assert d.size() == 2
+        assert d.draw_one() is catalogue.cards[cards.GZ_FIRST]
+        assert d.draw_one() is catalogue.cards[cards.CF_2]
+        assert catalogue.size() == 70
+
+    def test_game_resets_deal_from_the_shared_catalogue(self):
+
+        test_game = GoNutsGame(3)
+        test_game.setup_game(deck_filter=GoNutsGame.teal_deck_filter_no_fc())
+        first_deck = list(test_game.deck.cards)
+        test_game.reset_game(deck_filter=GoNutsGame.teal_deck_filter_no_fc())
+
+        assert sorted(c.id for c in test_game.deck.cards) == sorted(GoNutsGame.teal_deck_filter_no_fc())
+        assert all(c is GoNutsGame.card_catalogue().cards[c.id] for c in first_deck + test_game.deck.cards)
+
+    def test_game_resets_empty_the_same_containers(self):
+
+        test_game = GoNutsGame(3)
+        test_game.setup_game(deck_filter=GoNutsGame.teal_deck_filter_no_fc())
+        deck, discard, players = test_game.deck, test_game.discard, list(test_game.players)
+        test_game.start_game()
+        test_game.players[1].position.add(test_game.deck.draw(3))
+        test_game.players[1].score = 7
+        test_game.discard.add(test_game.deck.draw(2))
+        test_game.reset_game(deck_filter=GoNutsGame.teal_deck_filter_no_fc())
+
+        assert test_game.deck is deck and test_game.discard is discard and test_game.players == players
+        assert test_game.deck.size() == len(GoNutsGame.teal_deck_filter_no_fc())
+        assert test_game.discard.size() == test_game.discard.counts.sum() == 0
+        assert all(p.position.size() == p.position.counts.sum() == p.score == 0 for p in test_game.players)
+        assert not any(test_game.players[1].position.types) and not test_game.players[1].position.ids
+
 
 class TestGoNutsForDonutsEnvUtility:
     def test_rewards_single_winner(self):
@@ -287,6 +414,54 @@ class TestGoNutsForDonutsScorer:
         scores = GoNutsScorer.score_turn(positions)
         assert (scores == [10, 5, 10]).all()
 
+    def test_count_scoring(self):
+        positions = [ Position(), Position(), Position()]
+        positions[0].add([Plain(cards.P_FIRST), Glazed(cards.GZ_FIRST), DonutHoles(cards.DH_FIRST), DonutHoles(cards.DH_2), Plain(cards.P_2)])
+        positions[1].add([Powdered(cards.POW_FIRST), JellyFilled(cards.JF_FIRST), FrenchCruller(cards.FC_FIRST), Eclair(cards.ECL_FIRST), MapleBar(cards.MB_FIRST)])
+        positions[2].add([Glazed(cards.GZ_FIRST), ChocolateFrosted(cards.CF_FIRST), MapleBar(cards.MB_FIRST), JellyFilled(cards.JF_FIRST), DonutHoles(cards.DH_2), Powdered(cards.POW_2), Plain(cards.P_3)])
+
+        scores = GoNutsScorer.score_counts(np.array([[ p.counts for p in positions ]]))
+        assert scores.shape == (1, 3)
+        assert (scores[0] == [10, 5, 10]).all()
+
+    def test_count_scoring_lookup_tables(self):
+        # every possible number of donut holes, jelly filled and boston creams, one game each
+        counts = np.zeros((7, 3, cards.TOTAL_TYPES), dtype=np.int32)
+        counts[:, 0, cards.TYPE_DH] = np.arange(7)
+        counts[:, 1, cards.TYPE_JF] = np.arange(7)
+        counts[:, 2, cards.TYPE_BC] = np.arange(7)
+
+        scores = GoNutsScorer.score_counts(counts)
+
+        for n in range(7):
+            position = Position()
+            position.counts[:] = counts[n, 0]
+            assert scores[n, 0] == GoNutsScorer.score_donut_holes(position)
+            position.counts[:] = counts[n, 1]
+            assert scores[n, 1] == GoNutsScorer.score_jelly_filled(position)
+            position.counts[:] = counts[n, 2]
+            assert scores[n, 2] == GoNutsScorer.score_boston_cream(position)
+
+    def test_count_scoring_matches_itemised_scoring(self):
+        # random deals of the full deck to three players, scored one rule at a time and from the counts of all the games at once
+        rng = np.random.RandomState(0)
+        all_positions = []
+        for _ in range(300):
+            deck = Deck(3, GoNutsGame.standard_deck_contents())
+            order = rng.permutation(deck.size())
+            sizes = rng.randint(0, 16, size=3)
+            positions = [ Position(), Position(), Position()]
+            start = 0
+            for position, size in zip(positions, sizes):
+                position.add([ deck.cards[i] for i in order[start:start + size] ])
+                start += size
+            all_positions.append(positions)
+
+        scores = GoNutsScorer.score_counts(np.array([[ p.counts for p in positions ] for positions in all_positions]))
+
+        for game_scores, positions in zip(scores, all_positions):
+            assert (game_scores == GoNutsScorer.score_itemised(positions)).all()
+
 class TestGoNutsForDonutsGymTranslator:
 
     def fixture_card_order(self):
@@ -1033,6 +1208,21 @@ class TestGoNutsForDonutsGame:
 
         assert test_game.translate_step_action(GoNutsGameState.GIVE_CARD, 1, actions.ACTION_GIVE_CARD + cards.TYPE_DH) == cards.DH_FIRST
 
+    def test_donut_decks_are_found_by_card_id_after_refill(self):
+
+        test_game = GoNutsGame(3)
+
+        test_game.setup_game(shuffle=False, deck_filter=self.fixture_card_filter())
+        test_game.start_game() # deals top 4
+        assert test_game.deck_for_card_id(cards.DH_FIRST) is test_game.donut_decks[1]
+
+        test_game.execute_game_loop_with_actions(TestHelpers.step_actions(actions.ACTION_DONUT, [cards.TYPE_ECL, cards.TYPE_DH, cards.TYPE_GZ]))
+
+        for deck in test_game.donut_decks:
+            assert test_game.deck_for_card_id(deck.card.id) is deck
+            assert test_game.translate_step_action(GoNutsGameState.PICK_DONUT, 0, deck.card.type) == deck.card.id
+        assert cards.DH_FIRST not in test_game.donut_deck_for_id
+
     def test_red_velvet_draws_correct_card_from_discard(self):
         test_game = GoNutsGame(4)
 
@@ -1196,4 +1386,59 @@ class TestGoNutsForDonutsGame:
 
         # Check player receiving card has correct position (player 0, has lowest score, lowest ID to break ties)
         assert test_game.players[0].position.size() == 1
-        assert test_game.players[0].position.cards[0].id == cards.SPR_FIRST
\ No newline at end of file
+        assert test_game.players[0].position.cards[0].id == cards.SPR_FIRST
+
+
+class TestGoNutsForDonutsBatchEnv:
+
+    def reset_game(self, env, batch_env, g, deck_filter):
+        env.game.reset_game(shuffle=True, deck_filter=deck_filter)
+        batch_env.reset_games([g], np.array([[ card.id for card in env.game.deck.cards ]]))
+        env.game.start_game()
+        env.current_player_num = 0
+        env.done = False
+        env.clear_cache()
+
+    def test_new_games_are_dealt_from_the_filtered_deck(self):
+        batch_env = GoNutsForDonutsBatchEnv(4)
+        batch_env.reset()
+        game = batch_env.game
+
+        assert (game.deck_size == len(game.deck_filter) - game.no_donut_decks).all()
+        for g in range(4):
+            dealt = np.concatenate([game.deck[g, :game.deck_size[g]], game.donut_decks[g]])
+            assert sorted(dealt) == sorted(game.deck_filter)
+        assert (batch_env.current_player_num == 0).all()
+        assert not batch_env.done.any()
+
+    def test_matches_single_game_env(self, monkeypatch):
+        # both pick the first matching card where the rules leave the choice to chance
+        monkeypatch.setattr(gonutsfordonuts.random, 'choice', lambda cards: cards[0])
+        monkeypatch.setattr(GoNutsBatchGame, 'choose', staticmethod(lambda matches: np.argmax(matches, axis=1)))
+
+        n = 8
+        deck_filter = GoNutsGame.teal_and_pink_filter_no_fc()
+        batch_env = GoNutsForDonutsBatchEnv(n)
+        batch_env.game = GoNutsBatchGame(n, batch_env.n_players, deck_filter)
+        batch_env.translator.game = batch_env.game
+        envs = [ GoNutsForDonutsEnv() for _ in range(n) ]
+        for g, env in enumerate(envs):
+            self.reset_game(env, batch_env, g, deck_filter)
+
+        rng = np.random.RandomState(0)
+        games = 0
+        for _ in range(300):
+            assert (batch_env.legal_actions == np.array([ env.legal_actions for env in envs ])).all()
+            assert (batch_env.observation == np.array([ env.observation for env in envs ])).all()
+
+            step_actions = np.array([ rng.choice(np.flatnonzero(env.legal_actions)) for env in envs ])
+            reward, done = batch_env.step(step_actions)
+            for g, env in enumerate(envs):
+                _, env_reward, env_done, _ = env.step(step_actions[g])
+                assert env_done == done[g]
+                assert (np.array(env_reward) == reward[g]).all()
+                if env_done:
+                    games += 1
+                    self.reset_game(env, batch_env, g, deck_filter)
+
+        assert games > 0
\ No newline at end of file
@@ -0,0 +1,69 @@
+import numpy as np
+
+from collections import OrderedDict
+
+from utils.inference import PolicyModel, NumpyPolicy, get_policy_graph
+from utils.register import get_environment
+
+from stable_baselines import logger
+
+logger.set_level(10)
+
+
+def random_params(env):
+    # random values for every policy parameter, so that the comparison doesn't rely on the default initialisation
+    policy_graph = get_policy_graph(env)
+    params = OrderedDict()
+    for name, (placeholder, _) in policy_graph.load_ops.items():
+        shape = tuple(placeholder.shape.as_list())
+        params[name] = np.random.normal(0, 0.1, shape).astype(np.float32)
+    return params
+
+
+def observations(env, n = 16):
+    # observations from actual play, so that the legal actions are realistic
+    obs = []
+    env.reset()
+    while len(obs) < n:
+        obs.append(env.observation)
+        legal_actions = np.flatnonzero(env.legal_actions)
+        _, _, done, _ = env.step(np.random.choice(legal_actions))
+        if done:
+            env.reset()
+    return np.array(obs)
+
+
+def assert_parity(env_name):
+    np.random.seed(17)
+    env = get_environment(env_name)(verbose = False)
+    params = random_params(env)
+    obs = observations(env)
+
+    tf_policy = PolicyModel(env, params)
+    numpy_policy = NumpyPolicy(env, params)
+
+    assert np.allclose(numpy_policy.proba_step(obs), tf_policy.proba_step(obs), atol = 1e-4)
+    assert np.allclose(numpy_policy.value(obs), tf_policy.value(obs), atol = 1e-4)
+
+
+class TestNumpyForward:
+    def test_tictactoe(self):
+        assert_parity('tictactoe')
+
+    def test_connect4(self):
+        assert_parity('connect4')
+
+    def test_sushigo(self):
+        assert_parity('sushigo')
+
+    def test_gonutsfordonuts(self):
+        assert_parity('gonutsfordonuts')
+
+    def test_butterfly(self):
+        assert_parity('butterfly')
+
+    def test_geschenkt(self):
+        assert_parity('geschenkt')
+
+    def test_frouge(self):
+        assert_parity('frouge')
@@ -0,0 +1,255 @@
+import numpy as np
+import random
+import pytest
+
+import utils.files as files
+import utils.selfplay as selfplay
+from utils.selfplay import SelfPlayBatchVecEnv, selfplay_vec_wrapper
+from utils.register import get_environment, get_batch_environment
+
+from stable_baselines import logger
+
+logger.set_level(10)
+
+
+ENV_NAME = 'gonutsfordonuts'
+OPPONENT_NAMES = ['base.zip', '_model_00001', '_model_00002', '_model_00003']
+
+
+class LegalPolicy():
+    # a policy that hasn't learnt anything, picking uniformly from the legal actions at the end of the
+    # observation, or from every action if it is careless, so that it ends some games with an illegal move
+    def __init__(self, name, n_actions, careless, log):
+        self.name = name
+        self.n_actions = n_actions
+        self.careless = careless
+        self.log = log
+
+    def proba_value(self, observations, value = True):
+        self.log.append(('evaluate', self.name, len(observations)))
+        if self.careless:
+            action_probs = np.ones((len(observations), self.n_actions))
+        else:
+            action_probs = observations[:, -self.n_actions:]
+        action_probs = action_probs / action_probs.sum(axis = 1, keepdims = True)
+        return action_probs, np.zeros(len(observations)) if value else None
+
+
+class LegalModel():
+    def __init__(self, name, n_actions, careless, log):
+        self.policy_pi = LegalPolicy(name, n_actions, careless, log)
+
+    def get_parameters(self):
+        return {'w': np.zeros(1)}
+
+
+def patch_models(monkeypatch, env, careless):
+    # models that don't need a saved zoo, logging every evaluation
+    np.random.seed(3)
+    random.seed(3)
+    log = []
+    n_actions = env(verbose = False).action_space.n
+    monkeypatch.setattr(files, 'load_policy', lambda env, name: LegalModel(name, n_actions, careless, log))
+    monkeypatch.setattr(selfplay, 'model_pool', files.ModelPool())
+    monkeypatch.setattr(selfplay, 'get_opponent_names', lambda env_name: list(OPPONENT_NAMES))
+    return log
+
+
+def make_env(monkeypatch, opponent_type, n_envs, careless = False):
+    # built the way train.py builds it with --batch_games
+    env = get_environment(ENV_NAME)
+    log = patch_models(monkeypatch, env, careless)
+    vec_env = SelfPlayBatchVecEnv(env, get_batch_environment(ENV_NAME), opponent_type = opponent_type, verbose = False, n_envs = n_envs)
+    return vec_env, log
+
+
+def make_vec_env(monkeypatch, opponent_type, n_envs, careless = False):
+    # built the way train.py builds it with --n_envs
+    env = get_environment(ENV_NAME)
+    log = patch_models(monkeypatch, env, careless)
+    vec_env = selfplay_vec_wrapper(env)(opponent_type = opponent_type, verbose = False, n_envs = n_envs)
+    return vec_env, log
+
+
+def legal_actions(vec_env):
+    return np.array([np.random.choice(np.flatnonzero(legal)) for legal in vec_env.batch_env.legal_actions])
+
+
+def assert_agent_to_move(vec_env):
+    assert not vec_env.dones.any()
+    assert (vec_env.batch_env.current_player_num == vec_env.agent_player_num).all()
+
+
+class TestSelfPlayBatchVecEnv:
+
+    @pytest.mark.parametrize('opponent_type', ['random', 'base', 'mostly_best_base'])
+    def test_agent_moves_in_every_game(self, monkeypatch, opponent_type):
+        vec_env, _ = make_env(monkeypatch, opponent_type, n_envs = 16)
+        obs = vec_env.reset()
+        assert obs.shape == (16,) + vec_env.observation_space.shape
+        assert_agent_to_move(vec_env)
+
+        finished = 0
+        for _ in range(200):
+            obs, rewards, dones, infos = vec_env.step(legal_actions(vec_env))
+            assert obs.shape == (16,) + vec_env.observation_space.shape
+            assert rewards.shape == dones.shape == (16,)
+            # the agent is only rewarded at the end of a game
+            assert (rewards[~dones] == 0).all()
+            assert [g for g, info in enumerate(infos) if 'terminal_observation' in info] == list(np.flatnonzero(dones))
+            assert_agent_to_move(vec_env)
+            finished += dones.sum()
+
+        assert finished > 16
+
+    def test_finished_games_are_dealt_again(self, monkeypatch):
+        vec_env, _ = make_env(monkeypatch, 'random', n_envs = 16)
+        vec_env.reset()
+        while True:
+            obs, _, dones, infos = vec_env.step(legal_actions(vec_env))
+            if dones.any():
+                break
+
+        for g in np.flatnonzero(dones):
+            # the new game is returned, and the last one is only kept in the info
+            assert not np.array_equal(infos[g]['terminal_observation'], obs[g])
+            assert (obs[g][-vec_env.action_space.n:] == vec_env.batch_env.legal_actions[g]).all()
+
+    def test_games_an_opponent_ends_are_dealt_again(self, monkeypatch):
+        vec_env, _ = make_env(monkeypatch, 'random', n_envs = 32, careless = True)
+        dealt = []
+        reset_games = vec_env.batch_env.reset_games
+        def record_reset_games(games, decks = None):
+            dealt.extend(games)
+            return reset_games(games, decks)
+        monkeypatch.setattr(vec_env.batch_env, 'reset_games', record_reset_games)
+
+        vec_env.reset()
+        # the careless opponents end some games before the agent's first move
+        assert len(dealt) > 32
+        assert_agent_to_move(vec_env)
+
+        for _ in range(20):
+            dealt.clear()
+            _, _, dones, _ = vec_env.step(legal_actions(vec_env))
+            assert set(dealt) == set(np.flatnonzero(dones))
+            assert_agent_to_move(vec_env)
+
+    def test_opponent_moves_are_batched_by_model(self, monkeypatch):
+        vec_env, log = make_env(monkeypatch, 'random', n_envs = 32)
+        take_turns = vec_env.take_turns
+        def record_take_turns(games, actions):
+            log.append(('take_turns', None, len(games)))
+            return take_turns(games, actions)
+        monkeypatch.setattr(vec_env, 'take_turns', record_take_turns)
+
+        vec_env.reset()
+        for _ in range(20):
+            vec_env.step(legal_actions(vec_env))
+
+        # each round of opponent moves evaluates every model once, for all the games it is to move in
+        rounds = [[]]
+        for event, name, n in log:
+            if event == 'take_turns':
+                assert sum(n_obs for _, n_obs in rounds[-1]) in (0, n)
+                rounds.append([])
+            else:
+                rounds[-1].append((name, n))
+        for evaluations in rounds:
+            names = [name for name, _ in evaluations]
+            assert len(names) == len(set(names))
+        assert max(n for event, _, n in log if event == 'evaluate') > 1
+
+    def test_add_opponent_to_every_game(self, monkeypatch):
+        vec_env, _ = make_env(monkeypatch, 'best', n_envs = 8)
+        assert vec_env.env_method('add_opponent', '_model_00004') == [None] * 8
+        assert vec_env.env_method('add_opponent', '_model_00004') == [None] * 8
+        assert vec_env.opponent_names == OPPONENT_NAMES + ['_model_00004']
+
+        # the best opponent in every new game is the one that was just added
+        vec_env.reset()
+        assert all(agent.model is selfplay.model_pool.get(vec_env.lead_env, '_model_00004')
+            for agents in vec_env.agents for agent in agents if agent is not None)
+
+        with pytest.raises(NotImplementedError):
+            vec_env.get_attr('opponent_names')
+
+
+class TestSelfPlayVecEnv:
+
+    def legal_actions(self, vec_env):
+        return np.array([np.random.choice(np.flatnonzero(env.legal_actions)) for env in vec_env.envs])
+
+    def assert_agent_to_move(self, vec_env, obs):
+        for env, observation in zip(vec_env.envs, obs):
+            assert env.current_player_num == env.agent_player_num
+            assert np.allclose(observation, env.observation)
+
+    @pytest.mark.parametrize('opponent_type', ['random', 'base', 'mostly_best_base'])
+    def test_agent_moves_in_every_game(self, monkeypatch, opponent_type):
+        vec_env, _ = make_vec_env(monkeypatch, opponent_type, n_envs = 8)
+        obs = vec_env.reset()
+        assert obs.shape == (8,) + vec_env.observation_space.shape
+        self.assert_agent_to_move(vec_env, obs)
+
+        finished = 0
+        for _ in range(100):
+            obs, rewards, dones, infos = vec_env.step(self.legal_actions(vec_env))
+            assert rewards.shape == dones.shape == (8,)
+            assert (rewards[~dones] == 0).all()
+            assert [g for g, info in enumerate(infos) if 'terminal_observation' in info] == list(np.flatnonzero(dones))
+            self.assert_agent_to_move(vec_env, obs)
+            finished += dones.sum()
+
+        assert finished > 8
+
+    def test_games_an_opponent_ends_are_dealt_again(self, monkeypatch):
+        vec_env, _ = make_vec_env(monkeypatch, 'random', n_envs = 16, careless = True)
+        dealt = []
+        for env_idx, env in enumerate(vec_env.envs):
+            def record_new_game(env_idx = env_idx, new_game = env.new_game):
+                dealt.append(env_idx)
+                return new_game()
+            monkeypatch.setattr(env, 'new_game', record_new_game)
+
+        obs = vec_env.reset()
+        # the careless opponents end some games before the agent's first move
+        assert len(dealt) > 16
+        self.assert_agent_to_move(vec_env, obs)
+
+        for _ in range(20):
+            dealt.clear()
+            obs, _, dones, _ = vec_env.step(self.legal_actions(vec_env))
+            assert set(dealt) == set(np.flatnonzero(dones))
+            self.assert_agent_to_move(vec_env, obs)
+
+    def test_opponent_moves_are_batched_by_model(self, monkeypatch):
+        vec_env, log = make_vec_env(monkeypatch, 'base', n_envs = 16)
+        turns = []
+        for env_idx, env in enumerate(vec_env.envs):
+            def record_take_turn(action, env_idx = env_idx, take_turn = env.take_turn):
+                turns.append(env_idx)
+                return take_turn(action)
+            monkeypatch.setattr(env, 'take_turn', record_take_turn)
+
+        continue_games = vec_env.continue_games
+        def record_continue_games(env_idxs):
+            turns.clear()
+            evaluations = len(log)
+            continue_games(env_idxs)
+            # a single opponent model, so every round of opponent moves is one evaluation for all the games
+            rounds = max([turns.count(i) for i in set(turns)], default = 0)
+            assert len(log) - evaluations == rounds
+        monkeypatch.setattr(vec_env, 'continue_games', record_continue_games)
+
+        vec_env.reset()
+        for _ in range(20):
+            vec_env.step(self.legal_actions(vec_env))
+        assert max(n for _, _, n in log) > 1
+
+    def test_add_opponent_to_every_game(self, monkeypatch):
+        vec_env, _ = make_vec_env(monkeypatch, 'best', n_envs = 4)
+        vec_env.env_method('add_opponent', '_model_00004')
+        # the games share one list of opponents, so it is only added once
+        assert all(env.opponent_names is vec_env.envs[0].opponent_names for env in vec_env.envs)
+        assert vec_env.envs[0].opponent_names == OPPONENT_NAMES + ['_model_00004']
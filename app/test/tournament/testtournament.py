@@ -0,0 +1,52 @@
+import argparse
+import numpy as np
+
+import tournament
+from utils.register import get_environment
+
+from stable_baselines import logger
+
+logger.set_level(10)
+
+
+class UniformPolicy():
+    # the policy of a model that hasn't learnt anything, so the games don't need any saved weights
+    def __init__(self, n_actions):
+        self.n_actions = n_actions
+
+    def proba_value(self, observations, value = True):
+        action_probs = np.full((len(observations), self.n_actions), 1 / self.n_actions)
+        return action_probs, np.zeros(len(observations)) if value else None
+
+
+class UniformModel():
+    def __init__(self, env):
+        self.policy_pi = UniformPolicy(env.action_space.n)
+
+
+def play_cell(env_name, lockstep, games = 8):
+    args = argparse.Namespace(seed = 17, games = games, best = False, backend = 'tf', lockstep = lockstep, env_name = env_name)
+    envs = [get_environment(env_name)(verbose = False) for _ in range(games if lockstep else 1)]
+    ppo_models = [(UniformModel(envs[0]), 'base'), (UniformModel(envs[0]), 'model_i'), (UniformModel(envs[0]), 'model_j')]
+    return tournament.run_cell(envs, ppo_models, 1, 2, args)
+
+
+class TestSeats:
+
+    def test_three_player_games_rotate_every_seat(self):
+        assert tournament.seat_orders(3) == tournament.SEAT_ORDERS
+        assert [tournament.seat_order(k, 3) for k in range(6)] == tournament.SEAT_ORDERS
+
+    def test_two_player_games_only_swap_the_models(self):
+        assert tournament.seat_orders(2) == [(0, 1, 2), (1, 0, 2)]
+
+    def test_both_models_play_every_two_player_game(self):
+        for lockstep in (False, True):
+            _, game_rows = play_cell('tictactoe', lockstep)
+
+            assert len(game_rows) == 8
+            for k, row in enumerate(game_rows):
+                assert (row['p0_seat'], row['p1_seat']) == ((0, 1) if k % 2 == 0 else (1, 0))
+                # base only fills the seat past the players, so it never moves and never scores
+                assert row['p2_seat'] == 2
+                assert row['p2_points'] == 0
@@ -9,12 +9,18 @@ tf.compat.v1.logging.set_verbosity(tf.compat.v1.logging.ERROR)
 
 import random
 import argparse
+import json
+import math
+import zlib
+import multiprocessing
+import numpy as np
+from collections import OrderedDict
 from statistics import mean
 
 from stable_baselines import logger
 from stable_baselines.common import set_global_seeds
 
-from utils.files import load_all_models_with_names, write_results, write_tournament_results
+from utils.files import load_all_models_with_names, model_fingerprint, ResultsWriter, TournamentCache, results_row, tournament_row
 from utils.register import get_environment
 from utils.agents import Agent
 
@@ -27,99 +33,307 @@ class PlayerScore():
 
     
 
-def main(args):
+def cell_names(ppo_models, game_cell_i, game_cell_j):
+    # the models in each seat
+    return [ppo_models[game_cell_i][1], ppo_models[game_cell_j][1], ppo_models[0][1]]
 
-    logger.configure(config.LOGDIR)
+# the models (i, j, base) in each seat, for successive games of a cell. Each pair of games swaps i and j
+# with base in the same seat, and base moves seat every pair, so every model sits in every seat
+SEAT_ORDERS = [(0, 1, 2), (1, 0, 2), (2, 0, 1), (2, 1, 0), (0, 2, 1), (1, 2, 0)]
 
-    if args.debug:
-        logger.set_level(config.DEBUG)
-    else:
-        logger.set_level(config.INFO)
-        
-    #make environment
-    env = get_environment(args.env_name)(verbose = args.verbose, manual = args.manual)
-    env.seed(args.seed)
-    set_global_seeds(args.seed)
+def seat_orders(n_players):
+    # the orders that seat both i and j in the game. In a 2 player game that only swaps i and j,
+    # with base left in the seat past the players, which never moves
+    return [order for order in SEAT_ORDERS if max(order.index(0), order.index(1)) < n_players]
 
-    #load the agents
-    ppo_models = load_all_models_with_names(env, start=args.start, stop=args.stop, step=args.step)
-    total_agents = len(ppo_models)
-    print(f"Loaded {total_agents} models in total.")
+def seat_order(k, n_players):
+    orders = seat_orders(n_players)
+    return orders[k % len(orders)]
+
+def cell_key(env, ppo_models, game_cell_i, game_cell_j, args):
+    # everything that decides the results of a cell: the game, the models (with the size and modification time
+    # of their weights, as names repeat across a zoo reset) and how their games are played
+    names = cell_names(ppo_models, game_cell_i, game_cell_j)
+    return json.dumps({'env_name': args.env_name, 'players': names, 'weights': [model_fingerprint(env.name, name) for name in names]
+        , 'seed': args.seed, 'games': args.games, 'best': args.best, 'lockstep': args.lockstep, 'seats': seat_orders(env.n_players)})
+
+def seed_game(args, match, k):
+    # common random numbers: game k of every cell is dealt from the same seed, whichever models are playing,
+    # and both games of each seat pair share a deal, so the luck of the cards mostly cancels out of the comparisons.
+    # Also means the results don't depend on which worker plays the cell, or where the models are in the list
+    set_global_seeds((args.seed + zlib.crc32(f"{match},{k // 2}".encode())) % 2 ** 32)
+
+def game_name(game_cell_i, game_cell_j, names):
+    return f"game: ({game_cell_i},{game_cell_j}) players: {names[0]},{names[1]},{names[2]}"
+
+
+def cell_agents(ppo_models, game_cell_i, game_cell_j, args):
+    # gonutsfordonuts perfectly blocks when playing against itself so 2 copies of the same agent is a bad idea
+    # always use 1 copy of base that plays exploratively
+    return [Agent(ppo_models[game_cell_i][1], ppo_models[game_cell_i][0], args.backend)
+        , Agent(ppo_models[game_cell_j][1], ppo_models[game_cell_j][0], args.backend)
+        , Agent(ppo_models[0][1], ppo_models[0][0], args.backend)]
 
-    all_results_filename = args.output + "-all-results.csv"
-    tournament_results_filename = args.output + "-tournament-results.csv"
 
-    #play all agents against each other
-    for game_cell_i in range(total_agents):
-        for game_cell_j in range(total_agents):
-            agents = []
+def play_cell(env, ppo_models, game_cell_i, game_cell_j, args, match = 0):
+    # the games between models i and j (and a copy of base), rotating the seats from game to game.
+    # Scores and result rows stay in model order (i, j, base), with the seat each model played from
+    agents = cell_agents(ppo_models, game_cell_i, game_cell_j, args)
 
-            agent_obj_1 = Agent(ppo_models[game_cell_i][1], ppo_models[game_cell_i][0])
-            agent_obj_2 = Agent(ppo_models[game_cell_j][1], ppo_models[game_cell_j][0])
-            # gonutsfordonuts perfectly blocks when playing against itself so 2 copies of the same agent is a bad idea
-            # always use 1 copy of base that plays exploratively
-            agent_obj_3 = Agent(ppo_models[0][1], ppo_models[0][0])
-            
-            agents.append(agent_obj_1)
-            agents.append(agent_obj_2)
-            agents.append(agent_obj_3)
+    player_total_scores = []
+    for agent in agents:
+        player_total_scores.append(PlayerScore(agent.name))
 
-            player_total_scores = []
-            for p in range(3):
-                player_total_scores.append(PlayerScore(agents[p].name))
+    game_str = game_name(game_cell_i, game_cell_j, [a.name for a in agents])
+    game_rows = []
+    for k in range(args.games):
+        order = seat_order(k, env.n_players)
+        players = [agents[m] for m in order]
 
-            for k in range(args.games):
-                total_rewards = {}
-                
-                total_rewards[agent_obj_1.id] = 0
-                total_rewards[agent_obj_2.id] = 0
-                total_rewards[agent_obj_3.id] = 0
-                
-                players = agents[:]
+        for p in players:
+            p.points = 0
 
-                # TODO: randomise player order without breaking records
+        seed_game(args, match, k)
+        obs = env.reset()
+        done = False
 
-                for p in players:
-                    p.points = 0
+        logger.info(f"Playing {game_str}")
 
-                obs = env.reset()
-                done = False
+        for i, p in enumerate(players):
+            logger.info(f'Player {i+1} = {p.name}')
 
-                game_str = f"game: ({game_cell_i},{game_cell_j}) players: {players[0].name},{players[1].name},{players[2].name}"
-                logger.info(f"Playing {game_str}")
+        while not done:
 
-                for i, p in enumerate(players):
-                    logger.info(f'Player {i+1} = {p.name}')
+            current_player = players[env.current_player_num]
+            env.render()
+            logger.info(f'\nCurrent player name: {current_player.name}')
 
-                while not done:
+            logger.info(f'\n{current_player.name} model choices')
+                               
+            action = current_player.choose_action(env, choose_best_action = args.best, mask_invalid_actions = True)
 
-                    current_player = players[env.current_player_num]
-                    env.render()
-                    logger.info(f'\nCurrent player name: {current_player.name}')
+            obs, reward, done, _ = env.step(action)
 
-                    logger.info(f'\n{current_player.name} model choices')
-                                       
-                    action = current_player.choose_action(env, choose_best_action = args.best, mask_invalid_actions = True)
+            for r, player in zip(reward, players):
+                player.points += r
+    
+        env.render()
 
-                    obs, reward, done, _ = env.step(action)
+        game_rows.append(results_row(agents, game_str, k, 0, seats = [order.index(m) for m in range(len(agents))]))
 
-                    for r, player in zip(reward, players):
-                        total_rewards[player.id] += r
-                        player.points += r
-            
-                env.render()
+        for agent, p in zip(agents, player_total_scores):
+            p.scores.append(agent.points)
+    
+    # mean scoring for this set of tournament games
+    for i, p in enumerate(player_total_scores):
+        p.mean_score = mean(p.scores)
+
+    return tournament_row(game_cell_i, game_cell_j, player_total_scores), game_rows
+
+
+def play_cell_lockstep(envs, ppo_models, game_cell_i, game_cell_j, args, match = 0):
+    # the same games as play_cell, but all played at once, one env each, so that at every ply the games
+    # waiting on the same model are evaluated in a single batch
+    agents = cell_agents(ppo_models, game_cell_i, game_cell_j, args)
+
+    game_str = game_name(game_cell_i, game_cell_j, [a.name for a in agents])
+    logger.info(f"Playing {len(envs)} games of {game_str}")
+
+    orders = [list(seat_order(k, env.n_players)) for k, env in enumerate(envs)]
+    for k, env in enumerate(envs):
+        seed_game(args, match, k)
+        env.reset()
+    points = np.zeros((len(envs), len(agents)))
+    pending = list(range(len(envs)))
+
+    while pending:
+        batches = OrderedDict()
+        for k in pending:
+            agent = agents[orders[k][envs[k].current_player_num]]
+            key = id(agent) if agent.model is None else id(agent.model)
+            batches.setdefault(key, []).append(k)
+
+        done_games = set()
+        for batch in batches.values():
+            agent = agents[orders[batch[0]][envs[batch[0]].current_player_num]]
+            actions = agent.choose_actions([envs[k] for k in batch], choose_best_action = args.best, mask_invalid_actions = True)
+            for k, action in zip(batch, actions):
+                _, reward, done, _ = envs[k].step(action)
+                points[k, orders[k][:len(reward)]] += reward
+                if done:
+                    done_games.add(k)
+
+        pending = [k for k in pending if k not in done_games]
+
+    game_rows = []
+    for k in range(len(envs)):
+        for agent, agent_points in zip(agents, points[k]):
+            agent.points = agent_points
+        game_rows.append(results_row(agents, game_str, k, 0, seats = [orders[k].index(m) for m in range(len(agents))]))
+
+    player_total_scores = []
+    for p, agent in enumerate(agents):
+        score = PlayerScore(agent.name)
+        score.scores = list(points[:, p])
+        score.mean_score = mean(score.scores)
+        player_total_scores.append(score)
+
+    return tournament_row(game_cell_i, game_cell_j, player_total_scores), game_rows
+
+
+def make_envs(args):
+    # one env per game when the games of a cell are played in lockstep
+    n_envs = args.games if args.lockstep else 1
+    return [get_environment(args.env_name)(verbose = args.verbose, manual = args.manual) for _ in range(n_envs)]
+
+def run_cell(envs, ppo_models, game_cell_i, game_cell_j, args, match = 0):
+    if args.lockstep:
+        return play_cell_lockstep(envs, ppo_models, game_cell_i, game_cell_j, args, match)
+    return play_cell(envs[0], ppo_models, game_cell_i, game_cell_j, args, match)
+
+
+class Ratings():
+    # Glicko ratings of the models, updated after every game from the result between models i and j, whichever
+    # seats they played from - the copy of base is part of the conditions, as in the round-robin heatmap
+    Q = math.log(10) / 400
+
+    def __init__(self, n, rating = 1500, rd = 350):
+        self.rating = np.full(n, float(rating))
+        self.rd = np.full(n, float(rd))
+        self.games = np.zeros(n, dtype = int)
+
+    def g(self, rd):
+        return 1 / np.sqrt(1 + 3 * self.Q ** 2 * rd ** 2 / math.pi ** 2)
+
+    def expected(self, rating, opponent_rating, opponent_rd):
+        return 1 / (1 + 10 ** (-self.g(opponent_rd) * (rating - opponent_rating) / 400))
+
+    def update(self, i, j, score):
+        # score is 1 if i beat j, 0.5 for a draw and 0 if j won
+        updates = []
+        for a, b, s in ((i, j, score), (j, i, 1 - score)):
+            g = self.g(self.rd[b])
+            e = self.expected(self.rating[a], self.rating[b], self.rd[b])
+            precision = 1 / self.rd[a] ** 2 + self.Q ** 2 * g ** 2 * e * (1 - e)
+            updates.append((a, self.rating[a] + self.Q / precision * g * (s - e), math.sqrt(1 / precision)))
+        for a, rating, rd in updates:
+            self.rating[a], self.rd[a] = rating, rd
+            self.games[a] += 1
+
+    def next_pairing(self):
+        # the pair whose next result says the most: both uncertain and evenly matched
+        combined_rd = np.sqrt(self.rd[:, None] ** 2 + self.rd[None, :] ** 2)
+        e = self.expected(self.rating[:, None], self.rating[None, :], combined_rd)
+        information = combined_rd ** 2 * e * (1 - e)
+        np.fill_diagonal(information, -np.inf)
+        return np.unravel_index(np.argmax(information), information.shape)
+
+
+def rate_models(envs, ppo_models, args, all_results):
+    # matches of args.games games between the most informative pairing each time, until every model's rating
+    # deviation is below args.target_rd, rather than every cell of the round robin
+    ratings = Ratings(len(ppo_models))
+    played = 0
+    for match in range(1, args.max_matches + 1):
+        if ratings.rd.max() < args.target_rd:
+            break
+        i, j = ratings.next_pairing()
+        _, game_rows = run_cell(envs, ppo_models, i, j, args, match)
+        for row in game_rows:
+            score = 1.0 if row['p0_points'] > row['p1_points'] else 0.5 if row['p0_points'] == row['p1_points'] else 0.0
+            ratings.update(i, j, score)
+            all_results.write(row)
+        played = match
+        logger.info(f"Match {match}: {ppo_models[i][1]} vs {ppo_models[j][1]}, largest rating deviation {ratings.rd.max():.1f}")
+
+    logger.info(f"Rated {len(ppo_models)} models in {played} matches")
+    return ratings
+
+
+# each worker process keeps its own environments, and its own copy of the models forked from the parent
+worker_envs = None
+worker_models = None
+worker_args = None
+
+def init_worker(ppo_models, args):
+    global worker_envs, worker_models, worker_args
+    worker_envs = make_envs(args)
+    worker_models = ppo_models
+    worker_args = args
+
+def play_cell_in_worker(cell):
+    return run_cell(worker_envs, worker_models, cell[0], cell[1], worker_args)
 
-                write_results(all_results_filename, players, game_str, k, 0)
 
-                for i, p in enumerate(player_total_scores):
-                    p.scores.append(players[i].points)
-            
-            # write mean scoring for this set of tournament games
-            for i, p in enumerate(player_total_scores):
-                p.mean_score = mean(p.scores)
+def main(args):
 
-            write_tournament_results(tournament_results_filename, game_cell_i, game_cell_j, player_total_scores)
+    logger.configure(config.LOGDIR)
 
+    if args.debug:
+        logger.set_level(config.DEBUG)
+    else:
+        logger.set_level(config.INFO)
+        
+    #make environment
+    envs = make_envs(args)
+    env = envs[0]
+    env.seed(args.seed)
+    set_global_seeds(args.seed)
+
+    #load the agents
+    ppo_models = load_all_models_with_names(env, start=args.start, stop=args.stop, step=args.step)
+    total_agents = len(ppo_models)
+    print(f"Loaded {total_agents} models in total.")
+
+    if args.ratings:
+        all_results = ResultsWriter(f"{config.RESULTSPATH}/{args.output}-all-results.{args.format}", append = False)
+        ratings = rate_models(envs, ppo_models, args, all_results)
+        all_results.close()
+
+        with ResultsWriter(f"{config.RESULTSPATH}/{args.output}-ratings.{args.format}", append = False) as ratings_results:
+            for k in np.argsort(-ratings.rating):
+                ratings_results.write(OrderedDict([('model', ppo_models[k][1]), ('rating', ratings.rating[k]), ('rd', ratings.rd[k]), ('games', ratings.games[k])]))
+        env.close()
+        return
+
+    cache = TournamentCache(f"{config.RESULTSPATH}/{args.output}-cache.jsonl", fresh = args.fresh)
+
+    #play all agents against each other, apart from the cells already in the cache
+    cells = [(game_cell_i, game_cell_j) for game_cell_i in range(total_agents) for game_cell_j in range(total_agents)]
+    keys = {cell: cell_key(env, ppo_models, cell[0], cell[1], args) for cell in cells}
+    new_cells = [cell for cell in cells if cache.get(keys[cell]) is None]
+    logger.info(f"{len(cells) - len(new_cells)} of {len(cells)} cells already played, playing the other {len(new_cells)}")
+
+    if args.n_workers > 1:
+        # forked, so the workers share the parent's memory-mapped model parameters rather than loading their own
+        pool = multiprocessing.get_context('fork').Pool(args.n_workers, initializer = init_worker, initargs = (ppo_models, args))
+        results = pool.imap(play_cell_in_worker, new_cells)
+    else:
+        pool = None
+        results = (run_cell(envs, ppo_models, game_cell_i, game_cell_j, args) for game_cell_i, game_cell_j in new_cells)
+
+    for cell, (cell_row, game_rows) in zip(new_cells, results):
+        cache.add(keys[cell], cell_row, game_rows)
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+    cache.close()
+
+    # the whole matrix is written out again, with the positions of the models in this run
+    all_results = ResultsWriter(f"{config.RESULTSPATH}/{args.output}-all-results.{args.format}", append = False)
+    tournament_results = ResultsWriter(f"{config.RESULTSPATH}/{args.output}-tournament-results.{args.format}", append = False)
+    logger.info(f"Writing tournament result file: {tournament_results.filename}")
+
+    for game_cell_i, game_cell_j in cells:
+        cell_row, game_rows = cache.get(keys[(game_cell_i, game_cell_j)])
+        game_str = game_name(game_cell_i, game_cell_j, cell_names(ppo_models, game_cell_i, game_cell_j))
+        for row in game_rows:
+            all_results.write(dict(row, game = game_str))
+        tournament_results.write(dict(cell_row, x = game_cell_i, y = game_cell_j))
+
+    all_results.close()
+    tournament_results.close()
     env.close()
 
 def cli() -> None:
@@ -153,6 +367,22 @@ def cli() -> None:
             , help="Which game to play?")
     parser.add_argument("--output", "-o",  type = str, default = 'tournament_results'
             , help="Outfile file root (don't add extension) for results")
+    parser.add_argument("--format", "-f",  type = str, default = 'csv'
+            , help="csv / parquet - the format of the results files (parquet needs pyarrow)")
+    parser.add_argument("--backend", "-bk", type = str, default = 'tf'
+            , help="tf / numpy - how the agent policies are evaluated")
+    parser.add_argument("--lockstep", "-ls",  action = 'store_true', default = False
+            , help="Play all the games of a cell at once, evaluating each model once per ply across the games")
+    parser.add_argument("--fresh", "-fr",  action = 'store_true', default = False
+            , help="Play every cell again, rather than reusing the cells cached by earlier runs with the same output name")
+    parser.add_argument("--ratings", "-ra",  action = 'store_true', default = False
+            , help="Rate the models from adaptively chosen matches instead of playing the full round robin")
+    parser.add_argument("--target_rd", "-rd",  type = float, default = 50
+            , help="With --ratings, stop once every model's rating deviation is below this")
+    parser.add_argument("--max_matches", "-mm",  type = int, default = 10000
+            , help="With --ratings, the most matches (of --games games each) to play")
+    parser.add_argument("--n_workers", "-nw", type = int, default = 1
+            , help="How many processes to play the tournament cells in")
     # Extract args
     args = parser.parse_args()
 
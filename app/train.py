@@ -21,9 +21,10 @@ from stable_baselines.common import set_global_seeds
 from stable_baselines import logger
 
 from utils.callbacks import SelfPlayCallback
-from utils.files import reset_logs, reset_models
-from utils.register import get_network_arch, get_environment
-from utils.selfplay import selfplay_wrapper
+from utils.files import reset_logs, reset_models, model_pool
+from utils.register import get_network_arch, get_environment, get_batch_environment
+from utils.selfplay import selfplay_wrapper, selfplay_vec_wrapper, SelfPlayBatchVecEnv
+from utils.workers import SubprocSelfPlayVecEnv, VecPPO1
 
 import config
 
@@ -54,10 +55,30 @@ def main(args):
   workerseed = args.seed + 10000 * MPI.COMM_WORLD.Get_rank()
   set_global_seeds(workerseed)
 
+  model_pool.max_memory = args.pool_memory * 1024 ** 2
+
   logger.info('\nSetting up the selfplay training environment opponents...')
   base_env = get_environment(args.env_name)
-  env = selfplay_wrapper(base_env)(opponent_type = args.opponent_type, verbose = args.verbose)
-  env.seed(workerseed)
+  if rank == 0:
+    # creates base.zip if it doesn't exist yet, before the other ranks look for it
+    model_pool.get(base_env(verbose = args.verbose), 'base.zip')
+  MPI.COMM_WORLD.Barrier()
+
+  if args.n_workers > 0:
+    env = SubprocSelfPlayVecEnv(base_env, opponent_type = args.opponent_type, verbose = args.verbose
+      , n_workers = args.n_workers, games_per_worker = args.worker_games, seed = workerseed, backend = args.backend)
+    Model = VecPPO1
+  elif args.batch_games > 0:
+    env = SelfPlayBatchVecEnv(base_env, get_batch_environment(args.env_name), opponent_type = args.opponent_type, verbose = args.verbose
+      , n_envs = args.batch_games, backend = args.backend)
+    Model = VecPPO1
+  elif args.n_envs > 1:
+    env = selfplay_vec_wrapper(base_env)(opponent_type = args.opponent_type, verbose = args.verbose, n_envs = args.n_envs, backend = args.backend)
+    Model = VecPPO1
+  else:
+    env = selfplay_wrapper(base_env)(opponent_type = args.opponent_type, verbose = args.verbose, backend = args.backend)
+    env.seed(workerseed)
+    Model = PPO1
 
   
   CustomPolicy = get_network_arch(args.env_name)
@@ -76,22 +97,13 @@ def main(args):
       , 'tensorboard_log':config.LOGDIR
   }
 
-  time.sleep(5) # allow time for the base model to be saved out when the environment is created
-
-  if args.reset or not os.path.exists(os.path.join(model_dir, 'best_model.zip')):
-    logger.info('\nLoading the base PPO agent to train...')
-    model = PPO1.load(os.path.join(model_dir, 'base.zip'), env, **params)
-  else:
-    logger.info('\nLoading the best_model.zip PPO agent to continue training...')
-    model = PPO1.load(os.path.join(model_dir, 'best_model.zip'), env, **params)
-
-  #Callbacks
+  #Callbacks - set up before the model is loaded, so that the evaluation worker is forked before there is a TensorFlow session
   logger.info('\nSetting up the selfplay evaluation environment opponents...')
   callback_args = {
-    'eval_env': selfplay_wrapper(base_env)(opponent_type = args.opponent_type, verbose = args.verbose),
+    'eval_env': selfplay_wrapper(base_env)(opponent_type = args.opponent_type, verbose = args.verbose, backend = args.backend),
     'best_model_save_path' : config.TMPMODELDIR,
     'log_path' : config.LOGDIR,
-    'eval_freq' : args.eval_freq,
+    'eval_freq' : max(args.eval_freq // getattr(env, 'num_envs', 1), 1), # the callback is called once per move across all the training games
     'n_eval_episodes' : args.n_eval_episodes,
     'deterministic' : False,
     'render' : True,
@@ -102,7 +114,7 @@ def main(args):
     logger.info('\nSetting up the evaluation environment against the rules-based agent...')
     # Evaluate against a 'rules' agent as well
     eval_actual_callback = EvalCallback(
-      eval_env = selfplay_wrapper(base_env)(opponent_type = 'rules', verbose = args.verbose),
+      eval_env = selfplay_wrapper(base_env)(opponent_type = 'rules', verbose = args.verbose, backend = args.backend),
       eval_freq=1,
       n_eval_episodes=args.n_eval_episodes,
       deterministic = args.best,
@@ -112,7 +124,14 @@ def main(args):
     callback_args['callback_on_new_best'] = eval_actual_callback
     
   # Evaluate the agent against previous versions
-  eval_callback = SelfPlayCallback(args.opponent_type, args.threshold, args.env_name, **callback_args)
+  eval_callback = SelfPlayCallback(args.opponent_type, args.threshold, args.env_name, early_stop_z = args.early_stop_z, **callback_args)
+
+  if args.reset or not os.path.exists(os.path.join(model_dir, 'best_model.zip')):
+    logger.info('\nLoading the base PPO agent to train...')
+    model = Model.load(os.path.join(model_dir, 'base.zip'), env, **params)
+  else:
+    logger.info('\nLoading the best_model.zip PPO agent to continue training...')
+    model = Model.load(os.path.join(model_dir, 'best_model.zip'), env, **params)
 
   logger.info('\nSetup complete - commencing learning...\n')
 
@@ -155,6 +174,20 @@ def cli() -> None:
             , help="How many episodes should each actor contirbute to the evaluation of the agent")
   parser.add_argument("--threshold", "-t",  type = float, default = 0.2
             , help="What score must the agent achieve during evaluation to 'beat' the previous version?")
+  parser.add_argument("--early_stop_z", "-ez",  type = float, default = 0
+            , help="Stop an evaluation once the mean reward over all actors is clearly above or below the threshold, at the two-sided significance of this many standard errors (e.g. 3) Bonferroni-corrected across the checks - 0 plays every episode")
+  parser.add_argument("--backend", "-bk", type = str, default = 'tf'
+              , help="tf / numpy - how the opponent policies are evaluated")
+  parser.add_argument("--n_workers", "-nw",  type = int, default = 0
+            , help="How many subprocesses each actor uses to play its training games (0 plays a single game in the actor itself)")
+  parser.add_argument("--worker_games", "-wg",  type = int, default = 1
+            , help="How many training games each subprocess plays at once, with the opponent moves across them evaluated in one batch per model")
+  parser.add_argument("--batch_games", "-bg",  type = int, default = 0
+            , help="How many training games each actor plays at once with the environment's batched simulator, when there are no subprocesses (0 doesn't use it)")
+  parser.add_argument("--n_envs", "-nv",  type = int, default = 1
+            , help="How many training games each actor plays at once, with the opponent moves across them evaluated in one batch per model, when there are no subprocesses or batched simulator (1 plays a single game)")
+  parser.add_argument("--pool_memory", "-pm",  type = int, default = config.MODEL_POOL_MEMORY
+            , help="How many MB of opponent model parameters each actor keeps loaded before evicting the least recently used")
   parser.add_argument("--gamma", "-g",  type = float, default = 0.99
             , help="The value of gamma in PPO")
   parser.add_argument("--timesteps_per_actorbatch", "-tpa",  type = int, default = 1024
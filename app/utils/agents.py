@@ -6,6 +6,8 @@ import string
 
 import config
 
+from utils.inference import NumpyPolicy
+
 from stable_baselines import logger
 
 def sample_action(action_probs):
@@ -23,13 +25,30 @@ def mask_actions(legal_actions, action_probs):
 
 
 class Agent():
-  def __init__(self, name, model = None):
+  def __init__(self, name, model = None, backend = 'tf'):
       self.name = name
       self.id = self.name + '_' + ''.join(random.choice(string.ascii_lowercase) for x in range(5))
       self.model = model
+      self.backend = backend
       self.points = 0
 
+  def policy(self, env):
+      # tf evaluates the model's own policy network, numpy a NumPy copy of it built from the model parameters
+      if self.backend == 'numpy':
+        if getattr(self.model, 'numpy_policy', None) is None:
+          # kept on the model, so that it is only built once for all the agents that play with it
+          self.model.numpy_policy = NumpyPolicy(env, self.model.get_parameters())
+        return self.model.numpy_policy
+      return self.model.policy_pi
+
+  def evaluate(self, env, observations):
+      # action probabilities from a single run of the policy, which only evaluates the value head as well
+      # when debug logging is on, as the values are only logged
+      return self.policy(env).proba_value(observations, value = logger.get_level() <= config.DEBUG)
+
   def print_top_actions(self, action_probs):
+    if logger.get_level() > config.DEBUG:
+      return
     top5_action_idx = np.argsort(-action_probs)[:5]
     top5_actions = action_probs[top5_action_idx]
     logger.debug(f"Top 5 actions: {[str(i) + ': ' + str(round(a,2))[:5] for i,a in zip(top5_action_idx, top5_actions)]}")
@@ -39,10 +58,26 @@ class Agent():
         action_probs = np.array(env.rules_move())
         value = None
       else:
-        action_probs = self.model.action_probability(env.observation)
-        value = self.model.policy_pi.value(np.array([env.observation]))[0]
-        logger.debug(f'Value {value:.2f}')
+        action_probs, values = self.evaluate(env, np.array([env.observation]))
+        action_probs = action_probs[0]
+        if values is not None:
+          logger.debug(f'Value {values[0]:.2f}')
+
+      return self.select_action(env, action_probs, choose_best_action, mask_invalid_actions)
+
+  def choose_actions(self, envs, choose_best_action, mask_invalid_actions):
+      # one action per env, with a single batched evaluation of the model across all of them
+      if self.name == 'rules':
+        return [self.choose_action(env, choose_best_action, mask_invalid_actions) for env in envs]
+
+      observations = np.array([env.observation for env in envs])
+      batch_action_probs, values = self.evaluate(envs[0], observations)
+      if values is not None:
+        logger.debug(f'Values {[round(float(v), 2) for v in values]}')
+
+      return [self.select_action(env, action_probs, choose_best_action, mask_invalid_actions) for env, action_probs in zip(envs, batch_action_probs)]
 
+  def select_action(self, env, action_probs, choose_best_action, mask_invalid_actions):
       self.print_top_actions(action_probs)
       
       if mask_invalid_actions:
@@ -0,0 +1,22 @@
+class GameStateCache():
+    # mixed into an environment that defines compute_observation and compute_legal_actions, so that each is
+    # worked out at most once per game state however often it is read. The environment calls clear_cache
+    # whenever step or reset changes the game state
+    cached_observation = None
+    cached_legal_actions = None
+
+    @property
+    def observation(self):
+        if self.cached_observation is None:
+            self.cached_observation = self.compute_observation()
+        return self.cached_observation
+
+    @property
+    def legal_actions(self):
+        if self.cached_legal_actions is None:
+            self.cached_legal_actions = self.compute_legal_actions()
+        return self.cached_legal_actions
+
+    def clear_cache(self):
+        self.cached_observation = None
+        self.cached_legal_actions = None
@@ -1,82 +1,298 @@
 import os
+import math
+import multiprocessing
 import numpy as np
-from shutil import copyfile
 from mpi4py import MPI
 
 from stable_baselines.common.callbacks import EvalCallback
+from stable_baselines.common.vec_env import VecEnv
 from stable_baselines import logger
 
-from utils.files import get_best_model_name, get_model_stats
+from utils.agents import Agent
+from utils.files import get_best_model_stats, get_manifest, model_record, publish_model
+from utils.inference import PolicyModel
 
 import config
 
+
+# the sequential test doesn't stop an evaluation before this many episodes have been played across all ranks
+MIN_SEQUENTIAL_EPISODES = 20
+# how many times the sequential test is run while an evaluation is in progress
+SEQUENTIAL_CHECKS = 10
+
+
+def bonferroni_z(z, looks):
+  # the z each look has to clear so that the chance of any of them stopping a two-sided test by mistake is
+  # no more than that of a single look at z, i.e. the alpha of z is split evenly across the looks
+  alpha = math.erfc(z / math.sqrt(2)) / looks
+  lo, hi = z, z + 10
+  for _ in range(100):
+    mid = (lo + hi) / 2
+    if math.erfc(mid / math.sqrt(2)) > alpha:
+      lo = mid
+    else:
+      hi = mid
+  return hi
+
+
+def play_episode(env, agent, deterministic):
+  env.reset()
+  done, episode_reward, episode_length = False, 0.0, 0
+  while not done:
+    action = agent.choose_action(env, choose_best_action = deterministic, mask_invalid_actions = False)
+    _, reward, done, _ = env.step(action)
+    episode_reward += reward
+    episode_length += 1
+  return episode_reward, episode_length
+
+
+def evaluation_worker(remote, parent_remote, eval_env, n_eval_episodes, deterministic, rules_env, n_rules_episodes, rules_deterministic):
+  # plays the evaluation games for each snapshot of the weights it is sent, with the numpy backend,
+  # so that it never touches the TensorFlow session or MPI of the training process it was forked from.
+  # Each episode is reported as soon as it's played, so the callback can stop the evaluation early
+  parent_remote.close()
+
+  level = logger.get_level()
+  logger.configure(format_strs=[])
+  logger.set_level(level)
+  np.random.seed()
+
+  eval_env.backend = 'numpy'
+  agent = None
+
+  try:
+    while True:
+      cmd, data = remote.recv()
+      if cmd == 'evaluate':
+        agent = Agent('ppo_agent', PolicyModel(eval_env, data), backend = 'numpy')
+        for _ in range(n_eval_episodes):
+          if remote.poll(): # the only message that can arrive mid evaluation is 'stop'
+            remote.recv()
+            break
+          remote.send(('episode', play_episode(eval_env, agent, deterministic)))
+        remote.send(('done', None))
+      elif cmd == 'add_opponent':
+        eval_env.add_opponent(data)
+      elif cmd == 'rules':
+        rewards = [play_episode(rules_env, agent, rules_deterministic)[0] for _ in range(n_rules_episodes)]
+        remote.send(('rules', rewards))
+      elif cmd == 'close':
+        break
+      # a 'stop' that arrives after the last episode has nothing left to stop
+  except KeyboardInterrupt:
+    pass
+  finally:
+    remote.close()
+    os._exit(0)
+
+
 class SelfPlayCallback(EvalCallback):
-  def __init__(self, opponent_type, threshold, env_name, *args, **kwargs):
+  # evaluates a snapshot of the weights every eval_freq steps in a background process while learning continues.
+  # The evaluation finishes at the next checkpoint, or earlier if the sequential test is on and the episodes
+  # pooled over every rank are clearly above or below the threshold - the snapshot is then promoted to a new
+  # generation if it beat the threshold. Ranks only exchange results at the same steps, so the allgathers line up
+  def __init__(self, opponent_type, threshold, env_name, *args, early_stop_z = 0, **kwargs):
     super(SelfPlayCallback, self).__init__(*args, **kwargs)
     self.opponent_type = opponent_type
+    self.env_name = env_name
     self.model_dir = os.path.join(config.MODELDIR, env_name)
-    self.generation, self.base_timesteps, pbmr, bmr = get_model_stats(get_best_model_name(env_name))
-
-    #reset best_mean_reward because this is what we use to extract the rewards from the latest evaluation by each agent
-    self.best_mean_reward = -np.inf
-    if self.callback is not None: #if evaling against rules-based agent as well, reset this too
-      self.callback.best_mean_reward = -np.inf
+    self.generation, self.base_timesteps, pbmr, bmr = get_best_model_stats(env_name)
 
     if self.opponent_type == 'rules':
       self.threshold = bmr # the threshold is the overall best evaluation by the agent against a rules-based agent
     else:
       self.threshold = threshold # the threshold is a constant
 
+    self.early_stop_z = early_stop_z # 0 always plays every episode
+    # the test is run up to SEQUENTIAL_CHECKS times per evaluation, so each look uses a Bonferroni bound
+    self.look_z = bonferroni_z(early_stop_z, SEQUENTIAL_CHECKS) if early_stop_z > 0 else 0
+    self.check_freq = max(self.eval_freq // SEQUENTIAL_CHECKS, 1)
+
+    self.remote = None
+    self.process = None
+    self.eval_timesteps = None # the timesteps of the snapshot being evaluated, None when there isn't one
+    self.eval_done = True
+    self.episode_rewards = []
+    self.episode_lengths = []
+    self.start_worker()
+
+
+  def start_worker(self):
+    # forked rather than spawned, so that it gets its own copy of the evaluation environments as they are.
+    # The callback is created before the model is loaded, so there is no TensorFlow session to inherit yet
+    rules_env, n_rules_episodes, rules_deterministic = None, 0, False
+    if self.callback is not None: # evaluating against the rules-based agent as well
+      rules_env, n_rules_episodes, rules_deterministic = self.callback.eval_env.envs[0], self.callback.n_eval_episodes, self.callback.deterministic
+
+    ctx = multiprocessing.get_context('fork')
+    self.remote, work_remote = ctx.Pipe(duplex = True)
+    args = (work_remote, self.remote, self.eval_env.envs[0], self.n_eval_episodes, self.deterministic, rules_env, n_rules_episodes, rules_deterministic)
+    self.process = ctx.Process(target = evaluation_worker, args = args, daemon = True)
+    self.process.start()
+    work_remote.close()
+
+
+  def start_evaluation(self):
+    if MPI.COMM_WORLD.Get_rank() == 0:
+      # the file copied to the model directory if this snapshot is promoted
+      self.model.save(os.path.join(config.TMPMODELDIR, 'best_model'))
+
+    self.eval_timesteps = self.num_timesteps
+    self.eval_done = False
+    self.episode_rewards = []
+    self.episode_lengths = []
+    if not self.process.is_alive():
+      # no episodes from this rank, but it still takes part in the allgathers of the other ranks
+      logger.error('The evaluation worker has stopped, so this snapshot is only evaluated by the other ranks')
+      self.eval_done = True
+      return
+    self.remote.send(('evaluate', self.model.get_parameters()))
+
+
+  def receive_episodes(self, block = False):
+    # reads the episodes the worker has played so far, or waits for all of them
+    while not self.eval_done and (block or self.remote.poll()):
+      try:
+        msg, result = self.remote.recv()
+      except (EOFError, ConnectionResetError):
+        logger.error('The evaluation worker stopped in the middle of an evaluation')
+        self.eval_done = True
+        break
+      if msg == 'episode':
+        self.episode_rewards.append(result[0])
+        self.episode_lengths.append(result[1])
+      else:
+        self.eval_done = True
+
+
+  def gather_episodes(self):
+    # count, sum and sum of squares of the episode rewards over every rank, and whether every rank has finished
+    stats = MPI.COMM_WORLD.allgather((len(self.episode_rewards), np.sum(self.episode_rewards), np.sum(np.square(self.episode_rewards)), self.eval_done))
+    n, total, total_sq, done = zip(*stats)
+    return np.sum(n), np.sum(total), np.sum(total_sq), all(done)
+
+
+  def sequential_test(self, n, total, total_sq):
+    # True / False once the mean reward is more than look_z standard errors above / below the threshold
+    if n < MIN_SEQUENTIAL_EPISODES:
+      return None
+    mean = total / n
+    half_width = self.look_z * np.sqrt(max(total_sq / n - mean ** 2, 0) / n)
+    if mean - half_width > self.threshold:
+      return True
+    if mean + half_width < self.threshold:
+      return False
+    return None
+
+
+  def finish_evaluation(self, n, total, total_sq, promote = None):
+    # promote is None to decide from the mean reward over all the episodes
+    if not self.eval_done:
+      if self.process.is_alive():
+        self.remote.send(('stop', None))
+      self.receive_episodes(block = True)
+    eval_timesteps, self.eval_timesteps = self.eval_timesteps, None
+
+    if self.log_path is not None:
+      self.evaluations_timesteps.append(eval_timesteps)
+      self.evaluations_results.append(self.episode_rewards)
+      self.evaluations_length.append(self.episode_lengths)
+      np.savez(self.log_path, timesteps=self.evaluations_timesteps,
+                results=self.evaluations_results, ep_lengths=self.evaluations_length)
+
+    if n == 0:
+      # no worker played an episode, so there is nothing to promote on
+      logger.error(f'No evaluation episodes were played for timesteps={eval_timesteps}, so the snapshot is not promoted')
+      return
+
+    av_reward = total / n
+    if promote is None:
+      promote = av_reward > self.threshold
+    std_reward = np.sqrt(max(total_sq / n - av_reward ** 2, 0))
+    self.last_mean_reward = av_reward
+
+    rank = MPI.COMM_WORLD.Get_rank()
+    if rank == 0:
+      logger.info("Eval num_timesteps={}, episode_reward={:.2f} +/- {:.2f}".format(eval_timesteps, av_reward, std_reward))
+      logger.info("Total episodes ran={}".format(n))
+
+    if promote:
+      self.generation += 1
+
+      if self.callback is not None: # the rules-based evaluation is only played for a new best model
+        rules_reward = np.nan
+        if self.process.is_alive():
+          self.remote.send(('rules', None))
+          _, rules_rewards = self.remote.recv()
+          rules_reward = np.mean(rules_rewards)
+        av_rules_based_reward = np.nanmean(MPI.COMM_WORLD.allgather(rules_reward))
+
+      model_name = None
+      if rank == 0: #write new files
+        logger.info(f"New best model: {self.generation}\n")
+
+        generation_str = str(self.generation).zfill(5)
+        av_rewards_str = str(round(av_reward,3))
+
+        if self.callback is not None:
+          av_rules_based_reward_str = str(round(av_rules_based_reward,3))
+        else:
+          av_rules_based_reward_str = str(0)
+
+        source_file = os.path.join(config.TMPMODELDIR, f"best_model.zip") # the snapshot that was evaluated - not actually the best model
+        model_name = f"_model_{generation_str}_{av_rules_based_reward_str}_{av_rewards_str}_{str(self.base_timesteps + eval_timesteps)}_.zip"
+        publish_model(source_file, self.model_dir, model_name)
+        publish_model(source_file, self.model_dir, f"best_model.zip")
+
+        # indexed last, so that every generation in the manifest already has its file
+        get_manifest(self.env_name).add(model_record(model_name, self.generation, self.base_timesteps + eval_timesteps
+          , float(av_rules_based_reward_str), float(av_rewards_str)))
+
+      # the file is complete by now, so every rank can add the new generation to its opponents straight away
+      self.add_opponent(MPI.COMM_WORLD.bcast(model_name, root = 0))
+
+      # if playing against a rules based agent, update the global best reward to the improved metric
+      if self.opponent_type == 'rules':
+        self.threshold  = av_reward
+
+
+  def add_opponent(self, model_name):
+    if isinstance(self.training_env, VecEnv):
+      self.training_env.env_method('add_opponent', model_name)
+    else:
+      self.training_env.add_opponent(model_name)
+    # after the current evaluation, so the worker picks it up before the next one
+    if self.process.is_alive():
+      self.remote.send(('add_opponent', model_name))
+
 
   def _on_step(self) -> bool:
 
     if self.eval_freq > 0 and self.n_calls % self.eval_freq == 0:
+      # the previous evaluation has had eval_freq steps to finish, so this rarely waits
+      if self.eval_timesteps is not None:
+        self.receive_episodes(block = True)
+        n, total, total_sq, _ = self.gather_episodes()
+        self.finish_evaluation(n, total, total_sq)
+      self.start_evaluation()
+
+    elif self.eval_timesteps is not None and self.n_calls % self.check_freq == 0:
+      # also keeps the pipe drained, so the worker is never left waiting to report an episode
+      self.receive_episodes()
+      if self.early_stop_z > 0:
+        n, total, total_sq, done = self.gather_episodes()
+        promote = self.sequential_test(n, total, total_sq)
+        if promote is not None or done:
+          self.finish_evaluation(n, total, total_sq, promote)
+
+    return True
+
 
-      result = super(SelfPlayCallback, self)._on_step() #this will set self.best_mean_reward to the reward from the evaluation as it's previously -np.inf
-
-      list_of_rewards = MPI.COMM_WORLD.allgather(self.best_mean_reward)
-      av_reward = np.mean(list_of_rewards)
-      std_reward = np.std(list_of_rewards)
-      av_timesteps = np.mean(MPI.COMM_WORLD.allgather(self.num_timesteps))
-      total_episodes = np.sum(MPI.COMM_WORLD.allgather(self.n_eval_episodes))
-
-      if self.callback is not None:
-        rules_based_rewards = MPI.COMM_WORLD.allgather(self.callback.best_mean_reward)
-        av_rules_based_reward = np.mean(rules_based_rewards)
-
-      rank = MPI.COMM_WORLD.Get_rank()
-      if rank == 0:
-        logger.info("Eval num_timesteps={}, episode_reward={:.2f} +/- {:.2f}".format(self.num_timesteps, av_reward, std_reward))
-        logger.info("Total episodes ran={}".format(total_episodes))
-
-      #compare the latest reward against the threshold
-      if result and av_reward > self.threshold:
-        self.generation += 1
-        if rank == 0: #write new files
-          logger.info(f"New best model: {self.generation}\n")
-
-          generation_str = str(self.generation).zfill(5)
-          av_rewards_str = str(round(av_reward,3))
-
-          if self.callback is not None:
-            av_rules_based_reward_str = str(round(av_rules_based_reward,3))
-          else:
-            av_rules_based_reward_str = str(0)
-          
-          source_file = os.path.join(config.TMPMODELDIR, f"best_model.zip") # this is constantly being written to - not actually the best model
-          target_file = os.path.join(self.model_dir,  f"_model_{generation_str}_{av_rules_based_reward_str}_{av_rewards_str}_{str(self.base_timesteps + self.num_timesteps)}_.zip")
-          copyfile(source_file, target_file)
-          target_file = os.path.join(self.model_dir,  f"best_model.zip")
-          copyfile(source_file, target_file)
-
-        # if playing against a rules based agent, update the global best reward to the improved metric
-        if self.opponent_type == 'rules':
-          self.threshold  = av_reward
-        
-      #reset best_mean_reward because this is what we use to extract the rewards from the latest evaluation by each agent
-      self.best_mean_reward = -np.inf
-
-      if self.callback is not None: #if evaling against rules-based agent as well, reset this too
-        self.callback.best_mean_reward = -np.inf
-
-    return True
\ No newline at end of file
+  def _on_training_end(self) -> None:
+    if self.process is not None and self.process.is_alive():
+      if not self.eval_done:
+        self.remote.send(('stop', None))
+        self.receive_episodes(block = True)
+      self.remote.send(('close', None))
+      self.process.join()
+      self.process = None
@@ -1,84 +1,188 @@
 
 
 import os
+import re
 import sys
 import random
 import csv
+import json
+import mmap
+import struct
 import time
 import numpy as np
 import math
 
 from mpi4py import MPI
 
-from shutil import rmtree
+from shutil import rmtree, copyfile
 from stable_baselines.ppo1 import PPO1
 from stable_baselines.common.policies import MlpPolicy
+from stable_baselines.common.base_class import BaseRLModel
 
 from collections import OrderedDict
 
 from utils.register import get_network_arch
+from utils.inference import PolicyModel
 
 import config
 
 from stable_baselines import logger
 
-def write_tournament_results(filename, x, y, scores):
+TOURNAMENT_FIELDNAMES = ['x', 'y', 'model0', 'score0', 'model1', 'score1', 'model2', 'score2']
 
-    fieldnames = OrderedDict([('x', None), ('y', None), ('model0', None), ('score0', None), ('model1', None), ('score1', None), ('model2', None), ('score2', None)])
-    out = { 'x': x, 'y': y}
-    
+def tournament_row(x, y, scores):
+    out = OrderedDict((field, None) for field in TOURNAMENT_FIELDNAMES)
+    out['x'], out['y'] = x, y
     for i, p in enumerate(scores):
         out[f'model{i}'] = p.name
         out[f'score{i}'] = p.mean_score
+    return out
 
-    resultsfile = f"{config.RESULTSPATH}/{filename}"
-
-    logger.info(f"Writing tournament result file: {resultsfile}")
-
-    if not os.path.exists(resultsfile):
-        with open(resultsfile,'a') as csvfile:
-            writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-            writer.writeheader()
-
-    with open(resultsfile,'a') as csvfile:
-        writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-        writer.writerow(out)
-
-def write_results(filename, players, game, games, episode_length):
-    
-    out = {'game': game
-    , 'games': games
-    , 'episode_length': episode_length }
-
+def results_row(players, game, games, episode_length, seats = None):
+    # seats: the seat each player played from, when the players aren't listed in seat order
+    out = OrderedDict([('game', game), ('games', games), ('episode_length', episode_length)])
     for i, p in enumerate(players):
         out[f'p{i}'] = p.name
         out[f'p{i}_points'] = p.points
-
-    resultsfile = f"{config.RESULTSPATH}/{filename}"
-
-    if not os.path.exists(config.RESULTSPATH):
-        with open(resultsfile,'a') as csvfile:
-            writer = csv.DictWriter(csvfile, fieldnames=out.keys())
-            writer.writeheader()
-
-    with open(resultsfile,'a') as csvfile:
-        writer = csv.DictWriter(csvfile, fieldnames=out.keys())
-        writer.writerow(out)
+        if seats is not None:
+            out[f'p{i}_seat'] = seats[i]
+    return out
+
+
+# the results columns that are always written as floats - points and scores start as the int 0, which a player who
+# never scores keeps, so their type would otherwise depend on the games played
+FLOAT_FIELDS = re.compile(r'^(p\d+_points|score\d+|rating|rd)$')
+
+class ResultsWriter():
+    # keeps a results file open and writes its rows in batches, rather than reopening the file for every game.
+    # Appends to a CSV (or replaces it, with append=False), or writes a new Parquet file (one row group per
+    # batch, needs pyarrow) when the filename ends in .parquet, which draw_tournament_results.py reads
+    # without parsing any text. A file started from scratch is made under a temporary name and renamed over
+    # the old one, rather than truncating it, so that a reader can tell it is a new file by its inode
+    def __init__(self, filename, batch_size = 100, append = True):
+        self.filename = filename
+        self.batch_size = batch_size
+        self.append = append
+        self.parquet = filename.endswith('.parquet')
+        self.rows = []
+        self.file = None
+        self.writer = None
+        # one type per column, so every run writes the same CSV values and Parquet schema, see column_type
+        self.types = {}
+
+    def column_type(self, field):
+        if field not in self.types:
+            self.types[field] = float if FLOAT_FIELDS.match(field) else None
+        return self.types[field]
+
+    def convert(self, field, value):
+        column_type = self.column_type(field)
+        if column_type is not None and value is not None:
+            return column_type(value)
+        # numpy scalars are written as the matching Python numbers
+        return value.item() if isinstance(value, np.generic) else value
+
+    def write(self, row):
+        self.rows.append(OrderedDict((field, self.convert(field, value)) for field, value in row.items()))
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if len(self.rows) == 0:
+            return
+        if self.parquet:
+            self.write_parquet()
+        else:
+            self.write_csv()
+        self.rows = []
+
+    def write_csv(self):
+        if self.writer is None:
+            new_file = not self.append or not os.path.exists(self.filename) or os.path.getsize(self.filename) == 0
+            if new_file:
+                self.file = open(self.tmp_filename(), 'w', newline='')
+                os.replace(self.tmp_filename(), self.filename)
+            else:
+                self.file = open(self.filename, 'a', newline='')
+            self.writer = csv.DictWriter(self.file, fieldnames=list(self.rows[0].keys()))
+            if new_file:
+                self.writer.writeheader()
+        self.writer.writerows(self.rows)
+        self.file.flush()
+
+    def write_parquet(self):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        columns = OrderedDict((field, [row.get(field) for row in self.rows]) for field in self.rows[0].keys())
+        table = pa.Table.from_pydict(columns)
+        if self.writer is None:
+            # renamed into place when it is closed, as it can't be read before then
+            self.writer = pq.ParquetWriter(self.tmp_filename(), table.schema)
+        else:
+            table = table.cast(self.writer.schema)
+        self.writer.write_table(table)
+
+    def tmp_filename(self):
+        return f'{self.filename}.{os.getpid()}.tmp'
+
+    def close(self):
+        self.flush()
+        if self.parquet and self.writer is not None:
+            self.writer.close()
+            os.replace(self.tmp_filename(), self.filename)
+        if self.file is not None:
+            self.file.close()
+        self.file = None
+        self.writer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class TournamentCache():
+    # the rows of every tournament cell played so far, keyed by everything that decides its outcome, so that a
+    # rerun only plays the cells it hasn't seen (new generations, or the rest of an interrupted run).
+    # Each cell is appended as a JSON line as soon as it has been played
+    def __init__(self, filename, fresh = False):
+        self.filename = filename
+        self.cells = {}
+        if fresh and os.path.exists(filename):
+            # emptied under a new inode rather than truncated, as ResultsWriter does
+            tmp_filename = f'{filename}.{os.getpid()}.tmp'
+            open(tmp_filename, 'w').close()
+            os.replace(tmp_filename, filename)
+        if os.path.exists(filename):
+            with open(filename) as f:
+                for line in f:
+                    if line.endswith('\n'): # a line cut short by an interruption is played again
+                        cell = json.loads(line)
+                        self.cells[cell['key']] = (cell['cell_row'], cell['game_rows'])
+        self.file = open(filename, 'a')
+
+    def get(self, key):
+        return self.cells.get(key)
+
+    def add(self, key, cell_row, game_rows):
+        self.cells[key] = (cell_row, game_rows)
+        # numpy scalars are written as plain numbers
+        self.file.write(json.dumps({'key': key, 'cell_row': cell_row, 'game_rows': game_rows}, default = lambda value: value.item()) + '\n')
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
 
 
 def load_model(env, name):
 
     filename = os.path.join(config.MODELDIR, env.name, name)
     if os.path.exists(filename):
+        # models are only ever renamed into the zoo once they are complete, see publish_model
         logger.info(f'Loading {name}')
-        cont = True
-        while cont:
-            try:
-                ppo_model = PPO1.load(filename, env=env)
-                cont = False
-            except Exception as e:
-                time.sleep(5)
-                print(e)
+        ppo_model = PPO1.load(filename, env=env)
     
     elif name == 'base.zip':
         cont = True
@@ -89,7 +193,10 @@ def load_model(env, name):
                 if rank == 0:
                     ppo_model = PPO1(get_network_arch(env.name), env=env)
                     logger.info(f'Saving base.zip PPO model...')
-                    ppo_model.save(os.path.join(config.MODELDIR, env.name, 'base.zip'))
+                    os.makedirs(config.TMPMODELDIR, exist_ok = True)
+                    tmp_filename = os.path.join(config.TMPMODELDIR, 'base.zip')
+                    ppo_model.save(tmp_filename)
+                    publish_model(tmp_filename, os.path.join(config.MODELDIR, env.name), 'base.zip')
                 else:
 
                     ppo_model = PPO1.load(os.path.join(config.MODELDIR, env.name, 'base.zip'), env=env)
@@ -107,37 +214,162 @@ def load_model(env, name):
     return ppo_model
 
 
-def load_all_models(env):
-    modellist = [f for f in os.listdir(os.path.join(config.MODELDIR, env.name)) if f.startswith("_model")]
-    modellist.sort()
+def load_policy(env, name):
+    # only the policy parameters, for models that are played against rather than trained
+    filename = os.path.join(config.MODELDIR, env.name, name)
+    if not os.path.exists(filename):
+        load_model(env, name)
+
+    logger.info(f'Loading policy {name}')
+    params_file = params_filename(filename)
+    source = file_fingerprint(filename)
+    params = load_params(params_file, source) if os.path.exists(params_file) else None
+    if params is None:
+        # converted the first time it's loaded (or again once the zip has been replaced), so every later load can map it instead
+        _, params = BaseRLModel._load_from_file(filename, load_data = False)
+        try:
+            save_params(params, params_file, source)
+        except OSError:
+            pass
+    return PolicyModel(env, params)
+
+
+def file_fingerprint(filename):
+    # the size and modification time of a file, which change whenever it is replaced
+    stat = os.stat(filename)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+PARAMS_ALIGNMENT = 64
+
+def align(offset):
+    return -(-offset // PARAMS_ALIGNMENT) * PARAMS_ALIGNMENT
+
+def params_filename(filename):
+    return os.path.splitext(filename)[0] + '.params'
+
+def save_params(params, filename, source):
+    # the policy parameters uncompressed in one file: the length of a JSON header giving the fingerprint of the zip
+    # they were converted from (see file_fingerprint) and each parameter's name, dtype, shape and offset, the header
+    # itself, then the raw arrays, aligned so they can be mapped in place
+    table, offset = [], 0
+    for name, value in params.items():
+        value = np.asarray(value)
+        table.append({'name': name, 'dtype': value.dtype.str, 'shape': value.shape, 'offset': offset})
+        offset += align(value.nbytes)
+    header = json.dumps({'source': source, 'params': table}).encode()
+    data_start = align(8 + len(header))
+
+    # written under a temporary name and renamed, so a reader never maps a partly written file
+    tmp_filename = f'{filename}.{os.getpid()}.tmp'
+    with open(tmp_filename, 'wb') as f:
+        f.write(struct.pack('<Q', len(header)))
+        f.write(header)
+        for entry, value in zip(table, params.values()):
+            f.seek(data_start + entry['offset'])
+            f.write(np.ascontiguousarray(value).tobytes())
+    os.replace(tmp_filename, filename)
+
+def load_params(filename, source):
+    # read-only arrays over a shared mapping of the file, so processes loading the same generation share its pages.
+    # None when the file wasn't converted from the zip with the fingerprint source, which has been replaced since
+    with open(filename, 'rb') as f:
+        blob = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+    header_length, = struct.unpack('<Q', blob[:8])
+    data_start = align(8 + header_length)
+    header = json.loads(blob[8:8 + header_length].decode())
+    if not isinstance(header, dict) or header['source'] != source:
+        return None
+
+    params = OrderedDict()
+    for entry in header['params']:
+        shape = tuple(entry['shape'])
+        count = int(np.prod(shape))
+        params[entry['name']] = np.frombuffer(blob, np.dtype(entry['dtype']), count, data_start + entry['offset']).reshape(shape)
+    return params
+
+
+def publish_model(source_file, model_dir, name):
+    # copied to a temporary file next to the zoo and renamed into place, so the zoo never holds a partly written model
+    # the policy parameters are published first in the format opponents are loaded from, see load_params, marked
+    # with the fingerprint of the copy, which the rename keeps
+    tmp_file = os.path.join(config.TMPMODELDIR, f'publish_{name}')
+    copyfile(source_file, tmp_file)
+
+    _, params = BaseRLModel._load_from_file(source_file, load_data = False)
+    save_params(params, params_filename(os.path.join(model_dir, name)), file_fingerprint(tmp_file))
+    os.replace(tmp_file, os.path.join(model_dir, name))
+
+
+def model_fingerprint(env_name, name):
+    # the size and modification time of a model's zip, which change whenever the model is saved again
+    # (the base model is listed as 'base' in the tournament)
+    filename = os.path.join(config.MODELDIR, env_name, name if name.endswith('.zip') else f'{name}.zip')
+    return '-'.join(str(x) for x in file_fingerprint(filename))
+
+
+def get_opponent_names(env_name):
+    return ['base.zip'] + [record['name'] for record in get_manifest(env_name).records()]
+
+
+def get_model_size(model):
+    return sum(p.nbytes for p in model.get_parameters().values())
+
+
+class ModelPool():
+    # process-wide cache of loaded models, keyed by filename, so that envs in the same process share
+    # one copy of each model and a generation is only loaded the first time it is actually needed
+    def __init__(self, max_memory = config.MODEL_POOL_MEMORY):
+        self.max_memory = max_memory * 1024 ** 2
+        self.models = OrderedDict()
+        self.sizes = {}
+
+    def get(self, env, name):
+        key = (env.name, name)
+        if key in self.models:
+            self.models.move_to_end(key)
+            return self.models[key]
+
+        model = load_policy(env, name)
+        self.models[key] = model
+        self.sizes[key] = get_model_size(model)
+        self.evict()
+        return model
+
+    def evict(self):
+        # least recently used first, always keeping the model that was loaded last
+        while len(self.models) > 1 and sum(self.sizes.values()) > self.max_memory:
+            key, _ = self.models.popitem(last = False)
+            del self.sizes[key]
+            logger.debug(f'Evicted {key[1]} from the model pool')
+
+
+model_pool = ModelPool()
 
-    models = [load_model(env, 'base.zip')]
-    for model_name in modellist:
-        models.append(load_model(env, name = model_name))
-    return models
 
 def load_all_models_with_names(env, start=None, stop=None, step=None):
-    modellist = [f for f in os.listdir(os.path.join(config.MODELDIR, env.name)) if f.startswith("_model")]
-    modellist.sort()
+    modellist = [record['name'] for record in get_manifest(env.name).records()]
     print(f"Length of model list {len(modellist)}")
 
     modellist = modellist[slice(start, stop, step)]
     
-    models = [(load_model(env, 'base.zip'), 'base')]
+    models = [(load_policy(env, 'base.zip'), 'base')]
     for model_name in modellist:
-        models.append((load_model(env, name = model_name), model_name))
+        models.append((load_policy(env, name = model_name), model_name))
     return models
 
 def get_best_model_name(env_name):
-    modellist = [f for f in os.listdir(os.path.join(config.MODELDIR, env_name)) if f.startswith("_model")]
-    
-    if len(modellist)==0:
-        filename = None
-    else:
-        modellist.sort()
-        filename = modellist[-1]
-        
-    return filename
+    records = get_manifest(env_name).records()
+    if len(records)==0:
+        return None
+    return records[-1]['name']
+
+def get_best_model_stats(env_name):
+    records = get_manifest(env_name).records()
+    if len(records)==0:
+        return get_model_stats(None)
+    record = records[-1]
+    return record['generation'], record['timesteps'], record['rules_reward'], record['reward']
 
 def get_model_stats(filename):
     if filename is None:
@@ -154,6 +386,74 @@ def get_model_stats(filename):
     return generation, timesteps, best_rules_based, best_reward
 
 
+def model_record(name, generation, timesteps, rules_reward, reward):
+    return {'name': name, 'generation': generation, 'timesteps': timesteps, 'rules_reward': rules_reward, 'reward': reward}
+
+
+class ZooManifest():
+    # index of the generations in a zoo directory, one JSON record per line in the order they were promoted,
+    # so the best model and its stats don't have to be parsed out of a directory listing on every new game.
+    # The file is only ever appended to, so a refresh reads just the lines added since the last one, and
+    # refreshes are at most every ZOO_MANIFEST_REFRESH seconds. Zoos from before the manifest are indexed
+    # from their filenames until their first new generation writes one
+    def __init__(self, env_name):
+        self.model_dir = os.path.join(config.MODELDIR, env_name)
+        self.filename = os.path.join(self.model_dir, config.ZOO_MANIFEST)
+        self.cached_records = []
+        self.offset = 0 # how much of the manifest has been read, None when the records came from a scan
+        self.checked = -np.inf
+
+    def scan(self):
+        modellist = [f for f in os.listdir(self.model_dir) if f.startswith("_model") and f.endswith(".zip")]
+        modellist.sort()
+        return [model_record(f, *get_model_stats(f)) for f in modellist]
+
+    def refresh(self):
+        try:
+            size = os.path.getsize(self.filename)
+        except OSError:
+            self.cached_records, self.offset = self.scan(), None
+            return
+
+        if self.offset is None or size < self.offset: # the manifest is new, or the zoo has been reset
+            self.cached_records, self.offset = [], 0
+        if size > self.offset:
+            with open(self.filename, 'rb') as f:
+                f.seek(self.offset)
+                lines = f.read(size - self.offset)
+            # a line that is still being written is picked up on the next refresh
+            complete = lines[:lines.rfind(b'\n') + 1]
+            self.cached_records.extend(json.loads(line) for line in complete.splitlines())
+            self.offset += len(complete)
+
+    def records(self):
+        if time.time() - self.checked >= config.ZOO_MANIFEST_REFRESH:
+            self.refresh()
+            self.checked = time.time()
+        return self.cached_records
+
+    def add(self, record):
+        if os.path.exists(self.filename):
+            with open(self.filename, 'a') as f:
+                f.write(json.dumps(record) + '\n')
+        else:
+            # the first generation indexed in this zoo - written in full and renamed into place
+            records = [r for r in self.scan() if r['name'] != record['name']] + [record]
+            tmp_filename = self.filename + '.tmp'
+            with open(tmp_filename, 'w') as f:
+                f.writelines(json.dumps(r) + '\n' for r in records)
+            os.replace(tmp_filename, self.filename)
+        self.checked = -np.inf
+
+
+manifests = {}
+
+def get_manifest(env_name):
+    if env_name not in manifests:
+        manifests[env_name] = ZooManifest(env_name)
+    return manifests[env_name]
+
+
 def reset_logs(model_dir):
     try:
         filelist = [ f for f in os.listdir(config.LOGDIR) if f not in ['.gitignore']]
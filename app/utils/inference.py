@@ -0,0 +1,110 @@
+import numpy as np
+import tensorflow as tf
+
+from collections import OrderedDict
+
+from stable_baselines.common import tf_util
+
+from utils.register import get_network_arch, get_numpy_network
+from utils.numpy_layers import softmax
+
+
+policy_graphs = {}
+
+
+class PolicyGraph():
+  # a single copy of the CustomPolicy network for an environment, with ops to assign the weights of any generation into it
+  def __init__(self, env):
+      self.graph = tf.Graph()
+      with self.graph.as_default():
+        self.sess = tf_util.make_session(num_cpu=1, graph=self.graph)
+        self.policy = get_network_arch(env.name)(self.sess, env.observation_space, env.action_space, 1, 1, None, reuse=False)
+
+        self.load_ops = OrderedDict()
+        for param in tf_util.get_trainable_vars("model"):
+          placeholder = tf.placeholder(dtype=param.dtype, shape=param.shape)
+          self.load_ops[param.name] = (placeholder, param.assign(placeholder))
+
+        tf_util.initialize(sess=self.sess)
+
+      self.loaded_model = None
+
+  def load(self, policy_model):
+      # only swap the weights in when a different generation was evaluated last
+      if self.loaded_model is not policy_model:
+        feed_dict = {placeholder: policy_model.params[name] for name, (placeholder, _) in self.load_ops.items()}
+        self.sess.run([assign for _, assign in self.load_ops.values()], feed_dict)
+        self.loaded_model = policy_model
+
+
+def get_policy_graph(env):
+  if env.name not in policy_graphs:
+    policy_graphs[env.name] = PolicyGraph(env)
+  return policy_graphs[env.name]
+
+
+class PolicyModel():
+  # the policy parameters of one saved generation, evaluated in the environment's shared PolicyGraph
+  # supports the parts of the PPO1 interface that an Agent uses, so it can stand in for a full PPO1 model
+  def __init__(self, env, params):
+      self.params = params
+      self.env = env
+      self.observation_space = env.observation_space
+
+  @property
+  def policy_graph(self):
+      # built on first use, so that models only ever evaluated with the numpy backend never create a graph
+      return get_policy_graph(self.env)
+
+  @property
+  def policy_pi(self):
+      return self
+
+  def get_parameters(self):
+      return self.params
+
+  def proba_step(self, obs, state=None, mask=None):
+      self.policy_graph.load(self)
+      return self.policy_graph.policy.proba_step(obs)
+
+  def value(self, obs, state=None, mask=None):
+      self.policy_graph.load(self)
+      return self.policy_graph.policy.value(obs)
+
+  def proba_value(self, obs, value=True):
+      self.policy_graph.load(self)
+      return self.policy_graph.policy.proba_value(obs, value)
+
+  def action_probability(self, observation):
+      observation = np.array(observation).reshape((-1,) + self.observation_space.shape)
+      return self.proba_step(observation)[0]
+
+
+class NumpyPolicy():
+  # evaluates the policy parameters of a model with the NumPy mirror of its CustomPolicy,
+  # which is faster than a TensorFlow session call for the small batches played move by move
+  def __init__(self, env, params):
+      self.params = [np.asarray(p) for p in params.values()]
+      self.forward = get_numpy_network(env.name)
+
+      # same rescaling of the observation to [0, 1] as the policy's processed_obs
+      low, high = env.observation_space.low, env.observation_space.high
+      self.scale = not np.any(np.isinf(low)) and not np.any(np.isinf(high)) and np.any((high - low) != 0)
+      self.low = low.astype(np.float32)
+      self.range = (high - low).astype(np.float32)
+
+  def processed_obs(self, obs):
+      obs = np.asarray(obs, dtype=np.float32)
+      if self.scale:
+        obs = (obs - self.low) / self.range
+      return obs
+
+  def proba_step(self, obs, state=None, mask=None):
+      return self.proba_value(obs, value = False)[0]
+
+  def value(self, obs, state=None, mask=None):
+      return self.proba_value(obs)[1]
+
+  def proba_value(self, obs, value=True):
+      policy, value = self.forward(iter(self.params), self.processed_obs(obs), value = value)
+      return softmax(policy), value
@@ -0,0 +1,72 @@
+import numpy as np
+
+# NumPy versions of the layers used in models/*/models.py, for evaluating a saved policy without TensorFlow.
+# Each layer takes the next parameters it needs from an iterator over the saved policy parameters,
+# so a network has to call them in the same order as the Keras layers were created in its CustomPolicy.
+
+BN_EPSILON = 1e-3
+
+
+def activate(y, activation):
+    if activation == 'relu':
+        return np.maximum(y, 0)
+    elif activation == 'tanh':
+        return np.tanh(y)
+    elif activation is None:
+        return y
+    else:
+        raise Exception(f'Activation {activation} not implemented')
+
+
+def softmax(y):
+    y = np.exp(y - np.max(y, axis = -1, keepdims = True))
+    return y / np.sum(y, axis = -1, keepdims = True)
+
+
+def flatten(y):
+    return y.reshape(y.shape[0], -1)
+
+
+def batch_normalization(weights, y):
+    # the moving mean and variance are never trained or saved, so they stay at 0 and 1
+    gamma, beta = next(weights), next(weights)
+    return y / np.sqrt(1 + BN_EPSILON, dtype = y.dtype) * gamma + beta
+
+
+def dense(weights, y, batch_norm = False, activation = 'relu'):
+    kernel, bias = next(weights), next(weights)
+    y = y @ kernel + bias
+    if batch_norm:
+        y = batch_normalization(weights, y)
+    return activate(y, activation)
+
+
+def conv2d(weights, y, strides = (1, 1)):
+    # channels last, with 'same' padding
+    kernel, bias = next(weights), next(weights)
+    kernel_h, kernel_w, _, filters = kernel.shape
+    stride_h, stride_w = strides
+    n, h, w, channels = y.shape
+
+    out_h, out_w = -(-h // stride_h), -(-w // stride_w)
+    pad_h = max((out_h - 1) * stride_h + kernel_h - h, 0)
+    pad_w = max((out_w - 1) * stride_w + kernel_w - w, 0)
+    y = np.pad(y, ((0, 0), (pad_h // 2, pad_h - pad_h // 2), (pad_w // 2, pad_w - pad_w // 2), (0, 0)))
+
+    patches = np.empty((n, out_h, out_w, kernel_h, kernel_w, channels), dtype = y.dtype)
+    for i in range(kernel_h):
+        for j in range(kernel_w):
+            patches[:, :, :, i, j, :] = y[:, i:i + stride_h * out_h:stride_h, j:j + stride_w * out_w:stride_w, :]
+
+    return patches.reshape(n, out_h, out_w, -1) @ kernel.reshape(-1, filters) + bias
+
+
+def convolutional(weights, y, batch_norm = True, activation = 'relu', strides = (1, 1)):
+    y = conv2d(weights, y, strides)
+    if batch_norm:
+        y = batch_normalization(weights, y)
+    return activate(y, activation)
+
+
+def mask_illegal(policy, legal_actions):
+    return policy + (1 - legal_actions) * -1e8
@@ -33,6 +33,15 @@ def get_environment(env_name):
     
 
 
+def get_batch_environment(env_name):
+    # the batched simulators that play many games of an environment at once, for SelfPlayBatchVecEnv
+    if env_name in ('gonutsfordonuts'):
+        from gonutsfordonuts.envs.batch import GoNutsForDonutsBatchEnv
+        return GoNutsForDonutsBatchEnv
+    else:
+        raise Exception(f'No batched environment found for {env_name}')
+
+
 def get_network_arch(env_name):
     if env_name in ('tictactoe'):
         from models.tictactoe.models import CustomPolicy
@@ -58,3 +67,28 @@ def get_network_arch(env_name):
     else:
         raise Exception(f'No model architectures found for {env_name}')
 
+
+def get_numpy_network(env_name):
+    if env_name in ('tictactoe'):
+        from models.tictactoe.models import numpy_forward
+        return numpy_forward
+    elif env_name in ('connect4'):
+        from models.connect4.models import numpy_forward
+        return numpy_forward
+    elif env_name in ('sushigo'):
+        from models.sushigo.models import numpy_forward
+        return numpy_forward
+    elif env_name in ('gonutsfordonuts'):
+        from models.gonutsfordonuts.models import numpy_forward
+        return numpy_forward
+    elif env_name in ('butterfly'):
+        from models.butterfly.models import numpy_forward
+        return numpy_forward
+    elif env_name in ('geschenkt'):
+        from models.geschenkt.models import numpy_forward
+        return numpy_forward
+    elif env_name in ('frouge'):
+        from models.frouge.models import numpy_forward
+        return numpy_forward
+    else:
+        raise Exception(f'No model architectures found for {env_name}')
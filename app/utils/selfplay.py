@@ -1,80 +1,106 @@
 import os
 import numpy as np
 import random
+from copy import deepcopy
+from collections import OrderedDict
 
-from utils.files import load_model, load_all_models, get_best_model_name
+from utils.files import model_pool, get_opponent_names
 from utils.agents import Agent
 
 import config
 
 from stable_baselines import logger
+from stable_baselines.common.vec_env import DummyVecEnv, VecEnv
+
+def choose_opponents(opponent_type, n_players, opponent_names, opponent_model, backend):
+    # the agents for a new self play game (with None in the seat of the agent being trained) and that seat,
+    # where opponent_model(i) loads the ith of the opponent_names
+    if opponent_type == 'rules':
+        opponent_agent = Agent('rules')
+    else:
+        if opponent_type == 'random':
+            start = 0
+            end = len(opponent_names) - 1
+            i = random.randint(start, end)
+            opponent_agent = Agent('ppo_opponent', opponent_model(i), backend)
+
+        elif opponent_type == 'best':
+            opponent_agent = Agent('ppo_opponent', opponent_model(-1), backend)
+
+        elif opponent_type == 'mostly_best' or opponent_type == 'mostly_best_base':
+            j = random.uniform(0,1)
+            if j < 0.8:
+                opponent_agent = Agent('ppo_opponent', opponent_model(-1), backend)
+            else:
+                start = 0
+                end = len(opponent_names) - 1
+                i = random.randint(start, end)
+                opponent_agent = Agent('ppo_opponent', opponent_model(i), backend)
+
+        elif opponent_type == 'base':
+            opponent_agent = Agent('base', opponent_model(0), backend)
+
+    agent_player_num = np.random.choice(n_players)
+    agents = [opponent_agent] * n_players
+
+    # Always include one base agent
+    if opponent_type == 'mostly_best_base':
+        player_nums = set(range(0, n_players))
+        player_nums_not_player = player_nums - set([agent_player_num])
+        random_player_not_player = np.random.choice(tuple(player_nums_not_player))
+        agents[random_player_not_player] = Agent('base', opponent_model(0), backend)
+
+    agents[agent_player_num] = None
+    return agents, agent_player_num
+
 
 def selfplay_wrapper(env):
     class SelfPlayEnv(env):
         # wrapper over the normal single player env, but loads the best self play model
-        def __init__(self, opponent_type, verbose):
+        def __init__(self, opponent_type, verbose, opponent_names = None, backend = 'tf'):
             super(SelfPlayEnv, self).__init__(verbose)
             self.opponent_type = opponent_type
-            self.opponent_models = load_all_models(self)
-            self.best_model_name = get_best_model_name(self.name)
+            self.backend = backend
+            # opponents are only loaded into the shared model pool when they are first picked,
+            # but the base model is loaded straight away, so that it is created if it doesn't exist yet
+            model_pool.get(self, 'base.zip')
+            if opponent_names is None:
+                opponent_names = get_opponent_names(self.name)
+            self.opponent_names = opponent_names
+
+        def add_opponent(self, name):
+            # called when a new generation is promoted, rather than checking the zoo for one at every reset
+            # the list can be shared between envs, so a generation is only added once
+            if name not in self.opponent_names:
+                self.opponent_names.append(name)
+
+        def opponent_model(self, i):
+            return model_pool.get(self, self.opponent_names[i])
 
         def setup_opponents(self):
 
             logger.info(f'Using opponent type {self.opponent_type}')
-
-            if self.opponent_type == 'rules':
-                self.opponent_agent = Agent('rules')
-            else:
-                # incremental load of new model
-                best_model_name = get_best_model_name(self.name)
-                if self.best_model_name != best_model_name:
-                    self.opponent_models.append(load_model(self, best_model_name ))
-                    self.best_model_name = best_model_name
-
-                if self.opponent_type == 'random':
-                    start = 0
-                    end = len(self.opponent_models) - 1
-                    i = random.randint(start, end)
-                    self.opponent_agent = Agent('ppo_opponent', self.opponent_models[i]) 
-
-                elif self.opponent_type == 'best':
-                    self.opponent_agent = Agent('ppo_opponent', self.opponent_models[-1])  
-
-                elif self.opponent_type == 'mostly_best' or self.opponent_type == 'mostly_best_base':
-                    j = random.uniform(0,1)
-                    if j < 0.8:
-                        self.opponent_agent = Agent('ppo_opponent', self.opponent_models[-1])  
-                    else:
-                        start = 0
-                        end = len(self.opponent_models) - 1
-                        i = random.randint(start, end)
-                        self.opponent_agent = Agent('ppo_opponent', self.opponent_models[i])  
-
-                elif self.opponent_type == 'base':
-                    self.opponent_agent = Agent('base', self.opponent_models[0])  
-
-            self.agent_player_num = np.random.choice(self.n_players)
-            self.agents = [self.opponent_agent] * self.n_players
-
-            # Always include one base agent
-            if self.opponent_type == 'mostly_best_base':
-                player_nums = set(range(0, self.n_players))
-                player_nums_not_player = player_nums - set([self.agent_player_num])
-                random_player_not_player = np.random.choice(tuple(player_nums_not_player))
-                self.agents[random_player_not_player] = Agent('base', self.opponent_models[0])
-
-            self.agents[self.agent_player_num] = None
-            try:
-                #if self.players is defined on the base environment
-                logger.debug(f'Agent plays as Player {self.players[self.agent_player_num].id}')
-            except:
-                pass
+            self.agents, self.agent_player_num = choose_opponents(self.opponent_type, self.n_players, self.opponent_names, self.opponent_model, self.backend)
+            if logger.get_level() <= config.DEBUG:
+                try:
+                    #if self.players is defined on the base environment
+                    logger.debug(f'Agent plays as Player {self.players[self.agent_player_num].id}')
+                except:
+                    pass
 
 
-        def reset(self):
+        def new_game(self):
+            # resets the underlying game and picks new opponents, without playing any opponent moves
             super(SelfPlayEnv, self).reset()
             self.setup_opponents()
 
+        def take_turn(self, action):
+            # a single move in the underlying game, by whichever player is next to act
+            return super(SelfPlayEnv, self).step(action)
+
+        def reset(self):
+            self.new_game()
+
             if self.current_player_num != self.agent_player_num:   
                 self.continue_game()
 
@@ -84,6 +110,11 @@ def selfplay_wrapper(env):
         def current_agent(self):
             return self.agents[self.current_player_num]
 
+        def render(self, mode='human', close=False):
+            # the environments render to the debug log, so skip building the output when it would be discarded
+            if logger.get_level() <= config.DEBUG:
+                super(SelfPlayEnv, self).render(mode, close)
+
         def continue_game(self):
             observation = None
             reward = None
@@ -93,8 +124,9 @@ def selfplay_wrapper(env):
                 self.render()
                 action = self.current_agent.choose_action(self, choose_best_action = False, mask_invalid_actions = False)
                 observation, reward, done, _ = super(SelfPlayEnv, self).step(action)
-                logger.debug(f'Rewards: {reward}')
-                logger.debug(f'Done: {done}')
+                if logger.get_level() <= config.DEBUG:
+                    logger.debug(f'Rewards: {reward}')
+                    logger.debug(f'Done: {done}')
                 if done:
                     break
 
@@ -104,9 +136,10 @@ def selfplay_wrapper(env):
         def step(self, action):
             self.render()
             observation, reward, done, _ = super(SelfPlayEnv, self).step(action)
-            logger.debug(f'Action played by agent: {action}')
-            logger.debug(f'Rewards: {reward}')
-            logger.debug(f'Done: {done}')
+            if logger.get_level() <= config.DEBUG:
+                logger.debug(f'Action played by agent: {action}')
+                logger.debug(f'Rewards: {reward}')
+                logger.debug(f'Done: {done}')
 
             if not done:
                 package = self.continue_game()
@@ -115,11 +148,220 @@ def selfplay_wrapper(env):
 
 
             agent_reward = reward[self.agent_player_num]
-            logger.debug(f'\nReward To Agent: {agent_reward}')
+            if logger.get_level() <= config.DEBUG:
+                logger.debug(f'\nReward To Agent: {agent_reward}')
 
             if done:
                 self.render()
 
             return observation, agent_reward, done, {} 
 
-    return SelfPlayEnv
\ No newline at end of file
+    return SelfPlayEnv
+
+
+def selfplay_vec_wrapper(env):
+    SelfPlayEnv = selfplay_wrapper(env)
+
+    class SelfPlayVecEnv(DummyVecEnv):
+        # n_envs self play games stepped together, so that the opponent moves across all games
+        # are evaluated in one batch per opponent model rather than one policy call per move
+        def __init__(self, opponent_type, verbose, n_envs, backend = 'tf'):
+            lead_env = SelfPlayEnv(opponent_type, verbose, backend = backend)
+            env_fns = [lambda: lead_env]
+            for _ in range(n_envs - 1):
+                env_fns.append(lambda: SelfPlayEnv(opponent_type, verbose, opponent_names = lead_env.opponent_names, backend = backend))
+            super(SelfPlayVecEnv, self).__init__(env_fns)
+            self.name = lead_env.name
+            self.rewards = [None] * self.num_envs
+
+        def start_games(self, env_idxs):
+            # new games, played up to the agent's first move. Dealt again when an opponent ends one before then
+            # (with an illegal move), so that the agent is never asked to move in a finished game
+            while env_idxs:
+                for env_idx in env_idxs:
+                    self.envs[env_idx].new_game()
+                    self.buf_dones[env_idx] = False
+                self.continue_games(env_idxs)
+                env_idxs = [i for i in env_idxs if self.buf_dones[i]]
+
+        def continue_games(self, env_idxs):
+            # plays the opponents in every game until it is the agent's turn again (or the game is over),
+            # grouping the pending decisions of the same opponent model into a single batch
+            pending = [i for i in env_idxs if self.envs[i].current_player_num != self.envs[i].agent_player_num]
+
+            while pending:
+                batches = OrderedDict()
+                for i in pending:
+                    agent = self.envs[i].current_agent
+                    key = id(agent) if agent.model is None else id(agent.model)
+                    batches.setdefault(key, []).append(i)
+
+                for batch in batches.values():
+                    agent = self.envs[batch[0]].current_agent
+                    actions = agent.choose_actions([self.envs[i] for i in batch], choose_best_action = False, mask_invalid_actions = False)
+                    for i, action in zip(batch, actions):
+                        _, self.rewards[i], self.buf_dones[i], _ = self.envs[i].take_turn(action)
+
+                pending = [i for i in pending if not self.buf_dones[i] and self.envs[i].current_player_num != self.envs[i].agent_player_num]
+
+        def reset(self):
+            self.start_games(list(range(self.num_envs)))
+
+            for env_idx in range(self.num_envs):
+                self._save_obs(env_idx, self.envs[env_idx].observation)
+            return self._obs_from_buf()
+
+        def step_wait(self):
+            for env_idx in range(self.num_envs):
+                _, self.rewards[env_idx], self.buf_dones[env_idx], _ = self.envs[env_idx].take_turn(self.actions[env_idx])
+            if logger.get_level() <= config.DEBUG:
+                logger.debug(f'Actions played by agent: {self.actions}')
+
+            self.continue_games([i for i in range(self.num_envs) if not self.buf_dones[i]])
+
+            finished = []
+            for env_idx, env in enumerate(self.envs):
+                self.buf_rews[env_idx] = self.rewards[env_idx][env.agent_player_num]
+                self.buf_infos[env_idx] = {}
+                if self.buf_dones[env_idx]:
+                    if logger.get_level() <= config.DEBUG:
+                        logger.debug(f'\nReward To Agent in game {env_idx}: {self.buf_rews[env_idx]}')
+                    # save final observation where user can get it, then start a new game
+                    self.buf_infos[env_idx]['terminal_observation'] = env.observation
+                    finished.append(env_idx)
+
+            # the opponents' opening moves in the new games are batched too
+            self.start_games(finished)
+
+            for env_idx, env in enumerate(self.envs):
+                self._save_obs(env_idx, env.observation)
+                if env_idx in finished:
+                    self.buf_dones[env_idx] = True
+
+            return (self._obs_from_buf(), np.copy(self.buf_rews), np.copy(self.buf_dones), deepcopy(self.buf_infos))
+
+    return SelfPlayVecEnv
+
+
+class SelfPlayBatchVecEnv(VecEnv):
+    # n_envs self play games played by a batched simulator of the game (see get_batch_environment), which moves
+    # every game on with a few array operations rather than one env object per game. The opponent moves are
+    # batched by model, as in SelfPlayVecEnv, and played with a single call to the simulator per round
+    def __init__(self, env, BatchEnv, opponent_type, verbose, n_envs, backend = 'tf'):
+        assert opponent_type != 'rules', 'The rules based agent needs a single game env'
+        # a single game, so the opponent models can be loaded and evaluated as usual
+        self.lead_env = env(verbose = verbose)
+        self.batch_env = BatchEnv(n_envs, verbose = verbose)
+        self.name = self.batch_env.name
+        self.n_players = self.batch_env.n_players
+        self.opponent_type = opponent_type
+        self.backend = backend
+        model_pool.get(self.lead_env, 'base.zip')
+        self.opponent_names = get_opponent_names(self.name)
+
+        self.agents = [None] * n_envs
+        self.agent_player_num = np.zeros(n_envs, dtype = int)
+        self.rewards = np.zeros((n_envs, self.n_players))
+        self.dones = np.zeros(n_envs, dtype = bool)
+        self.actions = None
+        super(SelfPlayBatchVecEnv, self).__init__(n_envs, self.batch_env.observation_space, self.batch_env.action_space)
+
+    def add_opponent(self, name):
+        if name not in self.opponent_names:
+            self.opponent_names.append(name)
+
+    def opponent_model(self, i):
+        return model_pool.get(self.lead_env, self.opponent_names[i])
+
+    def new_games(self, games):
+        self.batch_env.reset_games(games)
+        self.dones[games] = False
+        for g in games:
+            self.agents[g], self.agent_player_num[g] = choose_opponents(self.opponent_type, self.n_players, self.opponent_names, self.opponent_model, self.backend)
+            if logger.get_level() <= config.DEBUG:
+                logger.debug(f'Agent plays as Player {self.agent_player_num[g]} in game {g}')
+
+    def start_games(self, games):
+        # new games, played up to the agent's first move. Dealt again when an opponent ends one before then
+        # (with an illegal move), so that the agent is never asked to move in a finished game
+        while len(games):
+            self.new_games(games)
+            self.continue_games(games)
+            games = games[self.dones[games]]
+
+    def take_turns(self, games, actions):
+        self.rewards[games], self.dones[games] = self.batch_env.step(actions, games)
+
+    def continue_games(self, games):
+        # plays the opponents in every game until it is the agent's turn again (or the game is over)
+        pending = np.asarray(games, dtype = int)
+        pending = pending[self.batch_env.current_player_num[pending] != self.agent_player_num[pending]]
+
+        while len(pending):
+            current_player_num = self.batch_env.current_player_num
+            batches = OrderedDict()
+            for g in pending:
+                agent = self.agents[g][current_player_num[g]]
+                batches.setdefault(id(agent.model), []).append(g)
+
+            observation = self.batch_env.observation
+            games, actions = [], []
+            for batch in batches.values():
+                agent = self.agents[batch[0]][current_player_num[batch[0]]]
+                batch_action_probs, values = agent.evaluate(self.lead_env, observation[batch])
+                if values is not None and logger.get_level() <= config.DEBUG:
+                    logger.debug(f'Values {[round(float(v), 2) for v in values]}')
+                games.extend(batch)
+                actions.extend(agent.select_action(self.lead_env, action_probs, choose_best_action = False, mask_invalid_actions = False) for action_probs in batch_action_probs)
+
+            games = np.array(games)
+            self.take_turns(games, actions)
+            pending = games[~self.dones[games] & (self.batch_env.current_player_num[games] != self.agent_player_num[games])]
+
+    def reset(self):
+        self.start_games(np.arange(self.num_envs))
+        return np.copy(self.batch_env.observation)
+
+    def step_async(self, actions):
+        self.actions = actions
+
+    def step_wait(self):
+        games = np.arange(self.num_envs)
+        self.take_turns(games, self.actions)
+        if logger.get_level() <= config.DEBUG:
+            logger.debug(f'Actions played by agent: {self.actions}')
+        self.continue_games(games[~self.dones])
+
+        rewards = self.rewards[games, self.agent_player_num].astype(np.float32)
+        dones = np.copy(self.dones)
+        infos = [{} for _ in games]
+
+        finished = games[dones]
+        if len(finished):
+            if logger.get_level() <= config.DEBUG:
+                logger.debug(f'\nRewards To Agent in games {finished}: {rewards[finished]}')
+            # save final observation where user can get it, then start a new game
+            for g, observation in zip(finished, self.batch_env.observation[finished]):
+                infos[g]['terminal_observation'] = observation
+            # the opponents' opening moves in the new games are batched too
+            self.start_games(finished)
+
+        return np.copy(self.batch_env.observation), rewards, dones, infos
+
+    def close(self):
+        pass
+
+    def seed(self, seed = None):
+        # the games are dealt from the global numpy random state
+        return [None] * self.num_envs
+
+    def get_attr(self, attr_name, indices = None):
+        raise NotImplementedError('The batched games are not separate envs')
+
+    def set_attr(self, attr_name, value, indices = None):
+        raise NotImplementedError('The batched games are not separate envs')
+
+    def env_method(self, method_name, *method_args, indices = None, **method_kwargs):
+        # such as add_opponent when a new generation is promoted, which applies to all the games
+        assert indices is None, 'Methods are called on all the batched games at once'
+        return [getattr(self, method_name)(*method_args, **method_kwargs)] * self.num_envs
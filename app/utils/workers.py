@@ -0,0 +1,268 @@
+import os
+import multiprocessing
+import numpy as np
+
+from functools import partial
+
+from stable_baselines import logger
+from stable_baselines.common import set_global_seeds
+from stable_baselines.common.vec_env import VecEnv
+from stable_baselines.ppo1 import PPO1, pposgd_simple
+
+from utils.selfplay import selfplay_wrapper, selfplay_vec_wrapper
+
+
+def shared_views(arrays, obs_shape):
+    # numpy views of the shared observations, rewards and dones of every game
+    obs_array, rew_array, done_array = arrays
+    observations = np.frombuffer(obs_array, dtype = np.float32).reshape((-1,) + obs_shape)
+    rewards = np.frombuffer(rew_array, dtype = np.float32)
+    dones = np.frombuffer(done_array, dtype = np.int8)
+    return observations, rewards, dones
+
+
+def selfplay_worker(remote, parent_remote, env, opponent_type, verbose, backend, games, arrays, obs_shape, level, seed):
+    # plays a slice of the games, opponent moves included, and writes the agent's observations,
+    # rewards and dones for them straight into the shared buffers - the pipe only carries the actions.
+    # The games are stepped together, so each opponent model is evaluated once per round for all of them
+    parent_remote.close()
+
+    # the parent's log files and MPI job belong to the parent
+    logger.configure(format_strs=[])
+    logger.set_level(level)
+    set_global_seeds(seed)
+
+    observations, rewards, dones = shared_views(arrays, obs_shape)
+    vec_env = selfplay_vec_wrapper(env)(opponent_type, verbose, n_envs = len(games), backend = backend)
+    games = slice(games.start, games.stop)
+
+    try:
+        while True:
+            cmd, data = remote.recv()
+            result = True
+            if cmd == 'reset':
+                observations[games] = vec_env.reset()
+            elif cmd == 'step':
+                # finished games are dealt again by the vec env
+                observations[games], rewards[games], dones[games], _ = vec_env.step(data)
+            elif cmd == 'env_method':
+                method_name, method_args, method_kwargs = data
+                result = vec_env.env_method(method_name, *method_args, **method_kwargs)
+            elif cmd == 'close':
+                break
+            else:
+                raise NotImplementedError(f'`{cmd}` is not implemented in the worker')
+            remote.send(result)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        remote.close()
+        # skip the exit handlers inherited from the parent, such as MPI finalize
+        os._exit(0)
+
+
+class SubprocSelfPlayVecEnv(VecEnv):
+    # n_workers processes each playing games_per_worker self play games, with the opponents evaluated inside
+    # the workers in one batch per model, so the parent only runs the batched policy step for the agent.
+    # With the numpy backend the workers never touch TensorFlow or MPI, so they can be forked from the
+    # training process. Otherwise they are spawned, so that each builds its own TensorFlow session
+    def __init__(self, env, opponent_type, verbose, n_workers, games_per_worker = 1, seed = 0, backend = 'numpy'):
+        # also makes sure the base model exists before the workers look for it
+        lead_env = selfplay_wrapper(env)(opponent_type, verbose, backend = backend)
+        self.name = lead_env.name
+        n_envs = n_workers * games_per_worker
+        obs_shape = lead_env.observation_space.shape
+
+        arrays = (multiprocessing.RawArray('f', n_envs * int(np.prod(obs_shape)))
+            , multiprocessing.RawArray('f', n_envs)
+            , multiprocessing.RawArray('b', n_envs))
+        self.buf_obs, self.buf_rews, self.buf_dones = shared_views(arrays, obs_shape)
+
+        ctx = multiprocessing.get_context('fork' if backend == 'numpy' else 'spawn')
+        self.remotes, work_remotes = zip(*[ctx.Pipe(duplex = True) for _ in range(n_workers)])
+        self.games = [range(w * games_per_worker, (w + 1) * games_per_worker) for w in range(n_workers)]
+        self.processes = []
+        for w, (work_remote, remote) in enumerate(zip(work_remotes, self.remotes)):
+            args = (work_remote, remote, env, opponent_type, verbose, backend, self.games[w], arrays, obs_shape, logger.get_level(), seed + w + 1)
+            # daemon=True: if the main process crashes, the workers shouldn't be left behind
+            process = ctx.Process(target = selfplay_worker, args = args, daemon = True)
+            process.start()
+            self.processes.append(process)
+            work_remote.close()
+
+        self.waiting = False
+        self.closed = False
+        super(SubprocSelfPlayVecEnv, self).__init__(n_envs, lead_env.observation_space, lead_env.action_space)
+
+    def wait(self):
+        for remote in self.remotes:
+            remote.recv()
+        self.waiting = False
+
+    def reset(self):
+        for remote in self.remotes:
+            remote.send(('reset', None))
+        self.wait()
+        return np.copy(self.buf_obs)
+
+    def step_async(self, actions):
+        for remote, games in zip(self.remotes, self.games):
+            remote.send(('step', actions[games.start:games.stop]))
+        self.waiting = True
+
+    def step_wait(self):
+        self.wait()
+        return np.copy(self.buf_obs), np.copy(self.buf_rews), self.buf_dones.astype(bool), [{} for _ in range(self.num_envs)]
+
+    def close(self):
+        if self.closed:
+            return
+        if self.waiting:
+            self.wait()
+        for remote in self.remotes:
+            remote.send(('close', None))
+        for process in self.processes:
+            process.join()
+        self.closed = True
+
+    def seed(self, seed = None):
+        # each worker is seeded when it starts
+        return [None] * self.num_envs
+
+    def get_attr(self, attr_name, indices = None):
+        raise NotImplementedError('The games only exist in the worker processes')
+
+    def set_attr(self, attr_name, value, indices = None):
+        raise NotImplementedError('The games only exist in the worker processes')
+
+    def env_method(self, method_name, *method_args, indices = None, **method_kwargs):
+        # called on every game, such as add_opponent when a new generation is promoted
+        assert indices is None, 'Methods are called on all the games in the worker processes'
+        for remote in self.remotes:
+            remote.send(('env_method', (method_name, method_args, method_kwargs)))
+        return [result for remote in self.remotes for result in remote.recv()]
+
+
+def vec_traj_segment_generator(policy, env, horizon, callback = None, gamma = 0.99):
+    # the segments of stable_baselines' traj_segment_generator, gathered from every game of a vectorised env
+    # with one policy step per move. Each game fills its own block of horizon // num_envs steps, so that
+    # add_vtarg_and_adv runs along one game at a time. Blocks are marked as starting an episode, and the value
+    # of the state each block was cut off at is discounted into its last reward, which is what nextvpred does
+    # for the single game in the original.
+    n_envs = env.num_envs
+    n_steps = horizon // n_envs
+    assert n_steps > 0, f'timesteps_per_actorbatch must be at least the number of games ({n_envs})'
+
+    observation = env.reset()
+    action = np.asarray(env.action_space.sample())  # not used, just so we have the datatype
+
+    observations = np.zeros((n_envs, n_steps) + observation.shape[1:], dtype = observation.dtype)
+    actions = np.zeros((n_envs, n_steps) + action.shape, dtype = action.dtype)
+    rewards = np.zeros((n_envs, n_steps), 'float32')
+    true_rewards = np.zeros((n_envs, n_steps), 'float32')
+    vpreds = np.zeros((n_envs, n_steps), 'float32')
+    episode_starts = np.zeros((n_envs, n_steps), 'bool')
+    dones = np.zeros((n_envs, n_steps), 'bool')
+
+    cur_ep_rets = np.zeros(n_envs)
+    cur_ep_lens = np.zeros(n_envs, 'int')
+    ep_rets = []
+    ep_lens = []
+    current_it_len = 0
+    episode_start = np.ones(n_envs, 'bool')
+
+    def segment(continue_training):
+        return {
+            "observations": observations.reshape((-1,) + observations.shape[2:]),
+            "rewards": rewards.reshape(-1),
+            "dones": dones.reshape(-1),
+            "episode_starts": episode_starts.reshape(-1),
+            "true_rewards": true_rewards.reshape(-1),
+            "vpred": vpreds.reshape(-1),
+            "actions": actions.reshape((-1,) + actions.shape[2:]),
+            "nextvpred": 0,
+            "ep_rets": ep_rets,
+            "ep_lens": ep_lens,
+            "ep_true_rets": ep_rets,
+            "total_timestep": current_it_len,
+            'continue_training': continue_training
+        }
+
+    step = 0
+    callback.on_rollout_start()
+
+    while True:
+        action, vpred, _, _ = policy.step(observation)
+
+        if step > 0 and step % n_steps == 0:
+            rewards[:, -1] += gamma * vpred * (1 - episode_start)
+            episode_starts[:, 0] = True
+            callback.update_locals(locals())
+            callback.on_rollout_end()
+            yield segment(True)
+            # the policy has been updated, so the values are out of date
+            _, vpred, _, _ = policy.step(observation)
+            ep_rets = []
+            ep_lens = []
+            current_it_len = 0
+            callback.on_rollout_start()
+
+        i = step % n_steps
+        observations[:, i] = observation
+        vpreds[:, i] = vpred
+        actions[:, i] = action
+        episode_starts[:, i] = episode_start
+
+        observation, reward, done, _ = env.step(action)
+
+        callback.update_locals(locals())
+        if callback.on_step() is False:
+            yield segment(False)
+            return
+
+        rewards[:, i] = reward
+        true_rewards[:, i] = reward
+        dones[:, i] = done
+        episode_start = done
+
+        cur_ep_rets += reward
+        cur_ep_lens += 1
+        current_it_len += n_envs
+
+        for j in np.flatnonzero(done):
+            ep_rets.append(cur_ep_rets[j])
+            ep_lens.append(cur_ep_lens[j])
+        cur_ep_rets[done] = 0
+        cur_ep_lens[done] = 0
+
+        step += 1
+
+
+class VecPPO1(PPO1):
+    # PPO1 collecting its segments from all the games of a vectorised self play env (SelfPlayVecEnv, SubprocSelfPlayVecEnv or SelfPlayBatchVecEnv) at once
+    # the model still trains as a single environment - only the rollout is vectorised
+    def set_env(self, env):
+        if isinstance(env, VecEnv) and env.num_envs > 1:
+            assert self.observation_space == env.observation_space, \
+                "Error: the environment passed must have at least the same observation space as the model was trained on."
+            assert self.action_space == env.action_space, \
+                "Error: the environment passed must have at least the same action space as the model was trained on."
+            self.env = env
+            self._vectorize_action = False
+            self._vec_normalize_env = None
+            self.n_envs = 1
+            self.episode_reward = None
+            self.ep_info_buf = None
+        else:
+            super(VecPPO1, self).set_env(env)
+
+    def learn(self, *args, **kwargs):
+        if getattr(self.env, 'num_envs', 1) == 1:
+            return super(VecPPO1, self).learn(*args, **kwargs)
+
+        traj_segment_generator = pposgd_simple.traj_segment_generator
+        pposgd_simple.traj_segment_generator = partial(vec_traj_segment_generator, gamma = self.gamma)
+        try:
+            return super(VecPPO1, self).learn(*args, **kwargs)
+        finally:
+            pposgd_simple.traj_segment_generator = traj_segment_generator